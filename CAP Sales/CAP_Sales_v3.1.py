@@ -1,20 +1,38 @@
-import aiohttp
+import argparse
 import asyncio
+import glob
 import pandas as pd
 import xml.etree.ElementTree as ET
 from datetime import datetime
 import logging
 import os
-import csv
-from tqdm.asyncio import tqdm  # Import tqdm for async
+from tqdm import tqdm
 
 # Update file paths
 home_dir = os.path.expanduser('~')
 base_path = os.path.join(home_dir, 'OneDrive - Motor Depot', 'Python Scripts', 'CAP', 'CAP Sales')
 input_csv_path = os.path.join(base_path, 'CAP_Sales_Input.csv')
 output_csv_base_path = os.path.join(base_path, 'Outputs', 'CAP_Sales_Output.csv')
+backfill_dir = os.path.join(base_path, 'Outputs', 'Backfill')
 current_date = datetime.now().strftime("%Y%m%d")
-error_log_path = os.path.join(base_path, 'Logs', f'CAP_Sales_errors_{current_date}.log')
+logs_dir = os.path.join(base_path, 'Logs')
+error_log_path = os.path.join(logs_dir, f'CAP_Sales_errors_{current_date}.log')
+
+# The shared CAP_* modules are importable through cap or `pip install -e .`
+from CAP_analytics import analyse
+from CAP_budget import BUDGET
+from CAP_cache import (CACHE_DIRECTORY, CACHE_FILENAME, METADATA_FIELDS, CapidMetadataStore, SingleFlight,
+                       parse_capid_metadata)
+from CAP_calendar import period_keys
+from CAP_connect import CONNECTIONS
+from CAP_graph import RequestGraph
+from CAP_inputs import read_csv
+from CAP_metrics import METRICS
+from CAP_normalise import format_dates, mileage_buckets, normalise_dates, unparsed_values
+from CAP_options import LATEST, add_common_arguments, run_tool
+from CAP_output import open_output, row_type, write_rows
+from CAP_shard import RateLimiter
+from CAP_warehouse import WarehouseSink, add_frame, available
 
 # Configure logging
 logging.basicConfig(filename=error_log_path, level=logging.ERROR,
@@ -30,88 +48,139 @@ DATABASE = 'CAR'
 NAMESPACE_USEDVALUESLIVE = {'ns': 'https://soap.cap.co.uk/usedvalueslive'}
 NAMESPACE_VRM = {'ns': 'https://soap.cap.co.uk/vrm'}
 VRM_URL = 'https://soap.cap.co.uk/vrm/capvrm.asmx/CAPIDValuation'
-
-df = pd.read_csv(input_csv_path)
-
-def round_up_to_nearest_thousand(mileage):
-    return int((mileage + 500) / 1000) * 1000
-
-def detect_and_convert_date_format(date_str):
-    for fmt in ('%d/%m/%Y', '%Y-%m-%d'):
-        try:
-            return datetime.strptime(date_str, fmt).strftime('%Y-%m-%d')
-        except ValueError:
-            continue
-    raise ValueError(f"Date format for '{date_str}' not recognized.")
+CONCURRENCY = 100  # Rows in flight at once; --concurrency overrides
+
+OUTPUT_HEADER = [
+    'VRM', 'mileage', 'CAP ID', 'Reg Date',
+    'SaleClean', 'SaleRetail', 'SaleValuationDate',
+    'PurchaseClean', 'PurchaseRetail', 'PurchaseValuationDate',
+    'CAPMan', 'CAPRange', 'CAPMod', 'CAPDer', 'ModIntroduced', 'ModDiscontinued', 'CAP Code',
+    'SaleMileage',  # The mileage the sale was valued at: 'mileage', or its 10,000-mile fallback
+    'SaleDate', 'PurchaseDate',  # The input's dates (YYYY-MM-DD); CAP's valuation dates are period dates
+]
+
+# Output rows are compact records (CAP_output.Row) rather than a dict per row
+SalesOutput = row_type('SalesOutput', OUTPUT_HEADER)
+
+# Output columns added to the valuation warehouse (CAP_warehouse): the record fields,
+# then (endpoint, valuation date, clean, retail) for the sale and the purchase valuation
+WAREHOUSE_FIELDS = {'vrm': 'VRM', 'capid': 'CAP ID', 'reg_date': 'Reg Date', 'mileage_bucket': 'mileage'}
+WAREHOUSE_VALUATIONS = [
+    ('GetUsedLive_IdRegDateMileage', 'SaleValuationDate', 'SaleClean', 'SaleRetail', 'SaleMileage'),
+    ('GetUsedLive_IdRegDateMileage', 'PurchaseValuationDate', 'PurchaseClean', 'PurchaseRetail'),
+]
+
+# capid -> derivative metadata, persisted across runs and filled by prefetch_metadata
+metadata_store = CapidMetadataStore(DATABASE)
+
+# One valuation call per capid, registration date, mileage and CAP publication period
+live_requests = SingleFlight('live_requests')
+
+# Requests per second across the whole run; unlimited unless --rate is given
+rate_limiter = RateLimiter()
+
+def prepare_input(df, strict=True):
+    # Normalise whole columns before scheduling so process_row only reads ready-made values.
+    # The input frame itself is left untouched because it is written back at the end.
+    # Unless strict, unrecognised dates are logged and left missing instead of stopping the run.
+    prepared = df.copy()
+    dates = {}
+    for column, target in (('DateFirstRegistered', 'reg_date'), ('SaleDate', 'sale_date'), ('PurchaseDate', 'purchase_date')):
+        converted = normalise_dates(df[column])
+        unparsed = unparsed_values(df[column], converted)
+        if strict and not unparsed.empty:
+            raise ValueError(f"Date format for '{unparsed.iloc[0]}' not recognized.")
+        for index, value in unparsed.items():
+            logging.error(f"{column} '{value}' not recognized.", extra={'registration': df.at[index, 'Registration']})
+        prepared[target] = format_dates(converted)
+        dates[target] = converted
+    # Sale and purchase dates are valued as they are, but share a call per CAP publication period
+    prepared['sale_period'] = period_keys(dates['sale_date'])
+    prepared['purchase_period'] = period_keys(dates['purchase_date'])
+    prepared['sale_month'] = dates['sale_date'].dt.strftime('%Y-%m')
+    prepared['rounded_mileage'] = mileage_buckets(df['Mileage'], offset=500)  # Nearest 1000 miles
+    return prepared
 
 async def fetch_valuation(payload, registration, session):
-    async with session.post(LIVE_URL, headers=HEADERS, data=payload) as response:
-        if response.status != 200:
+    await rate_limiter.wait()
+    with METRICS.request(LIVE_URL) as call:
+        async with session.post(LIVE_URL, headers=HEADERS, data=payload) as response:
+            call.status = response.status
+            if response.status != 200:
+                response_text = await response.text()
+                logging.error(f"Server returned status code {response.status}: {response_text}",
+                              extra={'registration': registration})
+                return None
+
             response_text = await response.text()
-            logging.error(f"Server returned status code {response.status}: {response_text}",
-                          extra={'registration': registration})
-            return None
-
-        response_text = await response.text()
-        root = ET.fromstring(response_text)
-
-        valuation_date_element = root.find('.//ns:ValuationDate/ns:Date', NAMESPACE_USEDVALUESLIVE)
-        if valuation_date_element is not None:
-            valuation_date_str = valuation_date_element.text
-            valuation_date_obj = datetime.strptime(valuation_date_str, "%Y-%m-%dT%H:%M:%S")
-            valuation_date = valuation_date_obj.strftime("%d/%m/%Y")
-        else:
-            logging.error(f"Valuation date not found in the XML response: {ET.tostring(root).decode()}",
-                          extra={'registration': registration})
-            return None
-
-        clean_element = root.find('.//ns:Clean', NAMESPACE_USEDVALUESLIVE)
-        retail_element = root.find('.//ns:Retail', NAMESPACE_USEDVALUESLIVE)
-
-        if clean_element is not None and retail_element is not None:
-            clean = clean_element.text
-            retail = retail_element.text
-        else:
-            clean = retail = ''
+            root = ET.fromstring(response_text)
+
+            valuation_date_element = root.find('.//ns:ValuationDate/ns:Date', NAMESPACE_USEDVALUESLIVE)
+            if valuation_date_element is not None:
+                valuation_date_str = valuation_date_element.text
+                valuation_date_obj = datetime.strptime(valuation_date_str, "%Y-%m-%dT%H:%M:%S")
+                valuation_date = valuation_date_obj.strftime("%d/%m/%Y")
+            else:
+                logging.error(f"Valuation date not found in the XML response: {ET.tostring(root).decode()}",
+                              extra={'registration': registration})
+                return None
+
+            clean_element = root.find('.//ns:Clean', NAMESPACE_USEDVALUESLIVE)
+            retail_element = root.find('.//ns:Retail', NAMESPACE_USEDVALUESLIVE)
+
+            if clean_element is not None and retail_element is not None:
+                clean = clean_element.text
+                retail = retail_element.text
+            else:
+                clean = retail = ''
 
     return valuation_date, clean, retail
 
 
 async def fetch_vrm_data(payload, registration, session):
-    async with session.post(VRM_URL, headers=HEADERS, data=payload) as response:
-        if response.status != 200:
+    await rate_limiter.wait()
+    with METRICS.request(VRM_URL) as call:
+        async with session.post(VRM_URL, headers=HEADERS, data=payload) as response:
+            call.status = response.status
+            if response.status != 200:
+                response_text = await response.text()
+                logging.error(f"VRM API returned status code {response.status}: {response_text}",
+                              extra={'registration': registration})
+                return None
+
             response_text = await response.text()
-            logging.error(f"VRM API returned status code {response.status}: {response_text}",
-                          extra={'registration': registration})
-            return None
-
-        response_text = await response.text()
-        root = ET.fromstring(response_text)
-
-        capid_lookup = root.find('.//ns:CAPIDLookup', NAMESPACE_VRM)
-        if capid_lookup is None or capid_lookup.find('.//ns:Success', NAMESPACE_VRM).text != 'true':
-            logging.error("CAPIDLookup element missing or not successful in VRM API response",
-                          extra={'registration': registration})
-            return None
-
-        # Extracting individual fields
-        cap_man = capid_lookup.find('.//ns:CAPMan', NAMESPACE_VRM).text if capid_lookup.find('.//ns:CAPMan', NAMESPACE_VRM) is not None else ''
-        cap_range = capid_lookup.find('.//ns:CAPRange', NAMESPACE_VRM).text if capid_lookup.find('.//ns:CAPRange', NAMESPACE_VRM) is not None else ''
-        cap_mod = capid_lookup.find('.//ns:CAPMod', NAMESPACE_VRM).text if capid_lookup.find('.//ns:CAPMod', NAMESPACE_VRM) is not None else ''
-        cap_der = capid_lookup.find('.//ns:CAPDer', NAMESPACE_VRM).text if capid_lookup.find('.//ns:CAPDer', NAMESPACE_VRM) is not None else ''
-        mod_introduced = capid_lookup.find('.//ns:ModIntroduced', NAMESPACE_VRM).text if capid_lookup.find('.//ns:ModIntroduced', NAMESPACE_VRM) is not None else None
-        mod_discontinued = capid_lookup.find('.//ns:ModDiscontinued', NAMESPACE_VRM).text if capid_lookup.find('.//ns:ModDiscontinued', NAMESPACE_VRM) is not None else None
-        der_introduced = capid_lookup.find('.//ns:DerIntroduced', NAMESPACE_VRM).text if capid_lookup.find('.//ns:DerIntroduced', NAMESPACE_VRM) is not None else None
-        der_discontinued = capid_lookup.find('.//ns:DerDiscontinued', NAMESPACE_VRM).text if capid_lookup.find('.//ns:DerDiscontinued', NAMESPACE_VRM) is not None else None
-        cap_code = capid_lookup.find('.//ns:CAPcode', NAMESPACE_VRM).text if capid_lookup.find('.//ns:CAPcode', NAMESPACE_VRM) is not None else ''
-
-    return cap_man, cap_range, cap_mod, cap_der, mod_introduced, mod_discontinued, der_introduced, der_discontinued, cap_code
+
+    metadata = parse_capid_metadata(response_text)
+    if metadata is None:
+        logging.error("CAPIDLookup element missing or not successful in VRM API response",
+                      extra={'registration': registration})
+    return metadata
+
+
+async def prefetch_metadata(prepared, session):
+    # Look up every distinct CAPID missing from the metadata cache once, before any row starts.
+    # CAPIDValuation needs a registration date and mileage; the first row for each capid supplies them.
+    samples = prepared.dropna(subset=['CAPID']).drop_duplicates('CAPID')
+    samples = samples.set_index(samples['CAPID'].astype(int))
+
+    def fetch(capid):
+        vrm_payload = {
+            'SubscriberID': SUBSCRIBER_ID,
+            'Password': PASSWORD,
+            'Database': DATABASE,
+            'CAPID': capid,
+            'RegisteredDate': samples.at[capid, 'reg_date'],
+            'Mileage': int(samples.at[capid, 'rounded_mileage']),
+            'StandardEquipmentRequired': False
+        }
+        return fetch_vrm_data(vrm_payload, samples.at[capid, 'Registration'], session)
+
+    calls = await metadata_store.prefetch(samples.index, fetch)
+    print(f"{len(samples)} distinct CAPIDs, {calls} metadata lookups needed")
 
 async def process_row(row, session):
-    reg_date = detect_and_convert_date_format(row.DateFirstRegistered)
-    sale_valuation_date = detect_and_convert_date_format(row.SaleDate)
-    purchase_valuation_date = detect_and_convert_date_format(row.PurchaseDate)    
-    rounded_mileage = round_up_to_nearest_thousand(row.Mileage)
+    reg_date = row.reg_date
+    rounded_mileage = int(row.rounded_mileage)
     capid = int(row.CAPID) if not pd.isna(row.CAPID) else None
 
     sale_payload = {
@@ -119,55 +188,61 @@ async def process_row(row, session):
         'password': PASSWORD,
         'database': DATABASE,
         'capid': capid,
-        'valuationDate': sale_valuation_date,
+        'valuationDate': row.sale_date,
         'regDate': reg_date,
         'mileage': rounded_mileage
     }
-    sale_valuation_info = await fetch_valuation(sale_payload, row.Registration, session)
-    if sale_valuation_info is not None:
-        sale_valuation_date, sale_clean, sale_retail = sale_valuation_info
+
+    def valuation(valuation_date, period, mileage):
+        # Rows for the same vehicle profile valued in the same period share one call
+        payload = {**sale_payload, 'valuationDate': valuation_date, 'mileage': mileage}
+        return live_requests.do((capid, reg_date, mileage, period),
+                                lambda: fetch_valuation(payload, row.Registration, session))
+
+    sale_mileage = rounded_mileage
+
+    async def sale_with_fallback(sale_valuation_info):
+        # Retry the sale valuation at the nearest 10,000 miles when the 1,000-mile bucket has no figures
+        nonlocal sale_mileage
+        if sale_valuation_info is not None and sale_valuation_info[1] and sale_valuation_info[2]:
+            return sale_valuation_info
+        rounded_mileage_10000 = round(rounded_mileage / 10000) * 10000
+        if rounded_mileage_10000 == rounded_mileage:
+            return sale_valuation_info
+        METRICS.inc('cap_retries_total', tool='CAP_Sales', reason='10000_mile_fallback')
+        valuation_info = await valuation(row.sale_date, row.sale_period, rounded_mileage_10000)
+        if valuation_info is None:
+            return sale_valuation_info
+        sale_mileage = rounded_mileage_10000
+        return valuation_info
+
+    # Sale and purchase calls are independent; only the sale fallback waits on the sale call
+    graph = RequestGraph()
+    graph.add('sale', lambda: valuation(row.sale_date, row.sale_period, rounded_mileage))
+    graph.add('sale_fallback', sale_with_fallback, 'sale')
+    graph.add('purchase', lambda: valuation(row.purchase_date, row.purchase_period, rounded_mileage))
+    results = await graph.run()
+
+    for step, result in results.items():
+        if isinstance(result, Exception):
+            logging.error(f"{step} request failed: {result}", extra={'registration': row.Registration})
+            results[step] = None
+
+    if results['sale_fallback'] is not None:
+        sale_valuation_date, sale_clean, sale_retail = results['sale_fallback']
     else:
         sale_valuation_date = sale_clean = sale_retail = ''
 
-        # Calculate valuations for Purchase Date
-    purchase_payload = {
-        'subscriberId': SUBSCRIBER_ID,
-        'password': PASSWORD,
-        'database': DATABASE,
-        'capid': capid,
-        'valuationDate': purchase_valuation_date,
-        'regDate': reg_date,
-        'mileage': rounded_mileage
-    }
-    purchase_valuation_info = await fetch_valuation(purchase_payload, row.Registration, session)
-    if purchase_valuation_info is not None:
-        purchase_valuation_date, purchase_clean, purchase_retail = purchase_valuation_info
+    if results['purchase'] is not None:
+        purchase_valuation_date, purchase_clean, purchase_retail = results['purchase']
     else:
         purchase_valuation_date = purchase_clean = purchase_retail = ''
 
-
-    rounded_mileage_10000 = None
-    if not clean or not retail:
-        rounded_mileage_10000 = round(sale_payload['mileage'] / 10000) * 10000
-        if rounded_mileage_10000 != sale_payload['mileage']:
-            retry_payload = sale_payload.copy()
-            retry_payload['mileage'] = rounded_mileage_10000
-            valuation_info = await fetch_valuation(retry_payload, row.Registration, session)
-            if valuation_info is not None:
-                valuation_date, clean, retail = valuation_info
-
-    vrm_payload = {
-        'SubscriberID': SUBSCRIBER_ID,
-        'Password': PASSWORD,
-        'Database': DATABASE,
-        'CAPID': capid,
-        'RegisteredDate': reg_date,
-        'Mileage': rounded_mileage,
-        'StandardEquipmentRequired': False
-    }
-    vrm_info = await fetch_vrm_data(vrm_payload, row.Registration, session)
-    if vrm_info is not None:
-        cap_man, cap_range, cap_mod, cap_der, mod_introduced, mod_discontinued, der_introduced, der_discontinued, cap_code = vrm_info
+    # Derivative metadata was resolved once per capid by prefetch_metadata
+    metadata = metadata_store.get(capid) if capid is not None else None
+    if metadata is not None:
+        cap_man, cap_range, cap_mod, cap_der, mod_introduced, mod_discontinued, der_introduced, der_discontinued, cap_code = (
+            metadata[field] for field in METADATA_FIELDS)
     else:
         cap_man = cap_range = cap_mod = cap_der = mod_introduced = mod_discontinued = der_introduced = der_discontinued = cap_code = ''
 
@@ -175,35 +250,136 @@ async def process_row(row, session):
         row.Registration, sale_payload['mileage'], capid, reg_date,
         sale_clean, sale_retail, sale_valuation_date,
         purchase_clean, purchase_retail, purchase_valuation_date,
-        cap_man, cap_range, cap_mod, cap_der, mod_introduced, mod_discontinued, cap_code
+        cap_man, cap_range, cap_mod, cap_der, mod_introduced, mod_discontinued, cap_code,
+        sale_mileage,
+        row.sale_date, row.purchase_date,
     ]
 
 
 
 
-async def main():
-    df = pd.read_csv(input_csv_path)
-    output_rows = []
+async def main(ordered=True, warehouse_directory=None, cache_directory=CACHE_DIRECTORY):
+    # Read on a thread so the connection warm-up (CAP_connect) carries on meanwhile; from the
+    # input's sidecar while it is unchanged (CAP_inputs)
+    df = await asyncio.to_thread(read_csv, input_csv_path, cache_directory)
+
+    # Rows are written as they finish, so partial results are on disk while the run is going
+    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    output_base_path = f"{os.path.splitext(output_csv_base_path)[0]}_{timestamp}"
+    warehouse = WarehouseSink.open(warehouse_directory, 'CAP_Sales', f'CAP_Sales_{timestamp}',
+                                   WAREHOUSE_FIELDS, WAREHOUSE_VALUATIONS)
+    with open_output(output_base_path, [], OUTPUT_HEADER, formats=('csv',), warehouse=warehouse) as output:
+        async with CONNECTIONS.session() as session:
+            prepared = prepare_input(df)
+            await prefetch_metadata(prepared, session)
+            metadata_store.close()
 
-    async with aiohttp.ClientSession() as session:
-        tasks = [process_row(row, session) for row in df.itertuples()]
-        for output_row in tqdm(asyncio.as_completed(tasks), total=len(df), desc="Processing Rows"):
-            result = await output_row
-            output_rows.append(result)
+            async def process(row):
+                return SalesOutput(*await process_row(row, session))
 
-    # Writing output CSV file
-    output_csv_path = f"{os.path.splitext(output_csv_base_path)[0]}_{datetime.now().strftime('%Y%m%d%H%M%S')}.csv"
-    with open(output_csv_path, 'w', newline='') as f_output:
-        csv_writer = csv.writer(f_output)
-        csv_writer.writerow([
-            'VRM', 'mileage', 'CAP ID', 'Reg Date',
-            'SaleClean', 'SaleRetail', 'SaleValuationDate',
-            'PurchaseClean', 'PurchaseRetail', 'PurchaseValuationDate',
-            'CAPMan', 'CAPRange', 'CAPMod', 'CAPDer', 'ModIntroduced', 'ModDiscontinued', 'CAP Code'
-        ])
-        csv_writer.writerows(output_rows)
+            with tqdm(total=len(df), desc="Processing Rows") as pbar:
+                await write_rows(prepared.itertuples(), process, output, CONCURRENCY, ordered, pbar.update)
+    print(f"{live_requests.requests} valuations needed {live_requests.calls} CAP calls")
 
     df.to_csv(input_csv_path, index=False)
 
+    for path in analyse(output.paths, f'{output_base_path}_Summary'):
+        print(f"Summary written to {path}")
+
+def partition_path(directory, month):
+    return os.path.join(directory, f'CAP_Sales_Output_{month}.csv')
+
+
+async def backfill(input_path, name, warehouse_directory=None, cache_directory=CACHE_DIRECTORY):
+    # Value a large sales history one sale month at a time. Each month is written to its own
+    # file under a temporary name and renamed once complete, so finished months survive a
+    # crash and running the same backfill again picks up at the first unfinished month.
+    directory = os.path.join(backfill_dir, name)
+    os.makedirs(directory, exist_ok=True)
+
+    df = await asyncio.to_thread(read_csv, input_path, cache_directory)
+    prepared = prepare_input(df, strict=False)
+    usable = prepared[['Registration', 'CAPID', 'reg_date', 'sale_period', 'purchase_period', 'rounded_mileage']].notna().all(axis=1)
+    if not usable.all():
+        print(f"Skipping {(~usable).sum()} rows with missing or unrecognised values; see {error_log_path}")
+    partitions = dict(tuple(prepared[usable].groupby('sale_month', sort=True)))
+
+    pending = [month for month in partitions if not os.path.exists(partition_path(directory, month))]
+    print(f"{len(partitions)} sale months in {input_path}, {len(partitions) - len(pending)} already complete")
+
+    failed = []
+    add_to_warehouse = available(warehouse_directory)
+    async with CONNECTIONS.session() as session:
+        await prefetch_metadata(prepared[usable], session)
+        metadata_store.close()
+
+        async def process(row):
+            return SalesOutput(*await process_row(row, session))
+
+        for month in pending:
+            rows = partitions[month]
+            partial_base_path = os.path.join(directory, f'CAP_Sales_Output_{month}.partial')
+            try:
+                with open_output(partial_base_path, [], OUTPUT_HEADER, formats=('csv',)) as output:
+                    with tqdm(total=len(rows), desc=month) as pbar:
+                        await write_rows(rows.itertuples(), process, output, CONCURRENCY, True, pbar.update)
+            except Exception as e:
+                # Leave the month for the next run and carry on with the rest
+                logging.error(f"Backfill of sale month {month} failed: {e}", extra={'registration': '-'})
+                failed.append(month)
+                continue
+            if BUDGET.stopped:
+                # The daily call budget ran out part way through; the month is redone on the next run
+                failed.append(month)
+                break
+            os.replace(f'{partial_base_path}.csv', partition_path(directory, month))
+            if add_to_warehouse:
+                # Only complete months are added, so a month redone after a failure isn't added twice
+                added = add_frame(pd.read_csv(partition_path(directory, month), dtype=str), 'CAP_Sales',
+                                  f'backfill_{name}_{month}', WAREHOUSE_FIELDS, WAREHOUSE_VALUATIONS, warehouse_directory)
+                print(f"{added} valuations added to the warehouse in {warehouse_directory}")
+
+    print(f"{live_requests.requests} valuations needed {live_requests.calls} CAP calls")
+    print(f"{len(pending) - len(failed)} sale months written to {directory}")
+    if failed:
+        print(f"{len(failed)} sale months failed ({', '.join(failed)}); run the same backfill again to retry them")
+
+    # Summarise every month written so far, including months finished by earlier runs
+    completed = [partition_path(directory, month) for month in partitions
+                 if os.path.exists(partition_path(directory, month))]
+    for path in analyse(completed, os.path.join(directory, 'CAP_Sales_Summary')):
+        print(f"Summary written to {path}")
+
+
 if __name__ == '__main__':
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Value each sale in CAP_Sales_Input.csv at its sale and purchase dates")
+    parser.add_argument('--unordered', action='store_true',
+                        help="Write rows in completion order instead of input order")
+    parser.add_argument('--backfill', metavar='NAME',
+                        help="Value a large sales history by sale month into Outputs/Backfill/NAME; "
+                             "running the same NAME again resumes it")
+    parser.add_argument('--input', default=input_csv_path,
+                        help="Sales history to backfill (default: CAP_Sales_Input.csv)")
+    add_common_arguments(parser, CONCURRENCY, priority=None)
+    args = parser.parse_args()
+
+    # --resume carries on with a backfill: the one named, or the most recently written
+    if args.resume:
+        if args.resume != LATEST:
+            args.backfill = args.resume
+        elif not args.backfill:
+            previous = sorted(glob.glob(os.path.join(backfill_dir, '*', '')), key=os.path.getmtime)
+            if not previous:
+                parser.error(f"--resume: no previous backfill in {backfill_dir}")
+            args.backfill = os.path.basename(os.path.dirname(previous[-1]))
+        print(f"Resuming backfill {args.backfill}")
+
+    CONCURRENCY = args.concurrency
+    # A backfill gives way to every other run sharing --rate
+    rate_limiter = RateLimiter(args.rate, args.priority or ('backfill' if args.backfill else 'lookups'))
+    metadata_store.path = os.path.join(args.cache, CACHE_FILENAME)
+    CONNECTIONS.start(LIVE_URL, args.warm_connections)
+    if args.backfill:
+        run_tool(args, logs_dir, 'CAP_Sales', CONNECTIONS.run, backfill(args.input, args.backfill, args.warehouse, args.cache))
+    else:
+        run_tool(args, logs_dir, 'CAP_Sales', CONNECTIONS.run, main(not args.unordered, args.warehouse, args.cache))
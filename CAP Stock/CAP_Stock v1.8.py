@@ -1,4 +1,4 @@
-import sys
+import argparse
 import os
 import pandas as pd
 import xml.etree.ElementTree as ET
@@ -8,19 +8,30 @@ import glob
 import re
 from tqdm import tqdm
 import shutil
-import aiohttp
 import asyncio
+import time
 
 # Get the home directory of the current user
 home_directory = os.path.expanduser('~')
 
-# Add the 'CAP' directory to the Python path
 script_directory = os.path.dirname(os.path.realpath(__file__))
-cap_config_directory = os.path.join(script_directory, '..', '..', 'CAP')
-sys.path.append(cap_config_directory)
 
-# Now import the variables from CAP_config
+# CAP_config and the shared CAP_* modules are importable through cap or `pip install -e .`
 from CAP_config import SUBSCRIBER_ID, PASSWORD, FIXED_VALUATION_DATE
+from CAP_budget import BUDGET
+from CAP_cache import SingleFlight
+from CAP_calendar import period_key
+from CAP_connect import CONNECTIONS
+from CAP_inputs import read_csv, read_excel
+from CAP_interpolate import (INTERPOLATE_TOLERANCE, INTERPOLATED_COLUMN, MileageInterpolator, interpolated_cells,
+                             interpolation_summary)
+from CAP_metrics import METRICS
+from CAP_normalise import (format_dates, mileage_buckets, normalise_dates, normalise_ids, normalise_registrations,
+                            unparsed_values)
+from CAP_options import add_common_arguments, run_tool
+from CAP_shard import RateLimiter
+from CAP_trace import TRACER
+from CAP_warehouse import add_frame, available
 
 # Create a timestamp for the log file
 current_date = datetime.now().strftime('%Y-%m-%d %H_%M_%S')
@@ -36,13 +47,45 @@ VRM_URL = 'https://soap.cap.co.uk/vrm/capvrm.asmx/VRMValuation'
 HEADERS = {'Content-Type': 'application/x-www-form-urlencoded'}
 DATABASE = 'CAR'
 VALUATION_DATE = datetime.now().strftime('%Y-%m-%d')
+CONCURRENCY = 100  # Rows valued at once; --concurrency overrides
+IF4C_STOCK_ID_COLUMNS = ('StockID', 'Stock ID')  # IF4C rows are matched by the first of these it has,
+IF4C_REGISTRATION_COLUMNS = ('Registration', 'Reg', 'VRM')  # then by registration for rows left unmatched
+IF4C_PREFIX = 'IF4C_'  # IF4C's other columns are added to the output with this prefix
+
+parser = argparse.ArgumentParser(description="Add live and FIXED_VALUATION_DATE CAP values to the autoedit stock export")
+parser.add_argument('--interpolate', nargs='?', type=int, const=INTERPOLATE_TOLERANCE, metavar='MILES',
+                    help="Estimate values from valued mileage buckets within MILES either side "
+                         f"(default: {INTERPOLATE_TOLERANCE}), calling CAP only when there are none")
+parser.add_argument('--if4c', metavar='XLSX',
+                    help="IF4C workbook whose columns are added to each stock row (default: IF4C.xlsx in Input Files)")
+parser.add_argument('--no-if4c', action='store_true', help="Don't add the IF4C columns")
+add_common_arguments(parser, CONCURRENCY, priority='stock')
+args = parser.parse_args()
+if args.resume:
+    parser.error("--resume is not supported: CAP Stock values the whole export in one pass")
+rate_limiter = RateLimiter(args.rate, args.priority)  # Unlimited unless --rate is given
 
 if4c_excel_path = os.path.join(home_directory, 'OneDrive - Motor Depot', 'Pricing', 'Input Files', 'IF4C.xlsx')
+if args.if4c:
+    if4c_excel_path = args.if4c
 input_excel_pattern = os.path.join(home_directory, 'OneDrive - Motor Depot', 'Pricing', 'Input Files', 'vehicles-autoedit*.xlsx')
 location_history_pattern = os.path.join(home_directory, 'OneDrive - Motor Depot', 'Pricing', 'Input Files', 'vehicles-location-history*.csv')
 
 NAMESPACE = {'ns': 'https://soap.cap.co.uk/usedvalueslive'}
 
+# One valuation call per capid, registration date, mileage and CAP publication period, so
+# VALUATION_DATE and FIXED_VALUATION_DATE share a call when they fall in the same period
+live_requests = SingleFlight('live_requests')
+
+# Valuations CAP only had figures for at the 10000-mile fallback: valuation type -> {row: mileage valued}
+fallback_mileages = {'current': {}, 'fixed': {}}
+
+# Neighbouring mileage buckets values are estimated from, with --interpolate (CAP_interpolate)
+interpolator = MileageInterpolator(args.interpolate) if args.interpolate is not None else None
+
+# Connect to CAP in the background while the spreadsheets are read
+CONNECTIONS.start(LIVE_URL, args.warm_connections)
+
 # Load and filter out rows with any blank input data from Excel
 input_files = glob.glob(input_excel_pattern)
 
@@ -53,8 +96,8 @@ if not input_files:
 # Select the first valid input file
 input_excel_path = input_files[0]
 
-# Read the entire Excel file
-df = pd.read_excel(input_excel_path)
+# Read the entire Excel file, from its sidecar when it hasn't changed since the last run (CAP_inputs)
+df = read_excel(input_excel_path, args.cache)
 
 # Convert 'StockID' to string
 df['StockID'] = df['StockID'].astype(str)
@@ -64,6 +107,9 @@ df['CleanLive'] = 0.0  # Initialize as float
 df['RetailLive'] = 0.0  # Initialize as float
 df['CleanMonth'] = 0.0  # Initialize as float
 df['RetailMonth'] = 0.0  # Initialize as float
+VALUE_COLUMNS = ['CleanLive', 'RetailLive', 'CleanMonth', 'RetailMonth']
+if interpolator is not None:
+    df[INTERPOLATED_COLUMN] = None  # Cells estimated from neighbouring mileage buckets
 
 # Clean the Price column
 df['Price'] = df['Price'].replace({'£': '', ',': ''}, regex=True)
@@ -88,7 +134,7 @@ location_history_pattern = os.path.join(home_directory, 'OneDrive - Motor Depot'
 
 def process_location_history(location_history_file):
     # Load the location history file
-    location_df = pd.read_csv(location_history_file)
+    location_df = read_csv(location_history_file, args.cache)
 
     # Convert 'Stock ID' to string
     location_df['Stock ID'] = location_df['Stock ID'].astype(str)
@@ -120,106 +166,149 @@ else:
     print(f"No matching location history files found with pattern: {location_history_pattern}")
     exit()
 
-def lookup_date_arrived(row, location_df):
-    stock_id = str(row['StockID'])  # Convert to string for safety
-    matching_rows = location_df[location_df['Stock ID'] == stock_id]
-    
-    if not matching_rows.empty:
-        matching_rows = matching_rows.sort_values(by='Date Arrived')
-        return matching_rows.iloc[0]['Date Arrived']
-    
-    return None
-
-# Add a new column 'Date Arrived' to the autoedit file by looking up the Date Arrived from location history
-df['Date Arrived'] = df.apply(lookup_date_arrived, args=(location_df,), axis=1)
+# Add a new column 'Date Arrived' to the autoedit file: the earliest arrival per stock ID in the location history
+first_arrivals = location_df.groupby('Stock ID')['Date Arrived'].min()
+df['Date Arrived'] = df['StockID'].map(first_arrivals)
+
+def if4c_positions(keys, if4c_keys):
+    # The IF4C row of each key (the last one when a key repeats), NaN where there is none
+    index = pd.Series(range(len(if4c_keys)), index=if4c_keys.array)
+    index = index[index.index.notna() & ~index.index.duplicated(keep='last')]
+    return keys.map(index)
+
+def join_if4c(df, if4c):
+    # df with IF4C's columns added, each stock row matched to IF4C by stock ID and, failing
+    # that, by registration. The whole frame is joined at once through one index per key.
+    stock_id_column = next((column for column in IF4C_STOCK_ID_COLUMNS if column in if4c.columns), None)
+    registration_column = next((column for column in IF4C_REGISTRATION_COLUMNS if column in if4c.columns), None)
+    if stock_id_column is None and registration_column is None:
+        print(f"IF4C has no {' or '.join(IF4C_STOCK_ID_COLUMNS + IF4C_REGISTRATION_COLUMNS)} column; not added")
+        return df
+    position = pd.Series(float('nan'), index=df.index)
+    if stock_id_column is not None:
+        position = if4c_positions(normalise_ids(df['StockID']), normalise_ids(if4c[stock_id_column]))
+    by_stock_id = int(position.notna().sum())
+    if registration_column is not None:
+        position = position.fillna(if4c_positions(normalise_registrations(df['Registration']),
+                                                  normalise_registrations(if4c[registration_column])))
+    columns = [column for column in if4c.columns if column not in (stock_id_column, registration_column)]
+    joined = if4c[columns].reset_index(drop=True).reindex(position.to_numpy())
+    joined.index = df.index
+    joined.columns = [f'{IF4C_PREFIX}{column}' for column in columns]
+    matched = int(position.notna().sum())
+    print(f"IF4C matched {matched} of {len(df)} stock rows ({by_stock_id} by stock ID, "
+          f"{matched - by_stock_id} by registration)")
+    return pd.concat([df, joined], axis=1)
+
+# Add the IF4C columns
+if args.no_if4c:
+    pass
+elif os.path.exists(if4c_excel_path):
+    df = join_if4c(df, read_excel(if4c_excel_path, args.cache))
+else:
+    print(f"No IF4C workbook at {if4c_excel_path}; the IF4C columns are not added")
 
 # Functions to round up mileage
 def round_up_to_nearest(mileage, round_to):
     return int((mileage + round_to - 1) / round_to) * round_to
 
+# Normalise whole columns before scheduling; kept out of df so they are not written to the output
+reg_dates = format_dates(normalise_dates(df['DateFirstRegistered']))
+rounded_mileages = mileage_buckets(df['Mileage'], 1000)  # Round up to nearest 1000 for initial request
+
 class LiveURLHandler:
     @staticmethod
     async def fetch_live_valuation(payload, registration, mileage_for_request, capid, reg_date, session, valuation_date_type, round_to):
-        async with session.post(LIVE_URL, headers=HEADERS, data=payload) as response:
-            # Check for successful response, proceed only if successful
-            if response.status == 200:
+        await rate_limiter.wait()
+        with METRICS.request(LIVE_URL) as call:
+            async with session.post(LIVE_URL, headers=HEADERS, data=payload) as response:
+                call.status = response.status
                 content = await response.text()
+
+        # Check for successful response, proceed only if successful
+        if response.status == 200:
+            with TRACER.span('parse'):
                 root = ET.fromstring(content)
                 valuation = root.find('.//ns:Valuation', NAMESPACE)
 
-                if valuation is not None:
-                    clean_element = valuation.find('ns:Clean', NAMESPACE)
-                    retail_element = valuation.find('ns:Retail', NAMESPACE)
-                    clean = clean_element.text if clean_element is not None else ''
-                    retail = retail_element.text if retail_element is not None else ''
-
-                    if not clean and round_to == 1000:
-                        # If Clean value is missing for 1000 rounding, try 10000 rounding
-                        mileage_for_request = round_up_to_nearest(mileage_for_request, 10000)
-                        payload['mileage'] = mileage_for_request
+            if valuation is not None:
+                clean_element = valuation.find('ns:Clean', NAMESPACE)
+                retail_element = valuation.find('ns:Retail', NAMESPACE)
+                clean = clean_element.text if clean_element is not None else ''
+                retail = retail_element.text if retail_element is not None else ''
+
+                if not clean and round_to == 1000:
+                    # If Clean value is missing for 1000 rounding, try 10000 rounding
+                    METRICS.inc('cap_retries_total', tool='CAP_Stock', reason='10000_mile_fallback')
+                    mileage_for_request = round_up_to_nearest(mileage_for_request, 10000)
+                    payload['mileage'] = mileage_for_request
+                    with TRACER.span('fallback', mileage=mileage_for_request):
                         return await LiveURLHandler.fetch_live_valuation(payload, registration, mileage_for_request, capid, reg_date, session, valuation_date_type, 10000)
 
-                    return (valuation_date_type, registration, clean, retail, mileage_for_request if round_to == 10000 else '')
-            else:
-                content = await response.text()
-                logging.error(f"Server returned status code {response.status}: {content}, Registration: {registration}, Mileage: {mileage_for_request}")
+                return (valuation_date_type, registration, clean, retail, mileage_for_request if round_to == 10000 else '')
+        else:
+            logging.error(f"Server returned status code {response.status}: {content}, Registration: {registration}, Mileage: {mileage_for_request}")
 
 
 
 # Define a function to process each row
 async def process_row(idx, row, df, session):
     registration = row['Registration']
-    reg_date = datetime.strptime(row['DateFirstRegistered'], '%d/%m/%Y').strftime('%Y-%m-%d')
+    reg_date = reg_dates[idx]
     capid = int(row['CapID'])
 
     # Initialize variables to store results
     current_valuation = {'clean': '', 'retail': ''}
     fixed_valuation = {'clean': '', 'retail': ''}
 
-    # Round up mileage to nearest 1000 for initial request
-    rounded_mileage = round_up_to_nearest(row['Mileage'], 1000)
-
-    # Create payload for current valuation
-    current_payload = {
-        'subscriberId': SUBSCRIBER_ID,
-        'password': PASSWORD,
-        'database': DATABASE,
-        'capid': capid,
-        'regDate': reg_date,
-        'mileage': rounded_mileage,
-        'valuationDate': VALUATION_DATE
-    }
-
-    # Create payload for fixed valuation
-    fixed_payload = current_payload.copy()
-    fixed_payload['valuationDate'] = FIXED_VALUATION_DATE
-
-    # Set up async tasks for current valuation date and fixed valuation date
-    task1 = asyncio.create_task(
-        LiveURLHandler.fetch_live_valuation(current_payload, registration, rounded_mileage, capid, reg_date, session, 'current', 1000)
-    )
-    task2 = asyncio.create_task(
-        LiveURLHandler.fetch_live_valuation(fixed_payload, registration, rounded_mileage, capid, reg_date, session, 'fixed', 1000)
-    )
-
-    # Await both tasks and process results
-    results = await asyncio.gather(task1, task2)
-    # Process results and update the dataframe with the results
-    for result in results:
+    # Mileage already rounded up to nearest 1000 for initial request
+    rounded_mileage = int(rounded_mileages[idx])
+
+    estimated = set()  # Valuations --interpolate estimated instead of calling CAP
+
+    async def valuation(valuation_date, valuation_date_type):
+        if interpolator is not None:
+            estimate = interpolator.estimate(capid, reg_date, valuation_date, rounded_mileage)
+            if estimate is not None:
+                estimated.add(valuation_date_type)
+                return valuation_date_type, registration, *estimate, ''
+        payload = {
+            'subscriberId': SUBSCRIBER_ID,
+            'password': PASSWORD,
+            'database': DATABASE,
+            'capid': capid,
+            'regDate': reg_date,
+            'mileage': rounded_mileage,
+            'valuationDate': valuation_date
+        }
+        result = await live_requests.do(
+            (capid, reg_date, rounded_mileage, period_key(valuation_date)),
+            lambda: LiveURLHandler.fetch_live_valuation(payload, registration, rounded_mileage, capid, reg_date, session, valuation_date_type, 1000))
+        if interpolator is not None and result is not None and not result[4]:
+            # A neighbour for the rows still to come, unless it was valued at the 10000-mile fallback
+            interpolator.add(capid, reg_date, valuation_date, rounded_mileage, result[2], result[3])
+        return result
+
+    # Current and fixed valuations run at once, and share one call when they fall in the same period
+    results = await asyncio.gather(valuation(VALUATION_DATE, 'current'), valuation(FIXED_VALUATION_DATE, 'fixed'))
+    # Process results and update the dataframe with the results; a shared call carries the
+    # first caller's valuation_date_type, so results are matched by position
+    for valuation_date_type, valuation_result, result in zip(('current', 'fixed'), (current_valuation, fixed_valuation), results):
         if result is not None:
-            valuation_date_type, registration, clean, retail, _ = result
-            if valuation_date_type == 'current':
-                current_valuation['clean'] = clean
-                current_valuation['retail'] = retail
-            elif valuation_date_type == 'fixed':
-                fixed_valuation['clean'] = clean
-                fixed_valuation['retail'] = retail
+            _, _, clean, retail, fallback_mileage = result
+            valuation_result['clean'] = clean
+            valuation_result['retail'] = retail
+            if fallback_mileage:
+                fallback_mileages[valuation_date_type][idx] = fallback_mileage
 
     # Ensure the values are of float type before assigning them to the DataFrame
     df.at[idx, 'CleanLive'] = pd.to_numeric(current_valuation['clean'], errors='coerce')
     df.at[idx, 'RetailLive'] = pd.to_numeric(current_valuation['retail'], errors='coerce')
     df.at[idx, 'CleanMonth'] = pd.to_numeric(fixed_valuation['clean'], errors='coerce')
     df.at[idx, 'RetailMonth'] = pd.to_numeric(fixed_valuation['retail'], errors='coerce')
+    if interpolator is not None:
+        df.at[idx, INTERPOLATED_COLUMN] = interpolated_cells(('current' in estimated, 'CleanLive', 'RetailLive'),
+                                                             ('fixed' in estimated, 'CleanMonth', 'RetailMonth'))
 
 
 
@@ -262,28 +351,84 @@ while os.path.exists(output_csv_path):
     shutil.move(output_csv_path, renamed_output_csv_path)
     print(f"Output file already exists. Renamed to {renamed_output_csv_path}")
 
+def valued_buckets(valuation_date_type):
+    # The mileage bucket each row's valuation was made at: the 1000-mile bucket, or the
+    # 10000-mile one for a valuation that fell back to it
+    buckets = pd.Series(rounded_mileages, index=df.index)
+    fallback = fallback_mileages[valuation_date_type]
+    buckets[list(fallback)] = list(fallback.values())
+    return buckets
+
+def add_to_warehouse():
+    # The live and FIXED_VALUATION_DATE figures of every valued row, at the mileage bucket
+    # that was valued, go to the valuation warehouse (CAP_warehouse)
+    valued = df.assign(RegDate=reg_dates, MileageBucket=rounded_mileages,
+                       LiveBucket=valued_buckets('current'), MonthBucket=valued_buckets('fixed'),
+                       LiveDate=VALUATION_DATE, MonthDate=FIXED_VALUATION_DATE)
+    fields = {'vrm': 'Registration', 'capid': 'CapID', 'reg_date': 'RegDate', 'mileage_bucket': 'MileageBucket',
+              'interpolated': INTERPOLATED_COLUMN}
+    valuations = [
+        ('GetUsedLive_IdRegDateMileage', 'LiveDate', 'CleanLive', 'RetailLive', 'LiveBucket'),
+        ('GetUsedLive_IdRegDateMileage', 'MonthDate', 'CleanMonth', 'RetailMonth', 'MonthBucket'),
+    ]
+    added = add_frame(valued, 'CAP_Stock', datetime.now().strftime('%Y%m%d%H%M%S'),
+                      fields, valuations, args.warehouse)
+    print(f"{added} valuations added to the warehouse in {args.warehouse}")
+
+
 async def main():
-    async with aiohttp.ClientSession() as session:
+    async with CONNECTIONS.session() as session:
+        # Rows need every required column plus a recognised registration date
+        valid = df[required_columns].notna().all(axis=1)
+        for idx, value in unparsed_values(df['DateFirstRegistered'], reg_dates).items():
+            logging.error(f"Unrecognised DateFirstRegistered '{value}', Registration: {df.at[idx, 'Registration']}")
+        valid &= reg_dates.notna()
+        if interpolator is not None:
+            loaded = interpolator.load(df.loc[valid, 'CapID'], (VALUATION_DATE, FIXED_VALUATION_DATE), args.warehouse)
+            print(f"{loaded} warehouse valuations loaded as neighbours for --interpolate")
+
+        # At most --concurrency rows are being valued at any time
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def process_bounded(idx, row):
+            queued = time.perf_counter()
+            async with semaphore:
+                if BUDGET.exhausted:
+                    # Rows not started by the time the daily call budget is spent are left blank,
+                    # not at the 0.0 the columns start from, so they don't read as valuations
+                    BUDGET.stop()
+                    df.loc[idx, VALUE_COLUMNS] = float('nan')
+                    return
+                with TRACER.row('row', row=idx, vrm=row['Registration']):
+                    TRACER.record('queue wait', queued)
+                    await process_row(idx, row, df, session)
+
         tasks = []
-        for idx, row in df.iterrows():
-            if not row[required_columns].isnull().any():
-                tasks.append(asyncio.create_task(process_row(idx, row, df, session)))
+        for idx, row in df[valid].iterrows():
+            tasks.append(asyncio.create_task(process_bounded(idx, row)))
 
         # Create a progress bar for the tasks
         for f in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="Processing rows"):
             await f  # Await the completion of each task and update the progress bar
+            METRICS.row()
 
         # Create a new DataFrame with values only to remove formatting
         df_values_only = pd.DataFrame(df.values, columns=df.columns)
 
         # Save the updated dataframe to a new CSV file
-        df_values_only.to_csv(output_csv_path, index=False)
-
+        with TRACER.span('write', rows=len(df_values_only)):
+            df_values_only.to_csv(output_csv_path, index=False)
+
+        print(f"{live_requests.requests} valuations needed {live_requests.calls} CAP calls")
+        if interpolator is not None:
+            print(interpolation_summary(METRICS, 2 * len(tasks)))
+        if available(args.warehouse):
+            add_to_warehouse()
         print(f"Script completed. Processed data saved to {output_csv_path}. Errors and info messages logged to {log_file}")
 
 
 # Run the main async function
-asyncio.run(main())
+run_tool(args, os.path.join(script_directory, 'Logs'), 'CAP_Stock', CONNECTIONS.run, main())
 
 # Define the destination directory in OneDrive\Apex\
 apex_dir = os.path.join(home_directory, 'OneDrive - Motor Depot', 'Exports', 'Apex Stock')
@@ -1,12 +1,14 @@
-import aiohttp
 from aiohttp import TCPConnector
+import argparse
 import asyncio
+import contextlib
 from datetime import datetime, timedelta
 import csv
 from datetime import datetime
 from xml.etree import ElementTree
 import os
-from collections import OrderedDict
+import time
+import pandas as pd
 from tqdm.asyncio import tqdm
 
 # Constants
@@ -17,14 +19,25 @@ output_directory = os.path.join(script_directory, 'Outputs')  # Outputs director
 if not os.path.exists(output_directory):
     os.makedirs(output_directory)
 
-# Import CAP_config
-import sys
-sys.path.append(os.path.join(os.path.expanduser("~"), "OneDrive - Motor Depot", "Python Scripts", "CAP"))
+# CAP_config and the shared CAP_* modules are importable through cap or `pip install -e .`
 import CAP_config
+from CAP_archive import ResponseArchive, run_valuation_date
+from CAP_autotrader import (AUTOTRADER_COLUMNS, AUTOTRADER_CONCURRENCY, AUTOTRADER_RATE, AUTOTRADER_URL,
+                             AutotraderClient, load_credentials)
+from CAP_budget import BUDGET
+from CAP_connect import CONNECTIONS
+from CAP_metrics import METRICS
+from CAP_normalise import mileage_buckets
+from CAP_options import add_common_arguments, run_tool
+from CAP_output import open_output, row_type
+from CAP_shard import SHARD_MODES, RateLimiter, run_sharded, shard_indices
+from CAP_trace import TRACER
+from CAP_warehouse import WarehouseSink
 
 
 current_datetime = datetime.now().strftime('%Y%m%d_%H%M%S')
-output_file_path = os.path.join(output_directory, f'CAP_VRM_Output_{current_datetime}.csv')
+output_base_path = os.path.join(output_directory, f'CAP_VRM_Output_{current_datetime}')  # .parquet / .csv added per format
+OUTPUT_FORMATS = ('parquet', 'csv')  # Drop 'csv' once nothing reads the padded legacy layout
 logs_directory = os.path.join(onedrive_path, "Python Scripts", "CAP", "CAP VRM Lookup", "Logs")  # Logs directory within the Outputs directory
 if not os.path.exists(logs_directory):
     os.makedirs(logs_directory)
@@ -38,22 +51,26 @@ headers = {'Content-Type': 'application/x-www-form-urlencoded'}
 subscriber_id = CAP_config.SUBSCRIBER_ID  # Updated to use CAP_config
 password = CAP_config.PASSWORD         # Updated to use CAP_config
 
+# Pipeline concurrency: each stage has its own pool of workers; --concurrency sets both
+VRM_CONCURRENCY = 20   # Concurrent VRMValuation requests (stage 1)
+LIVE_CONCURRENCY = 20  # Concurrent live valuation requests (stage 2)
 
-# Function to display progress in KB
-def get_file_size_in_kb(file_path):
-    return os.path.getsize(file_path) / 1024
+ROUNDED_MILEAGE = '_rounded_mileage'  # Mileage bucket worked out for each input row by read_input
 
-def log_api_response(vrm, response, is_live=False):
-    log_type = 'live' if is_live else 'monthly'
-    log_filename = f'CAP_VRM_{log_type}_responses_{current_datetime}.log'
-    log_file_path = os.path.join(logs_directory, log_filename)
+# Shared across worker processes when running with --workers; unlimited unless --rate is given
+rate_limiter = RateLimiter()
 
-    with open(log_file_path, 'a', encoding='utf-8') as log_file:
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        log_file.write(f"{timestamp}: VRM: {vrm}, Response: {response}\n")
+# Raw response archive, set by --archive (record) or --replay (serve a recorded run)
+archive = None
 
-def round_mileage(mileage):
-    return round((int(mileage) + 500) / 1000) * 1000
+# Autotrader valuations and metrics fetched alongside CAP, set by --autotrader (CAP_autotrader)
+autotrader = None
+valuation_date = datetime.now().strftime('%Y-%m-%d')  # Replays reuse the recorded run's date
+
+
+# Function to display progress in KB
+def get_file_size_in_kb(file_path):
+    return os.path.getsize(file_path) / 1024
 
 async def post_cap_vrm_request(session, vrm, rounded_mileage):
     data = {
@@ -63,8 +80,21 @@ async def post_cap_vrm_request(session, vrm, rounded_mileage):
         'Mileage': rounded_mileage,
         'StandardEquipmentRequired': 'false'
     }
-    async with session.post(url_monthly, headers=headers, data=data) as response:
-        return await response.text(), response.status, vrm
+    if archive is not None and archive.replay_run:
+        replayed = archive.replay(url_monthly, data)
+        if replayed is None:
+            raise LookupError(f"No archived VRMValuation response for {vrm} in run {archive.replay_run}")
+        response_text, status = replayed
+        return response_text, status, vrm
+
+    await rate_limiter.wait()
+    with METRICS.request(url_monthly) as call:
+        async with session.post(url_monthly, headers=headers, data=data) as response:
+            response_text = await response.text()
+            call.status = response.status
+    if archive is not None:
+        archive.record(url_monthly, data, response_text, response.status)
+    return response_text, response.status, vrm
 
 async def post_cap_request_live_values(session, vrm, capid, registered_date, rounded_mileage):
     data = {
@@ -72,14 +102,26 @@ async def post_cap_request_live_values(session, vrm, capid, registered_date, rou
         'password': password,
         'database': 'CAR',
         'capid': capid,
-        'valuationDate': datetime.now().strftime('%Y-%m-%d'),
+        'valuationDate': valuation_date,
         'regDate': registered_date,
         'mileage': rounded_mileage
     }
+    if archive is not None and archive.replay_run:
+        replayed = archive.replay(url_live, data)
+        if replayed is None:
+            print(f"No archived live response for VRM {vrm} in run {archive.replay_run}")
+            return None
+        return replayed[0]
+
     try:
-        async with session.post(url_live, data=data) as response:
-            response_text = await response.text()
-            return response_text
+        await rate_limiter.wait()
+        with METRICS.request(url_live) as call:
+            async with session.post(url_live, data=data) as response:
+                response_text = await response.text()
+                call.status = response.status
+        if archive is not None:
+            archive.record(url_live, data, response_text, response.status)
+        return response_text
     except Exception as e:
         print(f"Error during request for VRM {vrm}: {e}")
         return None
@@ -151,139 +193,415 @@ def convert_date_format(date_str):
     except ValueError:
         return None
 
-async def process_row(session, row, index, pbar):
-    try:
-        # Convert column names to lowercase for case-insensitive matching
-        vrm_column = next((key for key in row.keys() if key.lower() == 'vrm' or 'reg' in key.lower()), None)
-        mileage_column = next((key for key in row.keys() if 'mile' in key.lower()), None)
-
-        if vrm_column is None:
-            raise ValueError("No 'VRM' or 'REG' column found in the CSV.")
-        
-        if mileage_column is None:
-            raise ValueError("No column containing 'mile' found in the CSV.")
-
-
-        # Use the round_mileage function to round the mileage
-        rounded_mileage = round_mileage(row[mileage_column])
-
-        response, status_code, vrm = await post_cap_vrm_request(session, row[vrm_column], rounded_mileage)
-        database, capid, capman, caprange, capmod, capder, clean, retail, registered_date = extract_values(response)
-
-        # Convert the registered_date to the required format
-        formatted_registered_date = convert_date_format(registered_date)
-        if not formatted_registered_date:
-            raise ValueError(f"Invalid date format for VRM {vrm}")
-
-        live_response = await post_cap_request_live_values(session, vrm, capid, formatted_registered_date, rounded_mileage)
-        live_clean, live_retail = extract_live_values(live_response)
-
-        row_to_write = OrderedDict([
-            ('VRM', row[vrm_column]),
-            ('Unused1', ''),  # Unused column
-            ('CAPMan', capman),
-            ('CAPMod', capmod),
-            ('CAPDer', capder),
-            ('RegisteredDate', registered_date),
-            ('CAPID', capid),
-            ('Mileage', row[mileage_column]),
-            ('Unused2', ''),  # Unused column
-            ('Unused3', ''),  # Unused column
-            ('Unused4', ''),  # Unused column
-            ('Unused5', ''),  # Unused column
-            ('Unused6', ''),  # Unused column
-            ('Unused7', ''),  # Unused column
-            ('Unused8', ''),  # Unused column
-            ('Unused9', ''),  # Unused column
-            ('Monthly_Clean', clean),
-            ('Unused10', ''),  # Unused column
-            ('Unused11', ''),  # Unused column
-            ('Monthly_Retail', retail),
-            ('Unused12', ''),  # Unused column
-            ('Unused13', ''),  # Unused column
-            ('Unused14', ''),  # Unused column
-            ('Database', database),  # Unused column
-            ('Unused16', ''),  # Unused column
-            ('Unused17', ''),  # Unused column
-            ('Unused18', ''),  # Unused column
-            ('Unused19', ''),  # Unused column
-            ('Unused20', ''),  # Unused column
-            ('Live_Clean', live_clean),
-            ('Unused21', ''),  # Unused column
-            ('Unused22', ''),  # Unused column
-            ('Live_Retail', live_retail)
-        ])
-
-        if capid == 'Not Found':
-            log_error(vrm, status_code)
-
-        return index, row_to_write
-
-    except Exception as exc:
-        log_error(row[vrm_column], f"Exception: {exc}")
-        pbar.update(1)  # Ensure the progress bar is updated even if an exception occurs
-        return index, None
-    
-   
-async def process_file():
+# Typed columns written to the Parquet output
+OUTPUT_COLUMNS = [
+    ('VRM', 'string'), ('CAPMan', 'string'), ('CAPMod', 'string'), ('CAPDer', 'string'),
+    ('RegisteredDate', 'date'), ('CAPID', 'int'), ('Mileage', 'int'),
+    ('Monthly_Clean', 'int'), ('Monthly_Retail', 'int'), ('Database', 'string'),
+    ('Live_Clean', 'int'), ('Live_Retail', 'int'),
+]
+
+# Padded spreadsheet layout written to the legacy CSV view
+OUTPUT_FIELDNAMES = [
+    'VRM', 'Unused1', 'CAPMan', 'CAPMod', 'CAPDer', 'RegisteredDate',
+    'CAPID', 'Mileage', 'Unused2', 'Unused3', 'Unused4', 'Unused5',
+    'Unused6', 'Unused7', 'Unused8', 'Unused9', 'Monthly_Clean',
+    'Unused10', 'Unused11', 'Monthly_Retail', 'Unused12', 'Unused13',
+    'Unused14', 'Database', 'Unused16', 'Unused17', 'Unused18',
+    'Unused19', 'Unused20', 'Live_Clean', 'Unused21', 'Unused22', 'Live_Retail'
+]
+
+# Compact rows (CAP_output.Row): input rows keep only the columns the lookups use,
+# output rows the real columns plus the mileage bucket valued, for the warehouse
+VRMInput = row_type('VRMInput', ('VRM', 'Mileage', ROUNDED_MILEAGE))
+VRMOutput = row_type('VRMOutput', [name for name, _ in OUTPUT_COLUMNS + AUTOTRADER_COLUMNS] + [ROUNDED_MILEAGE])
+
+# Output columns added to the valuation warehouse (CAP_warehouse): the record fields,
+# then (endpoint, valuation date, clean, retail) for the VRM and the live valuation.
+# Every row of a run is valued on the run's date, so that column is filled in per run.
+VALUATION_DATE_COLUMN = '_valuation_date'
+WAREHOUSE_FIELDS = {'vrm': 'VRM', 'capid': 'CAPID', 'reg_date': 'RegisteredDate', 'mileage_bucket': ROUNDED_MILEAGE}
+WAREHOUSE_VALUATIONS = [
+    ('VRMValuation', VALUATION_DATE_COLUMN, 'Monthly_Clean', 'Monthly_Retail'),
+    ('GetUsedLive_IdRegDateMileage', VALUATION_DATE_COLUMN, 'Live_Clean', 'Live_Retail'),
+]
+
+
+class StageMetrics:
+    # Counters for one pipeline stage so each stage's throughput and latency can be compared
+    def __init__(self, name, concurrency):
+        self.name = name
+        self.concurrency = concurrency
+        self.completed = 0
+        self.failed = 0
+        self.busy_time = 0.0  # Seconds spent handling items, summed over workers
+        self.idle_time = 0.0  # Seconds spent waiting on the input queue, summed over workers
+
+    def record(self, duration, success):
+        self.busy_time += duration
+        if success:
+            self.completed += 1
+        else:
+            self.failed += 1
+
+    def summary(self, elapsed):
+        handled = self.completed + self.failed
+        average = self.busy_time / handled if handled else 0.0
+        utilisation = self.busy_time / (elapsed * self.concurrency) if elapsed > 0 else 0.0
+        rate = self.completed / elapsed if elapsed > 0 else 0.0
+        return (f"{self.name}: {self.completed} ok, {self.failed} failed, "
+                f"{rate:.1f} rows/s, avg {average:.2f}s per row, "
+                f"{utilisation:.0%} of {self.concurrency} workers busy, "
+                f"{self.idle_time:.1f}s worker idle")
+
+
+def find_input_columns(fieldnames):
+    # Convert column names to lowercase for case-insensitive matching
+    vrm_column = next((key for key in fieldnames if key.lower() == 'vrm' or 'reg' in key.lower()), None)
+    mileage_column = next((key for key in fieldnames if 'mile' in key.lower()), None)
+
+    if vrm_column is None:
+        raise ValueError("No 'VRM' or 'REG' column found in the CSV.")
+
+    if mileage_column is None:
+        raise ValueError("No column containing 'mile' found in the CSV.")
+
+    return vrm_column, mileage_column
+
+
+async def vrm_stage(session, input_queue, live_queue, output_queue, vrm_column, mileage_column, metrics):
+    # Stage 1: resolve each VRM to its CAPID, derivative and monthly values
+    while True:
+        wait_started = time.perf_counter()
+        item = await input_queue.get()
+        metrics.idle_time += time.perf_counter() - wait_started
+        if item is None:
+            break
+
+        index, row = item
+        if BUDGET.exhausted:
+            # No new rows once the daily call budget is spent; rows already past this stage finish
+            BUDGET.stop()
+            await output_queue.put((index, None))
+            continue
+        with TRACER.row('VRMValuation', row=index, vrm=row.get(vrm_column)):
+            TRACER.since(('input', index), 'queue wait')
+            started = time.perf_counter()
+            try:
+                # Mileage buckets are computed for the whole input in read_input
+                rounded_mileage = row[ROUNDED_MILEAGE]
+                if rounded_mileage is None:
+                    raise ValueError(f"Invalid mileage '{row[mileage_column]}'")
+
+                response, status_code, vrm = await post_cap_vrm_request(session, row[vrm_column], rounded_mileage)
+                with TRACER.span('parse'):
+                    values = extract_values(response)
+                database, capid, capman, caprange, capmod, capder, clean, retail, registered_date = values
+
+                # Convert the registered_date to the required format
+                formatted_registered_date = convert_date_format(registered_date)
+                if not formatted_registered_date:
+                    raise ValueError(f"Invalid date format for VRM {vrm}")
+
+                if capid == 'Not Found':
+                    log_error(vrm, status_code)
+
+                metrics.record(time.perf_counter() - started, True)
+                TRACER.mark(('live', index))
+                await live_queue.put((index, row, rounded_mileage, formatted_registered_date, values))
+
+            except Exception as exc:
+                metrics.record(time.perf_counter() - started, False)
+                log_error(row.get(vrm_column), f"Exception: {exc}")
+                await output_queue.put((index, None))
+
+
+async def live_stage(session, live_queue, output_queue, vrm_column, mileage_column, metrics):
+    # Stage 2: fetch live values for VRMs that stage 1 resolved
+    while True:
+        wait_started = time.perf_counter()
+        item = await live_queue.get()
+        metrics.idle_time += time.perf_counter() - wait_started
+        if item is None:
+            break
+
+        index, row, rounded_mileage, formatted_registered_date, values = item
+        database, capid, capman, caprange, capmod, capder, clean, retail, registered_date = values
+        vrm = row[vrm_column]
+        with TRACER.row('Live values', row=index, vrm=vrm):
+            TRACER.since(('live', index), 'queue wait')
+            started = time.perf_counter()
+            try:
+                live_response = await post_cap_request_live_values(session, vrm, capid, formatted_registered_date, rounded_mileage)
+                with TRACER.span('parse'):
+                    live_clean, live_retail = extract_live_values(live_response)
+
+                # Only the real columns; the padded legacy layout is produced by the CSV view
+                row_to_write = VRMOutput(
+                    VRM=vrm,
+                    CAPMan=capman,
+                    CAPMod=capmod,
+                    CAPDer=capder,
+                    RegisteredDate=registered_date,
+                    CAPID=capid,
+                    Mileage=row[mileage_column],
+                    Monthly_Clean=clean,
+                    Monthly_Retail=retail,
+                    Database=database,
+                    Live_Clean=live_clean,
+                    Live_Retail=live_retail,
+                    **{ROUNDED_MILEAGE: rounded_mileage},
+                )
+
+                metrics.record(time.perf_counter() - started, True)
+                await output_queue.put((index, row_to_write))
+
+            except Exception as exc:
+                metrics.record(time.perf_counter() - started, False)
+                log_error(vrm, f"Exception: {exc}")
+                await output_queue.put((index, None))
+
+
+async def autotrader_stage(client, autotrader_queue, vrm_column, metrics):
+    # Alongside stages 1 and 2: Autotrader figures for each VRM, merged into its row when
+    # the row is written. A row whose Autotrader call fails keeps its CAP figures.
+    while True:
+        wait_started = time.perf_counter()
+        item = await autotrader_queue.get()
+        metrics.idle_time += time.perf_counter() - wait_started
+        if item is None:
+            break
+
+        index, row, figures = item
+        fields = {}
+        if not BUDGET.exhausted and row[ROUNDED_MILEAGE] is not None:
+            vrm = row[vrm_column]
+            with TRACER.row('Autotrader', row=index, vrm=vrm):
+                started = time.perf_counter()
+                try:
+                    fields = await client.vehicle(vrm, row[ROUNDED_MILEAGE])
+                    metrics.record(time.perf_counter() - started, True)
+                except Exception as exc:
+                    metrics.record(time.perf_counter() - started, False)
+                    log_error(vrm, f"Autotrader: {exc}")
+        figures.set_result(fields)
+
+
+async def write_results(output_queue, emit, pbar, enrichment=None):
+    # Emit rows in input order; rows finishing early wait in a small reorder buffer.
+    # With --autotrader, each row's Autotrader figures are added as it is emitted.
+    pending = {}
+    next_index = 0
+    rows_written = 0
+    while True:
+        item = await output_queue.get()
+        if item is None:
+            break
+        index, row_to_write = item
+        pending[index] = row_to_write
+        pbar.update(1)
+        while next_index in pending:
+            ready = pending.pop(next_index)
+            fields = await enrichment.pop(next_index) if enrichment is not None else {}
+            if ready is not None:
+                for name, value in fields.items():
+                    ready[name] = value
+                with TRACER.span('write', row=next_index):
+                    emit(next_index, ready)
+                rows_written += 1
+            next_index += 1
+    return rows_written
+
+
+async def run_pipeline(rows, vrm_column, mileage_column, emit, show_progress=True):
+    # Push rows through both stages (and the Autotrader stage with --autotrader); emit(position,
+    # row) is called in input order. Returns the rows written, the seconds taken and the
+    # StageMetrics of each stage.
+    # Bounded queues keep each stage at most a couple of batches ahead of the next one
+    input_queue = asyncio.Queue(maxsize=VRM_CONCURRENCY * 2)
+    live_queue = asyncio.Queue(maxsize=LIVE_CONCURRENCY * 2)
+    autotrader_queue = asyncio.Queue(maxsize=AUTOTRADER_CONCURRENCY * 2)
+    output_queue = asyncio.Queue()
+    enrichment = {} if autotrader is not None else None  # Row index -> future of its Autotrader figures
+
+    stages = [StageMetrics('VRMValuation', VRM_CONCURRENCY), StageMetrics('Live values', LIVE_CONCURRENCY)]
+    vrm_metrics, live_metrics = stages
+    if autotrader is not None:
+        stages.append(StageMetrics('Autotrader', AUTOTRADER_CONCURRENCY))
+
+    async with contextlib.AsyncExitStack() as stack:
+        session = await stack.enter_async_context(
+            CONNECTIONS.session(limit_per_host=VRM_CONCURRENCY + LIVE_CONCURRENCY))
+        client = await stack.enter_async_context(autotrader.open()) if autotrader is not None else None
+        started = time.perf_counter()
+        with tqdm(total=len(rows), desc="Processing Rows", disable=not show_progress) as pbar:
+            writer_task = asyncio.create_task(write_results(output_queue, emit, pbar, enrichment))
+            autotrader_workers = [
+                asyncio.create_task(autotrader_stage(client, autotrader_queue, vrm_column, stages[2]))
+                for _ in range(AUTOTRADER_CONCURRENCY if client is not None else 0)
+            ]
+            vrm_workers = [
+                asyncio.create_task(vrm_stage(session, input_queue, live_queue, output_queue, vrm_column, mileage_column, vrm_metrics))
+                for _ in range(VRM_CONCURRENCY)
+            ]
+            live_workers = [
+                asyncio.create_task(live_stage(session, live_queue, output_queue, vrm_column, mileage_column, live_metrics))
+                for _ in range(LIVE_CONCURRENCY)
+            ]
+
+            for index, row in enumerate(rows):
+                TRACER.mark(('input', index))
+                if client is not None:
+                    enrichment[index] = asyncio.get_running_loop().create_future()
+                    await autotrader_queue.put((index, row, enrichment[index]))
+                await input_queue.put((index, row))
+
+            # Shut the stages down in order so every row drains through both of them
+            for _ in autotrader_workers:
+                await autotrader_queue.put(None)
+            for _ in vrm_workers:
+                await input_queue.put(None)
+            await asyncio.gather(*vrm_workers, *autotrader_workers)
+            for _ in live_workers:
+                await live_queue.put(None)
+            await asyncio.gather(*live_workers)
+            await output_queue.put(None)
+            rows_written = await writer_task
+        elapsed = time.perf_counter() - started
+
+    return rows_written, elapsed, stages
+
+
+def init_shard_worker(limiter, response_archive, run_valuation_date, concurrency, autotrader_client):
+    # Runs once in each worker process so every shard shares the parent's rate limit, archive,
+    # Autotrader client settings and other settings
+    global rate_limiter, archive, valuation_date, VRM_CONCURRENCY, LIVE_CONCURRENCY, autotrader
+    rate_limiter = limiter
+    autotrader = autotrader_client
+    archive = response_archive
+    valuation_date = run_valuation_date
+    VRM_CONCURRENCY = LIVE_CONCURRENCY = concurrency
+
+
+def run_shard(payload):
+    indices, rows, vrm_column, mileage_column = payload
+    results = []
+    rows_written, elapsed, stages = CONNECTIONS.run(run_pipeline(
+        rows, vrm_column, mileage_column,
+        lambda position, row_to_write: results.append((indices[position], row_to_write)),
+        show_progress=False))
+    if archive is not None:
+        archive.close()
+    print(f"Shard of {len(rows)} rows finished in {elapsed:.1f}s. "
+          + '. '.join(stage.summary(elapsed) for stage in stages))
+    return results
+
+
+def read_input():
+    # Returns VRMInput rows and the names of their VRM and mileage columns
+    with open(input_file_path, mode='r', newline='', encoding='utf-8-sig') as infile:
+        reader = csv.DictReader(infile)
+        vrm_column, mileage_column = find_input_columns(reader.fieldnames or [])
+        pairs = [(row[vrm_column], row[mileage_column]) for row in reader]
+
+    # Round every mileage to the nearest 1000 in one pass before any request is scheduled
+    buckets = mileage_buckets([mileage for _, mileage in pairs], offset=500, method='round')
+    rows = [VRMInput(vrm, mileage, None if pd.isna(bucket) else int(bucket))
+            for (vrm, mileage), bucket in zip(pairs, buckets)]
+    return rows, 'VRM', 'Mileage'
+
+
+def process_file(workers=1, shard_by='range', warehouse=None):
     if not os.path.exists(logs_directory):
         os.makedirs(logs_directory)
 
-    # Open the input file
-    infile = open(input_file_path, mode='r', newline='', encoding='utf-8-sig')
-    reader = csv.DictReader(infile)
-
-    total_rows = sum(1 for row in reader)
-    infile.seek(0)  # Reset the file pointer to the beginning
-
-    conn = aiohttp.TCPConnector(limit_per_host=40)  # Adjust the limit as needed
-
-    async with aiohttp.ClientSession(connector=conn) as session:
-        with open(output_file_path, mode='w', newline='', encoding='utf-8') as outfile:
-            writer = csv.DictWriter(outfile, fieldnames=[
-                'VRM', 'Unused1', 'CAPMan', 'CAPMod', 'CAPDer', 'RegisteredDate', 
-                'CAPID', 'Mileage', 'Unused2', 'Unused3', 'Unused4', 'Unused5', 
-                'Unused6', 'Unused7', 'Unused8', 'Unused9', 'Monthly_Clean', 
-                'Unused10', 'Unused11', 'Monthly_Retail', 'Unused12', 'Unused13', 
-                'Unused14', 'Database', 'Unused16', 'Unused17', 'Unused18', 
-                'Unused19', 'Unused20', 'Live_Clean', 'Unused21', 'Unused22', 'Live_Retail'
-            ])
-            writer.writeheader()
-
-            rows_written = 0  # Initialize the counter for the number of rows written
-            with tqdm(total=total_rows, desc="Processing Rows") as pbar:
-                batch_size = 50  # Define the batch size
-                tasks = []
-                for index, row in enumerate(reader):
-                    task = asyncio.create_task(process_row(session, row, index, pbar))
-                    tasks.append(task)
-
-                    # When batch size is reached, await completion of these tasks
-                    if len(tasks) >= batch_size:
-                        results = await asyncio.gather(*tasks)
-                        rows_in_batch = 0
-                        for _, row_to_write in results:
-                            if row_to_write is not None:
-                                writer.writerow(row_to_write)
-                                rows_in_batch += 1  # Increment the counter after each row is written
-                        pbar.update(rows_in_batch)  # Update the progress bar by the number of rows processed in this batch
-                        tasks.clear()  # Reset the task list for the next batch
-
-                # Process any remaining tasks
-                if tasks:
-                    results = await asyncio.gather(*tasks)
-                    rows_in_batch = 0
-                    for _, row_to_write in results:
-                        if row_to_write is not None:
-                            writer.writerow(row_to_write)
-                            rows_in_batch += 1  # Increment the counter after each row is written
-                    pbar.update(rows_in_batch)  # Update the progress bar by the number of rows processed in this batch
-
-
-    infile.close()
-    print("All rows processed and CSV file is built.")
+    rows, vrm_column, mileage_column = read_input()
+
+    # With --autotrader, both layouts end with the Autotrader columns
+    columns, header = OUTPUT_COLUMNS, OUTPUT_FIELDNAMES
+    if autotrader is not None:
+        columns = OUTPUT_COLUMNS + AUTOTRADER_COLUMNS
+        header = OUTPUT_FIELDNAMES + [name for name, _ in AUTOTRADER_COLUMNS]
+
+    with open_output(output_base_path, columns, header, OUTPUT_FORMATS, warehouse) as output:
+        if workers <= 1:
+            rows_written, elapsed, stages = CONNECTIONS.run(run_pipeline(
+                rows, vrm_column, mileage_column, lambda position, row_to_write: output.write(row_to_write)))
+        else:
+            # Each shard runs the full pipeline in its own process; results come back in input order
+            shards = shard_indices((row.get(vrm_column) for row in rows), workers, shard_by)
+            payloads = [(indices, [rows[i] for i in indices], vrm_column, mileage_column) for indices in shards]
+            with tqdm(total=len(rows), desc=f"Processing Rows ({len(shards)} shards)") as pbar:
+                merged = run_sharded(run_shard, payloads, workers, init_shard_worker,
+                                     (rate_limiter, archive, valuation_date, VRM_CONCURRENCY, autotrader),
+                                     lambda payload: pbar.update(len(payload[0])))
+            with TRACER.span('write', rows=len(rows)):
+                for _, row_to_write in merged:
+                    output.write(row_to_write)
+            rows_written = output.rows_written
+            stages = None
+
+    if archive is not None:
+        archive.close()
+
+    print("All rows processed and output files are built:")
+    for path in output.paths:
+        print(f"  {path}")
     print(f"Total rows written to the output file: {rows_written}")
+    if stages is not None:
+        for stage in stages:
+            print(stage.summary(elapsed))
+
+
+def main():
+    global rate_limiter, archive, valuation_date, VRM_CONCURRENCY, LIVE_CONCURRENCY, autotrader
+    parser = argparse.ArgumentParser(description="Look up CAP values for every VRM in VRM_Input.csv")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of worker processes, each with its own event loop (default: 1)")
+    parser.add_argument('--shard-by', choices=SHARD_MODES, default='range',
+                        help="Split the input by row range or by hash of VRM (default: range)")
+    parser.add_argument('--archive', action='store_true',
+                        help="Store every raw CAP response in the compressed response archive")
+    parser.add_argument('--replay', metavar='RUN_ID',
+                        help="Re-derive the output from an archived run instead of calling CAP")
+    parser.add_argument('--autotrader', action='store_true',
+                        help="Add Autotrader valuations and vehicle metrics to each row (needs Autotrader_config)")
+    parser.add_argument('--autotrader-url', default=AUTOTRADER_URL,
+                        help="Autotrader API, e.g. a local stand-in from CAP_autotrader.py (default: %(default)s)")
+    parser.add_argument('--autotrader-rate', type=float, default=AUTOTRADER_RATE,
+                        help="Maximum Autotrader requests per second, 0 for unlimited (default: %(default)s)")
+    add_common_arguments(parser, VRM_CONCURRENCY)
+    args = parser.parse_args()
+    if args.resume:
+        parser.error("--resume is not supported: VRM Lookup runs keep no per-row state (use --replay to rebuild a run)")
+
+    VRM_CONCURRENCY = LIVE_CONCURRENCY = args.concurrency
+    rate_limiter = RateLimiter(args.rate, args.priority)
+    if args.autotrader:
+        if args.replay:
+            parser.error("--autotrader cannot be combined with --replay")
+        try:
+            key, secret, advertiser_id = load_credentials()
+        except ImportError:
+            parser.error("--autotrader needs Autotrader_config.py (KEY, SECRET, ADVERTISER_ID) next to CAP_config.py")
+        autotrader = AutotraderClient(key, secret, advertiser_id, args.autotrader_url, args.autotrader_rate)
+    run_id = f'CAP_VRM_{current_datetime}'
+    if args.replay:
+        valuation_date = run_valuation_date(args.replay)
+        archive = ResponseArchive('vrm', run_id, replay_run=args.replay, valuation_date=valuation_date)
+        print(f"Replaying archived run {args.replay} (valuation date {valuation_date})")
+    elif args.archive:
+        archive = ResponseArchive('vrm', run_id, valuation_date=valuation_date)
+        print(f"Archiving raw responses as run {run_id}")
+    if args.workers <= 1 and not args.replay:
+        # Warmed up while the input is read; sharded runs connect from each worker
+        CONNECTIONS.start(url_monthly, args.warm_connections, limit_per_host=VRM_CONCURRENCY + LIVE_CONCURRENCY)
+    # Replayed runs are not added to the warehouse: their valuations are already there
+    warehouse = None if args.replay else WarehouseSink.open(
+        args.warehouse, 'CAP_VRM', run_id, WAREHOUSE_FIELDS, WAREHOUSE_VALUATIONS,
+        {VALUATION_DATE_COLUMN: valuation_date})
+    run_tool(args, logs_directory, 'CAP_VRM', process_file, args.workers, args.shard_by, warehouse)
 
 
 if __name__ == '__main__':
-    asyncio.run(process_file())
+    main()
@@ -1,10 +1,7 @@
-import asyncio
-import aiohttp
+import argparse
 import pandas as pd
-import csv
 import xml.etree.ElementTree as ET
 from datetime import datetime
-from datetime import datetime, timedelta
 import logging
 import os
 import sys
@@ -14,21 +11,27 @@ import re
 # Get the current script directory
 script_dir = os.path.dirname(os.path.abspath(__file__))
 
-# Get the parent directory (one level up)
-parent_dir = os.path.dirname(script_dir)
-
-# Constructing the paths using the parent directory
-cap_config_path = os.path.join(parent_dir)
 log_dir = os.path.join(script_dir, 'Logs')
 input_dir = script_dir
 output_dir = os.path.join(script_dir, 'Outputs')
 
-# Add the CAP_config.py directory to the Python path
-sys.path.append(cap_config_path)
-
-
-# Now import the variables from CAP_config
+# CAP_config and the shared CAP_* modules are importable through cap or `pip install -e .`
 from CAP_config import SUBSCRIBER_ID, PASSWORD, FIXED_VALUATION_DATE
+from CAP_archive import ResponseArchive, endpoint_name, run_valuation_date
+from CAP_cache import CACHE_FILENAME, CapidMetadataStore, SingleFlight, parse_capid_metadata
+from CAP_calendar import period_key
+from CAP_graph import RequestGraph
+from CAP_inputs import read_csv
+from CAP_interpolate import (INTERPOLATE_TOLERANCE, INTERPOLATED_COLUMN, MileageInterpolator, interpolated_cells,
+                             interpolation_summary)
+from CAP_ledger import RunLedger, StepResult, failure_manifest, latest_run, load_run
+from CAP_metrics import METRICS
+from CAP_connect import CONNECTIONS
+from CAP_options import LATEST, add_common_arguments, run_tool
+from CAP_normalise import format_dates, mileage_buckets, normalise_dates, unparsed_values
+from CAP_output import MemorySink, frame_rows, open_output, row_type, write_rows
+from CAP_shard import SHARD_MODES, RateLimiter, run_sharded, shard_indices
+from CAP_warehouse import WarehouseSink
 
 # Set the log file directory with the date at the end
 log_filename = f'CAPID_Lookup_errors_{datetime.now().strftime("%Y%m%d")}.log'
@@ -46,147 +49,251 @@ DATABASE = 'CAR'
 VALUATION_DATE = datetime.now().strftime('%Y-%m-%d')
 INPUT_CSV_FILENAME = 'CAPID_Lookup_Input.csv'
 OUTPUT_CSV_FILENAME = 'CAPID_Lookup_Output.csv'
+OUTPUT_FORMATS = ('parquet', 'csv')  # Drop 'csv' once nothing reads the padded legacy layout
+CONCURRENCY = 100  # Rows in flight at once; --concurrency overrides
+
+# Endpoint each of a row's steps calls; re-runs resolve the URL from here, not from the ledger
+STEP_URLS = {'metadata': CAPID_VALUATION_URL, 'live': LIVE_VALUATION_URL, 'live_old': LIVE_VALUATION_URL}
 
 
-# Read input CSV
 input_csv_path = os.path.join(input_dir, INPUT_CSV_FILENAME)
-df = pd.read_csv(input_csv_path)
 
-mileage_column = next((col for col in df.columns if re.search(r'mile', col, re.IGNORECASE)), None)
-capid_column = next((col for col in df.columns if re.search(r'capid', col, re.IGNORECASE)), None)
-vrm_column = next((col for col in df.columns if re.search(r'vrm|reg', col, re.IGNORECASE)), None)
+# Shared across worker processes when running with --workers; unlimited unless --rate is given
+rate_limiter = RateLimiter()
 
+# Raw response archive, set by --archive (record) or --replay (serve a recorded run)
+archive = None
 
-if mileage_column is None:
-    print("Mileage column not found in the input file.")
-    sys.exit(1)
+# capid -> derivative metadata, persisted across runs and filled by prefetch_metadata
+metadata_store = CapidMetadataStore(DATABASE)
 
-if capid_column is None:
-    print("CAPID column not found in the input file.")
-    sys.exit(1)
+# One call per distinct CAP request; live valuations are requested per CAP publication period, so
+# VALUATION_DATE and FIXED_VALUATION_DATE share a call when they fall in the same period
+cap_requests = SingleFlight('cap_requests')
 
-if vrm_column is None:
-    print("VRM/Reg column not found in the input file.")
-    sys.exit(1)
+# Every row's call results and failures, set in main; --rerun-failures reads a previous run back
+ledger = None
 
-def convert_excel_date(serial):
-    excel_epoch = datetime(1899, 12, 30)  # Excel's epoch starts on January 1, 1900, but there's an off-by-two error
-    converted_date = excel_epoch + timedelta(days=serial)
-    return converted_date.strftime('%d/%m/%Y')
+# Neighbouring mileage buckets live values are estimated from, with --interpolate (CAP_interpolate)
+interpolator = None
 
-def is_excel_date_format(date_str):
-    try:
-        int(date_str)
-        return True
-    except ValueError:
-        return False
 
-# Function to round up mileage to nearest 1000 miles
-def round_up_to_nearest_thousand(mileage):
-    return int((mileage + 999) / 1000) * 1000
+# Read input CSV (from its sidecar while it is unchanged, CAP_inputs) and rename the matched
+# columns to VRM, CAPID and Mileage
+def load_input(cache_directory):
+    df = read_csv(input_csv_path, cache_directory)
+
+    mileage_column = next((col for col in df.columns if re.search(r'mile', col, re.IGNORECASE)), None)
+    capid_column = next((col for col in df.columns if re.search(r'capid', col, re.IGNORECASE)), None)
+    vrm_column = next((col for col in df.columns if re.search(r'vrm|reg', col, re.IGNORECASE)), None)
+
+    if mileage_column is None:
+        print("Mileage column not found in the input file.")
+        sys.exit(1)
+
+    if capid_column is None:
+        print("CAPID column not found in the input file.")
+        sys.exit(1)
+
+    if vrm_column is None:
+        print("VRM/Reg column not found in the input file.")
+        sys.exit(1)
+
+    df = df.rename(columns={mileage_column: 'Mileage', capid_column: 'CAPID', vrm_column: 'VRM'})
+
+    # Normalise whole columns before scheduling: DFR may hold Excel serials or dd/mm/yyyy dates
+    dfr = normalise_dates(df['DFR'], excel_serials=True)
+    for index, value in unparsed_values(df['DFR'], dfr).items():
+        logging.error(f"Unrecognised DFR '{value}' for {df.at[index, 'VRM']}")
+    df['DFR'] = format_dates(dfr, '%d/%m/%Y')
+    df['RegDate'] = format_dates(dfr)
+    df['RoundedMileage'] = mileage_buckets(df['Mileage'])  # Round up to the nearest 1000 miles
+    return df
 
 # Function to fetch and parse the response from the API
 async def fetch_and_parse_data(session, url, payload):
     try:
-        async with session.post(url, headers=HEADERS, data=payload) as response:
+        if archive is not None and archive.replay_run:
+            replayed = archive.replay(url, payload)
+            if replayed is None:
+                raise LookupError(f"No archived {endpoint_name(url)} response in run {archive.replay_run}")
+            content, status = replayed
+            if status != 200:
+                raise ValueError(f"Archived response has status code {status}")
+        else:
+            await rate_limiter.wait()
+            with METRICS.request(url) as call:
+                async with session.post(url, headers=HEADERS, data=payload) as response:
+                    call.status = response.status
+                    content = await response.text()
+            if archive is not None:
+                archive.record(url, payload, content, response.status)
             response.raise_for_status()  # Raise an exception for non-200 status codes
-            content = await response.text()
-            root = ET.fromstring(content)
-
-            if url == LIVE_VALUATION_URL:
-                namespace = {'ns': 'https://soap.cap.co.uk/usedvalueslive'}
-                valuation = root.find('.//ns:Valuation', namespace)
-                if valuation is not None:
-                    clean = valuation.find('ns:Clean', namespace).text
-                    retail = valuation.find('ns:Retail', namespace).text
-                    return {'clean': clean, 'retail': retail}
-                else:
-                    return {"clean": "n/a", "retail": "n/a"}
-
-            elif url == CAPID_VALUATION_URL:
-                namespace = {'ns': 'https://soap.cap.co.uk/vrm'}
-                capid_lookup = root.find('.//ns:CAPIDLookup', namespace)
-                if capid_lookup is not None:
-                    cap_man = capid_lookup.find('ns:CAPMan', namespace).text
-                    cap_mod = capid_lookup.find('ns:CAPMod', namespace).text
-                    cap_der = capid_lookup.find('ns:CAPDer', namespace).text
-                    return {'CAPMan': cap_man, 'CAPMod': cap_mod, 'CAPDer': cap_der}
-                else:
-                    return {"CAPMan": "n/a", "CAPMod": "n/a", "CAPDer": "n/a"}
+        root = ET.fromstring(content)
+
+        if url == LIVE_VALUATION_URL:
+            namespace = {'ns': 'https://soap.cap.co.uk/usedvalueslive'}
+            valuation = root.find('.//ns:Valuation', namespace)
+            if valuation is not None:
+                clean = valuation.find('ns:Clean', namespace).text
+                retail = valuation.find('ns:Retail', namespace).text
+                return {'clean': clean, 'retail': retail}
+            else:
+                return {"clean": "n/a", "retail": "n/a"}
+
+        elif url == CAPID_VALUATION_URL:
+            # Full derivative metadata for the capid; empty when CAP has no lookup for it
+            return parse_capid_metadata(content) or {}
     except Exception as e:
         logging.error(f"An error occurred: {str(e)}")
-        return {"error": "error"}
-
+        return {"error": str(e) or type(e).__name__}
 
-async def process_row(session, row, total_valid_rows):
-    # Check if any of the required columns have missing or NaN values
-    if row.isna().any():
-        return None  # Skip processing for this row
-    
-        # Check if the date is in the 5-digit Excel format and convert if necessary
-    if is_excel_date_format(row['DFR']):
-        row['DFR'] = convert_excel_date(int(row['DFR']))
 
-    reg_date = datetime.strptime(row['DFR'], '%d/%m/%Y').strftime('%Y-%m-%d')
-    rounded_mileage = round_up_to_nearest_thousand(row[mileage_column])
-    capid_value = row[capid_column]
-    vrm_value = row[vrm_column]
+def with_credentials(url, request):
+    # Requests are built and recorded without credentials; add the ones each endpoint expects
+    if url == CAPID_VALUATION_URL:
+        return {'SubscriberID': SUBSCRIBER_ID, 'Password': PASSWORD, **request}
+    return {'subscriberId': SUBSCRIBER_ID, 'password': PASSWORD, **request}
 
 
-    live_payload = {
-        'subscriberId': SUBSCRIBER_ID,
-        'password': PASSWORD,
+def live_request(capid, valuation_date, reg_date, rounded_mileage):
+    return {
         'database': DATABASE,
-        'capid': int(capid_value),  # Use capid_value instead of row['CAPID']
-        'valuationDate': VALUATION_DATE,
+        'capid': int(capid),
+        'valuationDate': valuation_date,
         'regDate': reg_date,
         'mileage': rounded_mileage
     }
 
-    # Fetch current valuation from LIVE_VALUATION_URL
-    live_data = await fetch_and_parse_data(session, LIVE_VALUATION_URL, live_payload)
-    if "error" in live_data:
-        return None  # Skip this row due to error
-
-    # Extracting the clean and retail values for the current valuation
-    clean_live = live_data.get('clean', 'n/a')
-    retail_live = live_data.get('retail', 'n/a')
 
-    # Fetch old valuation from LIVE_VALUATION_URL
-    live_payload['valuationDate'] = FIXED_VALUATION_DATE
-    live_old_data = await fetch_and_parse_data(session, LIVE_VALUATION_URL, live_payload)
-    if "error" in live_old_data:
-        return None  # Skip this row due to error
-
-    # Extracting the clean and retail values for the old valuation
-    clean_month = live_old_data.get('clean', 'n/a')
-    retail_month = live_old_data.get('retail', 'n/a')
-    
-    # Construct payload for CAPID_VALUATION_URL
-    capid_payload = {
-        'SubscriberID': SUBSCRIBER_ID,
-        'Password': PASSWORD,
+def capid_request(capid, reg_date, rounded_mileage):
+    return {
         'Database': DATABASE,
-        'CAPID': int(row[capid_column]),  # Use the extracted CAPID column value
+        'CAPID': int(capid),
         'RegisteredDate': reg_date,
         'Mileage': rounded_mileage,
         'StandardEquipmentRequired': False  # Set to True if you need standard equipment data
     }
 
-    # Fetch data from CAPID_VALUATION_URL
-    capid_data = await fetch_and_parse_data(session, CAPID_VALUATION_URL, capid_payload)
-    if "error" in capid_data:
-        return None  # Skip this row due to error
 
-    return [vrm_value, None, capid_data['CAPMan'], capid_data['CAPMod'], capid_data['CAPDer'], row['DFR'],
-            capid_value, rounded_mileage, None, None, None, None, None, None, None, None,
-            clean_month, None, None, retail_month, None, None, None, None, None, None,
-            None, None, None, clean_live, None, None, retail_live, VALUATION_DATE, FIXED_VALUATION_DATE]
+def request_key(url, request):
+    # Key of a call in cap_requests: live requests in the same CAP publication period share
+    # a call, whatever their valuation date
+    if 'valuationDate' in request:
+        request = {**request, 'valuationDate': period_key(request['valuationDate'])}
+    return url, tuple(sorted(request.items()))
 
 
+async def fetch_step(session, url, request):
+    # One call of a row; raises when it failed so the failure is recorded against the step
+    data = await fetch_and_parse_data(session, url, with_credentials(url, request))
+    if "error" in data:
+        raise LookupError(f"{endpoint_name(url)} failed: {data['error']}")
+    return data
 
 
-# Prepare for output CSV with updated headers
+async def process_row(session, row_key, row):
+    # Check if any of the required columns have missing or NaN values
+    if any(pd.isna(value) for value in row.values()):
+        return None  # Skip processing for this row
+
+    # DFR, RegDate and RoundedMileage were normalised for the whole input in load_input
+    reg_date = row['RegDate']
+    rounded_mileage = int(row['RoundedMileage'])
+    capid_value = row['CAPID']
+
+    # Output fields that don't come from CAP
+    base = {
+        'VRM': row['VRM'], 'DFR': row['DFR'], 'CAPID': capid_value, 'Mileage': rounded_mileage,
+        'Live_Date': VALUATION_DATE, 'Month_Date': FIXED_VALUATION_DATE,
+    }
+
+    # The three calls a row needs; the old valuation is taken at FIXED_VALUATION_DATE
+    steps = {
+        'metadata': StepResult(STEP_URLS['metadata'], capid_request(capid_value, reg_date, rounded_mileage)),
+        'live': StepResult(STEP_URLS['live'], live_request(capid_value, VALUATION_DATE, reg_date, rounded_mileage)),
+        'live_old': StepResult(STEP_URLS['live_old'],
+                               live_request(capid_value, FIXED_VALUATION_DATE, reg_date, rounded_mileage)),
+    }
+
+    # Derivative metadata was resolved once per capid by prefetch_metadata
+    if int(capid_value) in metadata_store.failed:
+        steps['metadata'].error = f"CAPIDValuation failed for CAPID {int(capid_value)}"
+    else:
+        steps['metadata'].result = metadata_store.get(capid_value) or {}
+
+    # With --interpolate, valuations estimated from neighbouring mileage buckets need no call
+    pending = [name for name in ('live', 'live_old') if not interpolate_step(steps[name])]
+    return await complete_row(session, row_key, base, steps, pending)
+
+
+def interpolate_step(step):
+    if interpolator is None:
+        return False
+    request = step.request
+    estimate = interpolator.estimate(request['capid'], request['regDate'], request['valuationDate'], request['mileage'])
+    if estimate is None:
+        return False
+    clean, retail = estimate
+    step.result = {'clean': str(clean), 'retail': str(retail), 'interpolated': True}
+    return True
+
+
+async def complete_row(session, row_key, base, steps, pending):
+    # Issue the pending steps, record every step in the ledger and build the output row.
+    # Returns None when any step failed; its successful steps stay in the ledger.
+    graph = RequestGraph()  # The steps don't depend on each other, so all are in flight at once
+    for name in pending:
+        step = steps[name]
+        url = STEP_URLS[name]
+        graph.add(name, lambda url=url, step=step: cap_requests.do(
+            request_key(url, step.request), lambda: fetch_step(session, url, step.request)))
+    for name, result in (await graph.run()).items():
+        if isinstance(result, Exception):
+            steps[name].error = str(result) or type(result).__name__
+        else:
+            steps[name].result, steps[name].error = result, None
+            if name == 'metadata' and result:
+                metadata_store.put(steps[name].request['CAPID'], result)
+            elif name != 'metadata' and interpolator is not None:
+                # A neighbour for the rows still to come
+                request = steps[name].request
+                interpolator.add(request['capid'], request['regDate'], request['valuationDate'], request['mileage'],
+                                 result['clean'], result['retail'])
+
+    if ledger is not None:
+        ledger.record_row(row_key, base, steps)
+
+    if any(step.failed for step in steps.values()):
+        return None  # Skip this row due to error
+    return assemble_row(base, steps)
+
+
+def assemble_row(base, steps):
+    capid_data = steps['metadata'].result or {"CAPMan": "n/a", "CAPMod": "n/a", "CAPDer": "n/a"}
+    live_data, live_old_data = steps['live'].result, steps['live_old'].result
+
+    # Only the real columns; the padded legacy layout is produced by the CSV view
+    return CAPIDOutput(
+        VRM=base['VRM'], CAPMan=capid_data['CAPMan'], CAPMod=capid_data['CAPMod'],
+        CAPDer=capid_data['CAPDer'], DFR=base['DFR'], CAPID=base['CAPID'], Mileage=base['Mileage'],
+        Clean_Month=live_old_data.get('clean', 'n/a'), Retail_Month=live_old_data.get('retail', 'n/a'),
+        Clean_Live=live_data.get('clean', 'n/a'), Retail_Live=live_data.get('retail', 'n/a'),
+        Live_Date=base['Live_Date'], Month_Date=base['Month_Date'],
+        Interpolated=interpolated_cells((live_data.get('interpolated'), 'Clean_Live', 'Retail_Live'),
+                                        (live_old_data.get('interpolated'), 'Clean_Month', 'Retail_Month')),
+    )
+
+
+# Typed columns written to the Parquet output
+output_columns = [
+    ("VRM", "string"), ("CAPMan", "string"), ("CAPMod", "string"), ("CAPDer", "string"),
+    ("DFR", "date"), ("CAPID", "int"), ("Mileage", "int"), ("Clean_Month", "int"),
+    ("Retail_Month", "int"), ("Clean_Live", "int"), ("Retail_Live", "int"),
+    ("Live_Date", "date"), ("Month_Date", "date"),
+]
+
+# Padded spreadsheet layout written to the legacy CSV view
 output_header = [
     "VRM", "Unused1", "CAPMan", "CAPMod", "CAPDer", "DFR", "CAPID", "Mileage",
     "Unused2", "Unused3", "Unused4", "Unused5", "Unused6", "Unused7", "Unused8",
@@ -196,39 +303,238 @@ output_header = [
     "Month_Date"
 ]
 
+# With --interpolate, both layouts end with a column naming the estimated cells
+interpolated_columns = output_columns + [(INTERPOLATED_COLUMN, "string")]
+interpolated_header = output_header + [INTERPOLATED_COLUMN]
+
+# Compact rows (CAP_output.Row): input rows keep only the columns a lookup uses,
+# output rows only the real columns
+CAPIDInput = row_type('CAPIDInput', ('VRM', 'DFR', 'CAPID', 'RegDate', 'RoundedMileage'))
+CAPIDOutput = row_type('CAPIDOutput', [name for name, _ in interpolated_columns])
+
+# Output columns added to the valuation warehouse (CAP_warehouse): the record fields,
+# then (endpoint, valuation date, clean, retail) for the live and the month valuation
+WAREHOUSE_FIELDS = {'vrm': 'VRM', 'capid': 'CAPID', 'reg_date': 'DFR', 'mileage_bucket': 'Mileage',
+                    'interpolated': INTERPOLATED_COLUMN}
+WAREHOUSE_VALUATIONS = [
+    ('GetUsedLive_IdRegDateMileage', 'Live_Date', 'Clean_Live', 'Retail_Live'),
+    ('GetUsedLive_IdRegDateMileage', 'Month_Date', 'Clean_Month', 'Retail_Month'),
+]
+
 # Check if the output file exists and rename it if it does
-output_csv_path = os.path.join(output_dir, f"{OUTPUT_CSV_FILENAME.split('.')[0]}_{datetime.now().strftime('%Y%m%d%H%M%S')}.csv")
+output_base_path = os.path.join(output_dir, f"{OUTPUT_CSV_FILENAME.split('.')[0]}_{datetime.now().strftime('%Y%m%d%H%M%S')}")
+output_csv_path = f"{output_base_path}.csv"
 
 if os.path.exists(output_csv_path):
     os.rename(output_csv_path, os.path.join(output_dir, f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{OUTPUT_CSV_FILENAME}"))
 
 
-# Async function to process all rows
-async def process_all_rows():
-    async with aiohttp.ClientSession() as session:
-        valid_rows = [row for _, row in df.iterrows() if not row.isna().any()]
-        total_valid_rows = len(valid_rows)
+async def fetch_capid_metadata(session, capid, reg_date, rounded_mileage):
+    return await fetch_step(session, CAPID_VALUATION_URL, capid_request(capid, reg_date, rounded_mileage)) or None
+
+
+def prefetch_metadata(valid_df):
+    # Look up every distinct CAPID missing from the metadata cache once, before any row starts.
+    # CAPIDValuation needs a registration date and mileage; the first row for each capid supplies them.
+    samples = valid_df.drop_duplicates('CAPID')
+    samples = samples.set_index(samples['CAPID'].astype(int))
+
+    async def run():
+        async with CONNECTIONS.session() as session:
+            return await metadata_store.prefetch(
+                samples.index,
+                lambda capid: fetch_capid_metadata(session, capid, samples.at[capid, 'RegDate'],
+                                                   int(samples.at[capid, 'RoundedMileage'])))
+
+    calls = CONNECTIONS.run(run())
+    print(f"{len(samples)} distinct CAPIDs, {calls} metadata lookups needed")
+
+
+# Async function to process all rows, streaming each finished row into output
+async def process_all_rows(indexed_rows, output, total, ordered=True, show_progress=True):
+    async with CONNECTIONS.session() as session:
+        async def process_indexed(item):
+            index, row = item
+            result = await process_row(session, index, row)
+            return (index, result) if result is not None else None
+
+        with tqdm(total=total, unit="row", disable=not show_progress) as pbar:
+            return await write_rows(indexed_rows, process_indexed, output, CONCURRENCY, ordered,
+                                    lambda: pbar.update(1))
+
+
+async def rerun_failed_rows(previous_rows, output, warehouse=None):
+    # Re-issue only the failed steps of a previous run's rows; rows that already succeeded
+    # are rebuilt from the ledger, so the output is the previous run completed. Only the rows
+    # completed now go to the warehouse: the previous run added the others.
+    async with CONNECTIONS.session() as session:
+        async def rerun(item):
+            row_key, base, steps = item
+            failed = [name for name, step in steps.items() if step.failed]
+            METRICS.inc('cap_retries_total', len(failed), tool='CAPID_Lookup', reason='rerun_failed')
+            row = await complete_row(session, row_key, base, steps, failed)
+            if failed and row is not None and warehouse is not None:
+                warehouse.write(row)
+            return row
+
+        with tqdm(total=len(previous_rows), unit="row") as pbar:
+            return await write_rows(previous_rows, rerun, output, CONCURRENCY, True, lambda: pbar.update(1))
+
+
+class IndexedRows:
+    # Drops the input index from (index, row) pairs before they reach the output files
+    def __init__(self, output):
+        self.output = output
+
+    def write(self, item):
+        self.output.write(item[1])
+
+    def flush(self):
+        self.output.flush()
+
+
+def init_shard_worker(limiter, response_archive, valuation_date, metadata, run_ledger, concurrency, neighbours):
+    # Runs once in each worker process so every shard shares the parent's rate limit, archive,
+    # prefetched metadata, ledger, interpolation neighbours and settings
+    global rate_limiter, archive, VALUATION_DATE, metadata_store, ledger, CONCURRENCY, interpolator
+    rate_limiter = limiter
+    interpolator = neighbours
+    CONCURRENCY = concurrency
+    archive = response_archive
+    VALUATION_DATE = valuation_date
+    metadata_store = metadata
+    ledger = run_ledger
+
+
+def run_shard(indexed_rows):
+    results = MemorySink()
+    CONNECTIONS.run(process_all_rows(indexed_rows, results, len(indexed_rows), show_progress=False))
+    if archive is not None:
+        archive.close()
+    ledger.close()
+    metadata_store.close()
+    return results.rows
+
+
+def process_input(args, warehouse):
+    df = load_input(args.cache)
+    valid_df = df[df.notna().all(axis=1)]
+    prefetch_metadata(valid_df)
+    metadata_store.close()
+    columns, header = output_columns, output_header
+    if interpolator is not None:
+        loaded = interpolator.load(valid_df['CAPID'], (VALUATION_DATE, FIXED_VALUATION_DATE), args.warehouse)
+        print(f"{loaded} warehouse valuations loaded as neighbours for --interpolate")
+        columns, header = interpolated_columns, interpolated_header
+
+    # Rows are written as they finish, so partial results are on disk while the run is going
+    with open_output(output_base_path, columns, header, OUTPUT_FORMATS, warehouse) as output:
+        writer = IndexedRows(output)
+        if args.workers <= 1:
+            CONNECTIONS.run(process_all_rows(frame_rows(valid_df, CAPIDInput), writer, len(valid_df),
+                                             ordered=not args.unordered))
+        else:
+            # Each shard runs in its own process; results are merged back into input order
+            valid_rows = list(frame_rows(valid_df, CAPIDInput))
+            shards = shard_indices((row['CAPID'] for _, row in valid_rows), args.workers, args.shard_by)
+            payloads = [[valid_rows[i] for i in shard] for shard in shards]
+            with tqdm(total=len(valid_rows), unit="row", desc=f"{len(shards)} shards") as pbar:
+                for item in run_sharded(run_shard, payloads, args.workers, init_shard_worker,
+                                        (rate_limiter, archive, VALUATION_DATE, metadata_store, ledger, CONCURRENCY,
+                                         interpolator),
+                                        lambda payload: pbar.update(len(payload))):
+                    writer.write(item)
+    return output
 
-        tasks = [process_row(session, row, total_valid_rows) for row in valid_rows]
-        responses = []
-
-        for future in tqdm(asyncio.as_completed(tasks), total=total_valid_rows, unit="row"):
-            result = await future
-            if result is not None:
-                responses.append(result)
-        return responses
 
 # Function to run the async process_all_rows and write to CSV
 def main():
-    results = asyncio.run(process_all_rows())
-
-    with open(output_csv_path, 'w', newline='') as f_output:
-        csv_writer = csv.writer(f_output)
-        csv_writer.writerow(output_header)
-        for result in results:
-            csv_writer.writerow(result)
+    global rate_limiter, archive, VALUATION_DATE, ledger, CONCURRENCY, interpolator
+    parser = argparse.ArgumentParser(description="Value every CAPID in CAPID_Lookup_Input.csv")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of worker processes, each with its own event loop (default: 1)")
+    parser.add_argument('--shard-by', choices=SHARD_MODES, default='range',
+                        help="Split the input by row range or by hash of CAPID (default: range)")
+    parser.add_argument('--unordered', action='store_true',
+                        help="Write rows as soon as they finish instead of in input order")
+    parser.add_argument('--archive', action='store_true',
+                        help="Store every raw CAP response in the compressed response archive")
+    parser.add_argument('--replay', metavar='RUN_ID',
+                        help="Re-derive the output from an archived run instead of calling CAP")
+    parser.add_argument('--rerun-failures', metavar='RUN_ID',
+                        help="Re-issue only the calls that failed in a previous run and write its completed output")
+    parser.add_argument('--interpolate', nargs='?', type=int, const=INTERPOLATE_TOLERANCE, metavar='MILES',
+                        help="Estimate live values from valued mileage buckets within MILES either side "
+                             f"(default: {INTERPOLATE_TOLERANCE}), calling CAP only when there are none")
+    add_common_arguments(parser, CONCURRENCY)
+    args = parser.parse_args()
+
+    # --resume completes a previous run by re-running its failed calls
+    rerun = args.rerun_failures
+    if args.resume:
+        rerun = latest_run('capid') if args.resume == LATEST else args.resume
+        if rerun is None:
+            parser.error("--resume: no previous CAPID Lookup run in the ledger")
+    if rerun and (args.replay or args.workers > 1):
+        parser.error("--rerun-failures/--resume cannot be combined with --replay or --workers")
+    if args.interpolate is not None and (rerun or args.replay):
+        parser.error("--interpolate cannot be combined with --replay, --rerun-failures or --resume")
+
+    CONCURRENCY = args.concurrency
+    rate_limiter = RateLimiter(args.rate, args.priority)
+    metadata_store.path = os.path.join(args.cache, CACHE_FILENAME)
+    if args.interpolate is not None:
+        interpolator = MileageInterpolator(args.interpolate)
+
+    run_id = f"CAPID_Lookup_{datetime.now().strftime('%Y%m%d%H%M%S')}"
+    ledger = RunLedger('capid', run_id, rerun_of=rerun)
+    if args.replay:
+        VALUATION_DATE = run_valuation_date(args.replay)
+        archive = ResponseArchive('capid', run_id, replay_run=args.replay, valuation_date=VALUATION_DATE)
+        print(f"Replaying archived run {args.replay} (valuation date {VALUATION_DATE})")
+    elif args.archive:
+        archive = ResponseArchive('capid', run_id, valuation_date=VALUATION_DATE)
+        print(f"Archiving raw responses as run {run_id}")
+
+    if not args.replay:
+        CONNECTIONS.start(LIVE_VALUATION_URL, args.warm_connections)  # Warmed up while the input is read
+    run_tool(args, log_dir, 'CAPID_Lookup', run_lookup, args, run_id, rerun)
+
+
+def run_lookup(args, run_id, rerun):
+    # Replayed runs are not added to the warehouse: their valuations are already there
+    warehouse = None if args.replay else WarehouseSink.open(
+        args.warehouse, 'CAPID_Lookup', run_id, WAREHOUSE_FIELDS, WAREHOUSE_VALUATIONS)
+    if rerun:
+        previous_rows = load_run(rerun)
+        failed_rows = sum(any(step.failed for step in steps.values()) for _, _, steps in previous_rows)
+        print(f"Re-running the failed calls of {failed_rows} of {len(previous_rows)} rows from {rerun}")
+        # Values the previous run estimated with --interpolate are kept, and marked as before
+        interpolated = any((step.result or {}).get('interpolated')
+                           for _, _, steps in previous_rows for step in steps.values())
+        columns, header = (interpolated_columns, interpolated_header) if interpolated else (output_columns, output_header)
+        with open_output(output_base_path, columns, header, OUTPUT_FORMATS) as output:
+            CONNECTIONS.run(rerun_failed_rows(previous_rows, output, warehouse))
+        if warehouse is not None:
+            warehouse.close()
+    else:
+        output = process_input(args, warehouse)
+
+    if archive is not None:
+        archive.close()
+    ledger.close()
+    metadata_store.close()
+
+    print(f'Total number of rows processed: {output.rows_written}')
+    if interpolator is not None:
+        print(interpolation_summary(METRICS, 2 * output.rows_written))
+    for path in output.paths:
+        print(f'Output written to {path}')
+
+    failed_rows = {row_key for row_key, *_ in failure_manifest(run_id)}
+    if failed_rows:
+        print(f"{len(failed_rows)} rows had failed calls; re-run just those calls with --rerun-failures {run_id}")
 
-    print(f'Total number of rows processed: {len(results)}')
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,129 @@
+# Margin and depreciation analytics over CAP Sales output.
+#
+# Everything is computed on whole columns: the string CAP figures are converted
+# to numbers once, the per-vehicle measures are array arithmetic, and the
+# summaries are single group-bys, so a backfilled history of hundreds of
+# thousands of sales takes milliseconds rather than an afternoon in Excel.
+import argparse
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+
+VALUE_COLUMNS = ('SaleClean', 'SaleRetail', 'PurchaseClean', 'PurchaseRetail')
+TEXT_COLUMNS = {column: str for column in ('VRM', 'CAP ID', 'Reg Date', 'CAPMan', 'CAPRange', 'CAPMod', 'CAPDer', 'CAP Code')}
+MISSING_VALUES = ['n/a', 'Not Found']
+CAP_DATE_FORMAT = '%d/%m/%Y'  # Valuation dates as Sales writes them from the CAP response
+INPUT_DATE_FORMAT = '%Y-%m-%d'  # SaleDate and PurchaseDate as Sales copies them from its input
+
+DAYS_PER_MONTH = 365.25 / 12
+
+# Summary levels, from broadest to narrowest: (sheet name, group-by columns)
+SUMMARY_LEVELS = (
+    ('Manufacturer', ['CAPMan']),
+    ('Range', ['CAPMan', 'CAPRange']),
+    ('Model', ['CAPMan', 'CAPRange', 'CAPMod']),
+)
+
+
+def add_measures(df):
+    # Adds numeric copies of the CAP figures plus, for clean and retail:
+    #   <kind>Change           sale value - purchase value
+    #   <kind>DepPerMonth      value lost per month held
+    #   <kind>DepPer1000Miles  value lost per 1,000 recorded miles
+    # Blank, 'n/a' and failed valuations become nulls and drop out of the summaries.
+    # Months held run from the input's purchase date to its sale date; output written
+    # before Sales kept those falls back to CAP's valuation dates.
+    df = df.copy()
+    for column in VALUE_COLUMNS:
+        df[column] = pd.to_numeric(df[column], errors='coerce')
+    sale_dates = held_dates(df, 'SaleDate', 'SaleValuationDate')
+    purchase_dates = held_dates(df, 'PurchaseDate', 'PurchaseValuationDate')
+    months_held = ((sale_dates - purchase_dates).dt.days / DAYS_PER_MONTH).to_numpy(dtype=float)
+    thousands_of_miles = pd.to_numeric(df['mileage'], errors='coerce').to_numpy(dtype=float) / 1000
+
+    df['MonthsHeld'] = months_held
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for kind in ('Clean', 'Retail'):
+            change = df[f'Sale{kind}'].to_numpy() - df[f'Purchase{kind}'].to_numpy()
+            df[f'{kind}Change'] = change
+            df[f'{kind}DepPerMonth'] = np.where(months_held > 0, -change / months_held, np.nan)
+            df[f'{kind}DepPer1000Miles'] = np.where(thousands_of_miles > 0, -change / thousands_of_miles, np.nan)
+    return df
+
+
+def held_dates(df, input_column, valuation_column):
+    valuation_dates = pd.to_datetime(df[valuation_column], format=CAP_DATE_FORMAT, errors='coerce')
+    if input_column not in df:
+        return valuation_dates
+    return pd.to_datetime(df[input_column], format=INPUT_DATE_FORMAT, errors='coerce').fillna(valuation_dates)
+
+
+def summarise(measures, by):
+    # One row per group: vehicle count plus mean/median value change and mean depreciation rates
+    grouped = measures.groupby(by, dropna=False, sort=True)
+    summary = grouped.agg(
+        Vehicles=('CleanChange', 'size'),
+        Valued=('CleanChange', 'count'),
+        MeanMonthsHeld=('MonthsHeld', 'mean'),
+        MeanCleanChange=('CleanChange', 'mean'),
+        MedianCleanChange=('CleanChange', 'median'),
+        MeanRetailChange=('RetailChange', 'mean'),
+        MedianRetailChange=('RetailChange', 'median'),
+        CleanDepPerMonth=('CleanDepPerMonth', 'mean'),
+        RetailDepPerMonth=('RetailDepPerMonth', 'mean'),
+        CleanDepPer1000Miles=('CleanDepPer1000Miles', 'mean'),
+        RetailDepPer1000Miles=('RetailDepPer1000Miles', 'mean'),
+    )
+    return summary.round(2).reset_index()
+
+
+def load_sales_output(paths):
+    # One frame from any number of Sales output files (e.g. every month of a backfill)
+    # The CSV parser reads the CAP figures straight into numbers; 'n/a' and blanks become NaN
+    frames = [pd.read_csv(path, dtype=TEXT_COLUMNS, na_values=MISSING_VALUES, keep_default_na=True)
+              for path in paths]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+def write_summary(measures, base_path):
+    # Writes <base>.xlsx with one sheet per summary level, and the per-vehicle measures plus
+    # the narrowest summary as Parquet when pyarrow is available. Returns the paths written.
+    summaries = {name: summarise(measures, by) for name, by in SUMMARY_LEVELS}
+    paths = [f'{base_path}.xlsx']
+    with pd.ExcelWriter(paths[0]) as workbook:
+        for name, summary in summaries.items():
+            summary.to_excel(workbook, sheet_name=name, index=False)
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return paths
+    measures.to_parquet(f'{base_path}_vehicles.parquet', index=False)
+    summaries[SUMMARY_LEVELS[-1][0]].to_parquet(f'{base_path}_models.parquet', index=False)
+    return paths + [f'{base_path}_vehicles.parquet', f'{base_path}_models.parquet']
+
+
+def analyse(paths, base_path):
+    if not paths:
+        return []
+    measures = add_measures(load_sales_output(paths))
+    return write_summary(measures, base_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Summarise value change and depreciation in CAP Sales output")
+    parser.add_argument('paths', nargs='+', help="Sales output CSVs or directories of them (e.g. a backfill)")
+    parser.add_argument('--output', help="Base path for the summary files (default: next to the first input)")
+    args = parser.parse_args()
+    paths = []
+    for path in args.paths:
+        paths += sorted(glob.glob(os.path.join(path, '*.csv'))) if os.path.isdir(path) else [path]
+    if args.output:
+        base_path = args.output
+    elif os.path.isdir(args.paths[0]):
+        base_path = os.path.join(args.paths[0], 'CAP_Sales_Summary')
+    else:
+        base_path = f'{os.path.splitext(args.paths[0])[0]}_Summary'
+    for path in analyse(paths, base_path):
+        print(f'Summary written to {path}')
@@ -0,0 +1,168 @@
+# Compressed archive of raw CAP responses, for replaying a run and re-parsing
+# its responses without spending API calls again.
+#
+# Layout under the archive directory:
+#   blobs/ab/abcdef....gz  one gzip file per distinct response body, named by its SHA-256
+#   index.sqlite           run and request index: which request got which body in which run
+#
+# Requests are identified by a fingerprint of the endpoint and payload with the
+# credentials left out, so a replay can find the response a run received.
+# Shard processes record into one index at the same time, so each response is
+# committed on its own rather than holding SQLite's write lock across many.
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+from datetime import datetime
+
+ARCHIVE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Archive')
+
+# Payload fields that never go into a fingerprint or the index
+CREDENTIAL_FIELDS = {'subscriberid', 'password'}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    tool TEXT,
+    started TEXT,
+    valuation_date TEXT
+);
+CREATE TABLE IF NOT EXISTS responses (
+    run_id TEXT,
+    fingerprint TEXT,
+    endpoint TEXT,
+    request TEXT,
+    status INTEGER,
+    blob TEXT,
+    archived TEXT,
+    PRIMARY KEY (run_id, fingerprint)
+);
+CREATE INDEX IF NOT EXISTS responses_by_blob ON responses (blob);
+"""
+
+
+def request_fingerprint(url, payload):
+    request = {key: str(value) for key, value in payload.items() if key.lower() not in CREDENTIAL_FIELDS}
+    text = json.dumps({'url': url.strip(), 'request': request}, sort_keys=True)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest(), request
+
+
+def endpoint_name(url):
+    return url.strip().rstrip('/').rsplit('/', 1)[-1]
+
+
+class ResponseArchive:
+    # One run's view of the archive. In record mode every response is stored; in
+    # replay mode responses are served from replay_run instead of calling CAP.
+    # The sqlite connection is opened lazily so the object can be handed to
+    # worker processes.
+    def __init__(self, tool, run_id, directory=ARCHIVE_DIRECTORY, replay_run=None, valuation_date=None):
+        self.tool = tool
+        self.run_id = run_id
+        self.directory = directory
+        self.replay_run = replay_run
+        self.valuation_date = valuation_date
+        self.connection = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['connection'] = None
+        return state
+
+    def _connect(self):
+        if self.connection is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self.connection = sqlite3.connect(os.path.join(self.directory, 'index.sqlite'), timeout=30)
+            self.connection.execute("PRAGMA journal_mode=WAL")  # Shards read while another writes
+            self.connection.execute("PRAGMA synchronous=NORMAL")  # A commit per response need not wait on the disk
+            self.connection.executescript(SCHEMA)
+            if self.replay_run is None:
+                self.connection.execute(
+                    "INSERT OR IGNORE INTO runs (run_id, tool, started, valuation_date) VALUES (?, ?, ?, ?)",
+                    (self.run_id, self.tool, datetime.now().isoformat(timespec='seconds'), self.valuation_date))
+                self.connection.commit()
+        return self.connection
+
+    def _blob_path(self, digest):
+        return os.path.join(self.directory, 'blobs', digest[:2], f'{digest}.gz')
+
+    def record(self, url, payload, text, status=200):
+        if self.replay_run is not None or text is None:
+            return
+        fingerprint, request = request_fingerprint(url, payload)
+        data = text.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        blob_path = self._blob_path(digest)
+        if not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            # Write to a temporary name first so a crash never leaves a truncated blob behind
+            temporary_path = f'{blob_path}.{os.getpid()}.tmp'
+            with gzip.open(temporary_path, 'wb') as blob:
+                blob.write(data)
+            os.replace(temporary_path, blob_path)
+
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self.run_id, fingerprint, endpoint_name(url), json.dumps(request, sort_keys=True),
+                 status, digest, datetime.now().isoformat(timespec='seconds')))
+
+    def replay(self, url, payload):
+        # Returns (text, status) archived for this request in replay_run, or None
+        fingerprint, _ = request_fingerprint(url, payload)
+        found = self._connect().execute(
+            "SELECT blob, status FROM responses WHERE run_id = ? AND fingerprint = ?",
+            (self.replay_run, fingerprint)).fetchone()
+        if found is None:
+            return None
+        blob, status = found
+        with gzip.open(self._blob_path(blob), 'rb') as data:
+            return data.read().decode('utf-8'), status
+
+    def flush(self):
+        if self.connection is not None:
+            self.connection.commit()
+
+    def close(self):
+        self.flush()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def run_valuation_date(run_id, directory=ARCHIVE_DIRECTORY):
+    # Valuation date a recorded run used, so a replay can rebuild identical requests
+    connection = sqlite3.connect(os.path.join(directory, 'index.sqlite'))
+    try:
+        connection.executescript(SCHEMA)
+        found = connection.execute("SELECT valuation_date FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+    finally:
+        connection.close()
+    if found is None:
+        raise ValueError(f"Run '{run_id}' is not in the archive at {directory}")
+    return found[0]
+
+
+def list_runs(directory=ARCHIVE_DIRECTORY):
+    if not os.path.exists(os.path.join(directory, 'index.sqlite')):
+        return []
+    connection = sqlite3.connect(os.path.join(directory, 'index.sqlite'))
+    try:
+        connection.executescript(SCHEMA)
+        return connection.execute("""
+            SELECT runs.run_id, runs.tool, runs.started, COUNT(responses.fingerprint)
+            FROM runs LEFT JOIN responses ON responses.run_id = runs.run_id
+            GROUP BY runs.run_id ORDER BY runs.started
+        """).fetchall()
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="List the runs held in the CAP response archive")
+    parser.add_argument('--directory', default=ARCHIVE_DIRECTORY)
+    args = parser.parse_args()
+    for run_id, tool, started, responses in list_runs(args.directory):
+        print(f"{run_id}  {tool}  started {started}  {responses} responses")
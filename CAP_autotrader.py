@@ -0,0 +1,220 @@
+# Autotrader valuations and vehicle metrics alongside CAP (--autotrader).
+#
+# CAP_VRM_Lookup v1.4 started on this with a global access_token that every task
+# checked and renewed for itself, so when it expired a burst of tasks would all
+# authenticate at once. AutotraderClient instead keeps one token per run and
+# renews it single-flight: the first task to find it expired (or to get a 401
+# with it) authenticates while the rest wait for the new token. The client has
+# its own connection pool and rate limit, separate from CAP's, and its calls are
+# not metered against the CAP budget.
+#
+# One call per VRM, GET /vehicles with valuations and vehicle metrics, fills the
+# AUTOTRADER_COLUMNS of the output row. Credentials come from Autotrader_config
+# (KEY, SECRET, ADVERTISER_ID), kept next to CAP_config and not committed.
+#
+# A stand-in for the API, for trying the tools without Autotrader credentials:
+#
+#   python CAP_autotrader.py [--port 8766] [--token-seconds 900]
+#   ... --autotrader --autotrader-url http://localhost:8766
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import aiohttp
+
+from CAP_metrics import METRICS
+from CAP_shard import RateLimiter
+from CAP_trace import TRACER
+
+AUTOTRADER_URL = 'https://api.autotrader.co.uk'
+AUTOTRADER_RATE = 10.0  # Default --autotrader-rate, requests per second
+AUTOTRADER_CONCURRENCY = 10  # Connections (and so requests in flight) to Autotrader
+TOKEN_MINUTES = 15  # Token lifetime when the authenticate response doesn't say
+TOKEN_MARGIN_SECONDS = 60  # Tokens are renewed this long before they expire
+STAND_IN_PORT = 8766
+
+# Output columns filled from Autotrader: (name, type as for CAP_output.ParquetSink, path in the response)
+AUTOTRADER_FIELDS = [
+    ('AT_Retail', 'int', ('valuations', 'marketAverage', 'retail', 'amountGBP')),
+    ('AT_PartExchange', 'int', ('valuations', 'marketAverage', 'partExchange', 'amountGBP')),
+    ('AT_Trade', 'int', ('valuations', 'marketAverage', 'trade', 'amountGBP')),
+    ('AT_Private', 'int', ('valuations', 'marketAverage', 'private', 'amountGBP')),
+    ('AT_RetailRating', 'string', ('vehicleMetrics', 'retail', 'rating', 'value')),
+    ('AT_DaysToSell', 'int', ('vehicleMetrics', 'retail', 'daysToSell', 'value')),
+]
+AUTOTRADER_COLUMNS = [(name, kind) for name, kind, _ in AUTOTRADER_FIELDS]
+
+
+def load_credentials():
+    # (key, secret, advertiser id) from Autotrader_config; raises ImportError without it
+    from Autotrader_config import ADVERTISER_ID, KEY, SECRET
+    return KEY, SECRET, ADVERTISER_ID
+
+
+def extract_fields(data):
+    # Output column -> value from a /vehicles response; missing values stay None
+    fields = {}
+    for name, _, path in AUTOTRADER_FIELDS:
+        value = data
+        for key in path:
+            value = value.get(key) if isinstance(value, dict) else None
+        fields[name] = value
+    return fields
+
+
+def token_expiry(auth_data):
+    # Monotonic time the token should be renewed at
+    lifetime = TOKEN_MINUTES * 60
+    expires_at = auth_data.get('expires_at') or auth_data.get('expires')
+    if expires_at:
+        try:
+            lifetime = (datetime.fromisoformat(str(expires_at).replace('Z', '+00:00'))
+                        - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            pass
+    return time.monotonic() + lifetime - min(TOKEN_MARGIN_SECONDS, lifetime / 10)
+
+
+class AutotraderClient:
+    # One per run; shard workers get a copy without the session or token and open their own.
+    # async with client.open(): ... around the calls.
+    def __init__(self, key, secret, advertiser_id, url=AUTOTRADER_URL, rate=AUTOTRADER_RATE,
+                 concurrency=AUTOTRADER_CONCURRENCY):
+        self.key = key
+        self.secret = secret
+        self.advertiser_id = advertiser_id
+        self.url = url.rstrip('/')
+        self.rate_limiter = RateLimiter(rate)
+        self.concurrency = concurrency
+        self.session = None
+        self.token_lock = None
+        self.access_token = None
+        self.expires = 0.0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(session=None, token_lock=None, access_token=None, expires=0.0)
+        return state
+
+    @contextlib.asynccontextmanager
+    async def open(self):
+        # The client's own connection pool, and a token lock for this event loop
+        self.token_lock = asyncio.Lock()
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency)) as session:
+            self.session = session
+            try:
+                yield self
+            finally:
+                self.session = None
+
+    def token_valid(self):
+        return self.access_token is not None and time.monotonic() < self.expires
+
+    async def token(self):
+        # The current token, authenticating first when there is none or it has expired
+        if self.token_valid():
+            return self.access_token
+        async with self.token_lock:
+            if not self.token_valid():  # Not already renewed by the task that held the lock
+                await self.authenticate()
+            return self.access_token
+
+    async def renew(self, rejected):
+        # After a 401: renew the token unless another task already replaced the rejected one
+        async with self.token_lock:
+            if self.access_token == rejected:
+                await self.authenticate()
+
+    async def authenticate(self):
+        with TRACER.span('autotrader authenticate'):
+            await self.rate_limiter.wait()
+            async with self.session.post(f'{self.url}/authenticate',
+                                         data={'key': self.key, 'secret': self.secret}) as response:
+                if response.status != 200:
+                    raise LookupError(f"Autotrader authentication failed with status code {response.status}")
+                auth_data = await response.json()
+        self.access_token = auth_data.get('access_token')
+        self.expires = token_expiry(auth_data)
+        METRICS.inc('autotrader_authentications_total')
+
+    async def vehicle(self, vrm, mileage):
+        # AUTOTRADER_COLUMNS values for a VRM at a mileage; raises when the call fails
+        params = {'registration': str(vrm).replace(' ', '').upper(), 'advertiserId': self.advertiser_id,
+                  'odometerReadingMiles': int(mileage), 'valuations': 'true', 'vehicleMetrics': 'true'}
+        for attempt in range(2):
+            await self.rate_limiter.wait()  # Before taking the token, so it can't expire while this waits
+            token = await self.token()
+            async with self.session.get(f'{self.url}/vehicles', params=params,
+                                        headers={'Authorization': f'Bearer {token}'}) as response:
+                status = response.status
+                data = await response.json() if status == 200 else None
+            METRICS.inc('autotrader_requests_total', status=str(status))
+            if status == 401 and attempt == 0:
+                await self.renew(token)
+                continue
+            if status != 200:
+                raise LookupError(f"Autotrader /vehicles returned status code {status}")
+            return extract_fields(data)
+
+
+def stand_in_app(token_seconds=TOKEN_MINUTES * 60):
+    # A local Autotrader: any key authenticates, tokens last token_seconds, and figures
+    # are made up from the registration and mileage. /stats counts the calls.
+    from aiohttp import web
+
+    tokens = {}
+    stats = {'authentications': 0, 'vehicles': 0, 'unauthorised': 0}
+
+    async def authenticate(request):
+        form = await request.post()
+        if not form.get('key') or not form.get('secret'):
+            return web.json_response({'message': 'key and secret are required'}, status=401)
+        stats['authentications'] += 1
+        token = uuid.uuid4().hex
+        tokens[token] = time.monotonic() + token_seconds
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=token_seconds)
+        return web.json_response({'access_token': token, 'expires_at': expires_at.isoformat()})
+
+    async def vehicles(request):
+        token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+        if tokens.get(token, 0) < time.monotonic():
+            stats['unauthorised'] += 1
+            return web.json_response({'message': 'Unauthorised'}, status=401)
+        stats['vehicles'] += 1
+        registration = request.query.get('registration', '')
+        mileage = int(request.query.get('odometerReadingMiles', 0))
+        seed = int(hashlib.sha1(registration.encode()).hexdigest()[:6], 16)
+        retail = max(1500, 8000 + seed % 15000 - mileage // 8)
+        return web.json_response({
+            'vehicle': {'registration': registration, 'odometerReadingMiles': mileage},
+            'valuations': {'marketAverage': {
+                'retail': {'amountGBP': retail}, 'partExchange': {'amountGBP': retail - 1800},
+                'trade': {'amountGBP': retail - 1500}, 'private': {'amountGBP': retail - 700},
+            }},
+            'vehicleMetrics': {'retail': {'rating': {'value': round(40 + seed % 600 / 10, 1)},
+                                          'daysToSell': {'value': 10 + seed % 50}}},
+        })
+
+    async def show_stats(request):
+        return web.json_response(stats)
+
+    app = web.Application()
+    app.router.add_post('/authenticate', authenticate)
+    app.router.add_get('/vehicles', vehicles)
+    app.router.add_get('/stats', show_stats)
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the Autotrader API")
+    parser.add_argument('--port', type=int, default=STAND_IN_PORT, help="Port (default: %(default)s)")
+    parser.add_argument('--token-seconds', type=int, default=TOKEN_MINUTES * 60,
+                        help="Lifetime of the tokens it hands out (default: %(default)s)")
+    args = parser.parse_args()
+    from aiohttp import web
+    print(f"Autotrader stand-in on http://localhost:{args.port}")
+    web.run_app(stand_in_app(args.token_seconds), host='localhost', port=args.port, print=None)
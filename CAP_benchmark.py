@@ -0,0 +1,115 @@
+# Memory benchmark for the rows the CAP tools hold in flight and buffered.
+#
+# Builds N rows in each representation the tools have used and reports the bytes
+# each row costs on top of its values (measured with tracemalloc, so the values
+# themselves, shared by every representation, are left out):
+#
+#   VRM input     csv.DictReader dict plus the rounded mileage  -> VRMInput row
+#   VRM output    33-key OrderedDict padded with Unused* columns (v1.2), then a
+#                 dict of the 12 real columns                   -> VRMOutput row
+#   CAPID input   (index, Series) from DataFrame.iterrows()      -> (index, CAPIDInput row)
+#   CAPID output  35-element padded list, then a dict of the 13 real columns -> CAPIDOutput row
+#   Sales output  17-element list zipped into a dict             -> SalesOutput row
+#
+# python CAP_benchmark.py [--rows 20000]
+import argparse
+import gc
+import tracemalloc
+from collections import OrderedDict
+
+import pandas as pd
+
+from CAP_output import frame_rows, row_type
+
+VRM_COLUMNS = ('VRM', 'CAPMan', 'CAPMod', 'CAPDer', 'RegisteredDate', 'CAPID', 'Mileage',
+               'Monthly_Clean', 'Monthly_Retail', 'Database', 'Live_Clean', 'Live_Retail')
+VRM_LEGACY_HEADER = (
+    'VRM', 'Unused1', 'CAPMan', 'CAPMod', 'CAPDer', 'RegisteredDate', 'CAPID', 'Mileage', 'Unused2', 'Unused3',
+    'Unused4', 'Unused5', 'Unused6', 'Unused7', 'Unused8', 'Unused9', 'Monthly_Clean', 'Unused10', 'Unused11',
+    'Monthly_Retail', 'Unused12', 'Unused13', 'Unused14', 'Database', 'Unused16', 'Unused17', 'Unused18',
+    'Unused19', 'Unused20', 'Live_Clean', 'Unused21', 'Unused22', 'Live_Retail')
+CAPID_INPUT_COLUMNS = ('VRM', 'DFR', 'CAPID', 'RegDate', 'RoundedMileage')
+CAPID_COLUMNS = ('VRM', 'CAPMan', 'CAPMod', 'CAPDer', 'DFR', 'CAPID', 'Mileage', 'Clean_Month', 'Retail_Month',
+                 'Clean_Live', 'Retail_Live', 'Live_Date', 'Month_Date')
+CAPID_LEGACY_WIDTH = 35
+SALES_COLUMNS = ('VRM', 'mileage', 'CAP ID', 'Reg Date', 'SaleClean', 'SaleRetail', 'SaleValuationDate',
+                 'PurchaseClean', 'PurchaseRetail', 'PurchaseValuationDate', 'CAPMan', 'CAPRange', 'CAPMod',
+                 'CAPDer', 'ModIntroduced', 'ModDiscontinued', 'CAP Code')
+
+VRMInput = row_type('BenchmarkVRMInput', ('VRM', 'Mileage', '_rounded_mileage'))
+VRMOutput = row_type('BenchmarkVRMOutput', VRM_COLUMNS)
+CAPIDInput = row_type('BenchmarkCAPIDInput', CAPID_INPUT_COLUMNS)
+CAPIDOutput = row_type('BenchmarkCAPIDOutput', CAPID_COLUMNS)
+SalesOutput = row_type('BenchmarkSalesOutput', SALES_COLUMNS)
+
+
+def values(count, width):
+    # Distinct values for `count` rows of `width` columns, made before measuring
+    return [tuple(f'{column}-{row}' for column in range(width)) for row in range(count)]
+
+
+def bytes_per_row(build, count):
+    # Bytes allocated by build() and still held when it returns, per row
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    rows = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert len(rows) == count
+    return (after - before) / count
+
+
+def benchmarks(count):
+    vrm_input = values(count, 5)  # A typical input file: VRM, mileage and three more columns
+    vrm_output = values(count, len(VRM_COLUMNS))
+    capid_output = values(count, len(CAPID_COLUMNS))
+    sales_output = values(count, len(SALES_COLUMNS))
+    input_fieldnames = ('VRM', 'Mileage', 'Make', 'Model', 'Notes')
+    frame = pd.DataFrame({'VRM': [f'AB{row:05d}' for row in range(count)], 'DFR': '01/03/2020',
+                          'CAPID': range(count), 'Mileage': 23456, 'RegDate': '2020-03-01',
+                          'RoundedMileage': 24000.0, 'Notes': 'n/a'})
+
+    yield 'VRM input', [
+        ('DictReader dict', lambda: [{**dict(zip(input_fieldnames, row)), '_rounded_mileage': row[1]}
+                                     for row in vrm_input]),
+        ('VRMInput row', lambda: [VRMInput(row[0], row[1], row[1]) for row in vrm_input]),
+    ]
+    yield 'VRM output', [
+        ('OrderedDict, 33 keys', lambda: [OrderedDict((name, row[VRM_COLUMNS.index(name)] if name in VRM_COLUMNS else '')
+                                                      for name in VRM_LEGACY_HEADER) for row in vrm_output]),
+        ('dict, 12 keys', lambda: [dict(zip(VRM_COLUMNS, row)) for row in vrm_output]),
+        ('VRMOutput row', lambda: [VRMOutput(*row) for row in vrm_output]),
+    ]
+    yield 'CAPID input', [
+        ('(index, Series)', lambda: list(frame.iterrows())),
+        ('(index, CAPIDInput row)', lambda: list(frame_rows(frame, CAPIDInput))),
+    ]
+    yield 'CAPID output', [
+        ('list, 35 items', lambda: [list(row[:8]) + [''] * 8 + list(row[8:]) + [''] * (CAPID_LEGACY_WIDTH - 21)
+                                    for row in capid_output]),
+        ('dict, 13 keys', lambda: [dict(zip(CAPID_COLUMNS, row)) for row in capid_output]),
+        ('CAPIDOutput row', lambda: [CAPIDOutput(*row) for row in capid_output]),
+    ]
+    yield 'Sales output', [
+        ('dict from a 17-item list', lambda: [dict(zip(SALES_COLUMNS, list(row))) for row in sales_output]),
+        ('SalesOutput row', lambda: [SalesOutput(*row) for row in sales_output]),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the memory each buffered CAP row costs")
+    parser.add_argument('--rows', type=int, default=20000, help="Rows built per representation (default: %(default)s)")
+    args = parser.parse_args()
+    print(f"Bytes per row over {args.rows} rows, not counting the values themselves")
+    for name, cases in benchmarks(args.rows):
+        print(name)
+        baseline = None
+        for label, build in cases:
+            size = bytes_per_row(build, args.rows)
+            baseline = baseline or size
+            print(f"  {label:<26} {size:8.0f}  {size / baseline:6.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+# Daily CAP call budget and per-run call accounting.
+#
+# CAP is metered per call. Every call made through the request layer
+# (CAP_metrics.RequestTimer) is counted against BUDGET, whose count lives in
+# shared memory so all worker processes of a run draw on one figure. With
+# --budget N the day's calls from earlier runs are read from the usage database
+# at start; once the day's total reaches N the tools stop scheduling new rows and
+# the run ends cleanly. Rows already started still finish, so a run can pass the
+# budget by at most the calls of its in-flight rows. With --soft-budget the run
+# only warns. Runs going at the same time only see each other's calls once they
+# have finished. The count follows the calendar day, so a process running past
+# midnight (the valuation service) starts the new day's count from the usage
+# database rather than staying spent.
+#
+# At the end of every run its calls are added to Runs/usage.sqlite by day,
+# subscriber, tool, run and endpoint, and the run reports the calls it avoided
+# through caches and de-duplication. A long-running process records its usage
+# periodically as well; each record adds only the calls made since the last one.
+#
+# python CAP_budget.py [--days 7]    daily totals per tool
+import argparse
+import multiprocessing
+import os
+import sqlite3
+from datetime import date, timedelta
+
+from CAP_config import SUBSCRIBER_ID
+from CAP_ledger import LEDGER_DIRECTORY
+
+USAGE_FILENAME = 'usage.sqlite'
+
+# (tool, run id) -> ({endpoint: calls}, calls avoided) already added by record_usage
+RECORDED = {}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    day TEXT,
+    subscriber TEXT,
+    tool TEXT,
+    run_id TEXT,
+    endpoint TEXT,
+    calls INTEGER,
+    avoided INTEGER,
+    PRIMARY KEY (day, subscriber, tool, run_id, endpoint)
+)
+"""
+
+
+class CallBudget:
+    # Calls made today against an optional daily limit. Unconfigured, it counts nothing.
+    def __init__(self):
+        self.limit = None
+        self.hard = True
+        self.used = None  # Shared across worker processes once configured
+        self.day = None  # Ordinal of the day `used` counts, shared like it
+        self.stopped = False  # Set in this process when a scheduler skipped rows
+
+    def configure(self, limit, hard=True, used_today=0):
+        self.limit = limit
+        self.hard = hard
+        context = multiprocessing.get_context('spawn')
+        self.used = context.Value('q', used_today)
+        self.day = context.Value('i', date.today().toordinal())
+        if used_today >= limit:
+            print(f"{used_today} CAP calls already made today; the daily budget is {limit}")
+
+    def adopt(self, other):
+        # Worker processes share the parent's count (see CAP_shard.run_sharded)
+        self.limit, self.hard, self.used, self.day = other.limit, other.hard, other.used, other.day
+
+    def roll(self):
+        # Starts the count again from the usage database when the day has changed
+        today = date.today().toordinal()
+        if self.day.value == today:
+            return
+        with self.used.get_lock():
+            if self.day.value != today:
+                self.used.value = calls_today()
+                self.day.value = today
+
+    def sync(self, used_today):
+        # Takes in calls other runs have recorded today (the usage database's total for the day)
+        if self.used is None:
+            return
+        self.roll()
+        with self.used.get_lock():
+            self.used.value = max(self.used.value, used_today)
+
+    def spend(self, calls=1):
+        if self.used is None:
+            return
+        self.roll()
+        with self.used.get_lock():
+            before = self.used.value
+            self.used.value = before + calls
+        if not self.hard and before < self.limit <= before + calls:
+            print(f"Warning: the daily budget of {self.limit} CAP calls has been reached; the run carries on")
+
+    @property
+    def exhausted(self):
+        # True once a hard budget is spent: schedulers start no new rows
+        if not self.hard or self.used is None:
+            return False
+        self.roll()
+        return self.used.value >= self.limit
+
+    def stop(self):
+        self.stopped = True
+
+
+def connect(directory=LEDGER_DIRECTORY):
+    os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(os.path.join(directory, USAGE_FILENAME), timeout=30)
+    connection.execute(SCHEMA)
+    return connection
+
+
+def calls_today(subscriber=SUBSCRIBER_ID, directory=LEDGER_DIRECTORY):
+    connection = connect(directory)
+    try:
+        (calls,) = connection.execute("SELECT COALESCE(SUM(calls), 0) FROM usage WHERE day = ? AND subscriber = ?",
+                                      (date.today().isoformat(), str(subscriber))).fetchone()
+        return calls
+    finally:
+        connection.close()
+
+
+def run_usage(metrics):
+    # ({endpoint: calls}, calls avoided) from a run's METRICS
+    calls = {}
+    avoided = 0
+    for (name, labels), value in metrics.counters.items():
+        labels = dict(labels)
+        if name == 'cap_requests_total':
+            calls[labels['endpoint']] = calls.get(labels['endpoint'], 0) + value
+        elif name == 'cap_cache_total' and labels['outcome'] in ('hit', 'coalesced'):
+            avoided += value
+    return calls, avoided
+
+
+def record_usage(tool, run_id, metrics, subscriber=SUBSCRIBER_ID, directory=LEDGER_DIRECTORY):
+    # Adds the run's calls since its last record_usage to today's totals and returns a
+    # one-line summary of all of the run's calls
+    calls, avoided = run_usage(metrics)
+    recorded_calls, recorded_avoided = RECORDED.get((tool, run_id), ({}, 0))
+    connection = connect(directory)
+    try:
+        with connection:
+            # Avoided calls are not per endpoint; they are kept on a '-' row of their own
+            for endpoint, count in [(endpoint, count - recorded_calls.get(endpoint, 0))
+                                    for endpoint, count in calls.items()] + [('-', 0)]:
+                connection.execute(
+                    "INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (day, subscriber, tool, run_id, endpoint) "
+                    "DO UPDATE SET calls = calls + excluded.calls, avoided = avoided + excluded.avoided",
+                    (date.today().isoformat(), str(subscriber), tool, run_id, endpoint, count,
+                     avoided - recorded_avoided if endpoint == '-' else 0))
+    finally:
+        connection.close()
+    RECORDED[(tool, run_id)] = (calls, avoided)
+    breakdown = ', '.join(f'{endpoint} {count}' for endpoint, count in sorted(calls.items()))
+    return f"{sum(calls.values())} CAP calls ({breakdown or 'none'}); {avoided} avoided by caching and de-duplication"
+
+
+def daily_totals(days=7, directory=LEDGER_DIRECTORY):
+    # [(day, tool, calls, avoided)] for the last `days` days, newest first
+    connection = connect(directory)
+    try:
+        return connection.execute(
+            "SELECT day, tool, SUM(calls), SUM(avoided) FROM usage WHERE day >= ? "
+            "GROUP BY day, tool ORDER BY day DESC, tool",
+            ((date.today() - timedelta(days=days - 1)).isoformat(),)).fetchall()
+    finally:
+        connection.close()
+
+
+BUDGET = CallBudget()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Show CAP calls per day and tool")
+    parser.add_argument('--days', type=int, default=7, help="Days to show (default: %(default)s)")
+    args = parser.parse_args()
+    for day, tool, calls, avoided in daily_totals(args.days):
+        print(f"{day}  {tool:<14} {calls:>8} calls  {avoided:>8} avoided")
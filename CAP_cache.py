@@ -0,0 +1,198 @@
+# Persistent caches shared by the CAP tools.
+#
+# CapidMetadataStore keeps the derivative metadata CAPIDValuation returns
+# (CAPMan/CAPRange/CAPMod/CAPDer, introduced/discontinued dates, CAPcode). It
+# never changes for a capid, so each capid is looked up once, ever: tools
+# prefetch the distinct capids in their input that are not cached yet before
+# any row worker starts.
+#
+# SingleFlight shares one in-flight call between every row asking for the same
+# key (e.g. capid, registration date, mileage and CAP publication period) and
+# keeps the result for the rest of the run, or, for a long-running process (the
+# valuation service), for a bounded number of keys and a while.
+import asyncio
+import json
+import os
+import sqlite3
+import time
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from datetime import datetime
+
+from CAP_budget import BUDGET
+from CAP_metrics import METRICS
+
+CACHE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Cache')
+CACHE_FILENAME = 'CAP_cache.sqlite'
+CACHE_PATH = os.path.join(CACHE_DIRECTORY, CACHE_FILENAME)
+
+NAMESPACE_VRM = {'ns': 'https://soap.cap.co.uk/vrm'}
+
+METADATA_FIELDS = (
+    'CAPMan', 'CAPRange', 'CAPMod', 'CAPDer', 'ModIntroduced', 'ModDiscontinued',
+    'DerIntroduced', 'DerDiscontinued', 'CAPcode',
+)
+
+PREFETCH_CONCURRENCY = 20  # Metadata requests in flight during prefetch
+
+
+def parse_capid_metadata(response_text):
+    # Metadata fields from a CAPIDValuation response; None when CAP has no successful lookup
+    root = ET.fromstring(response_text)
+    capid_lookup = root.find('.//ns:CAPIDLookup', NAMESPACE_VRM)
+    if capid_lookup is None:
+        return None
+    success = capid_lookup.find('.//ns:Success', NAMESPACE_VRM)
+    if success is not None and success.text != 'true':
+        return None
+    metadata = {}
+    for field in METADATA_FIELDS:
+        element = capid_lookup.find(f'.//ns:{field}', NAMESPACE_VRM)
+        metadata[field] = element.text if element is not None else None
+    return metadata
+
+
+class CapidMetadataStore:
+    # capid -> metadata dict, held in memory and persisted to sqlite. Capids CAP has no
+    # lookup for and capids whose request failed are remembered for this run only.
+    def __init__(self, database='CAR', path=CACHE_PATH):
+        self.database = database
+        self.path = path
+        self.memory = {}
+        self.not_found = set()
+        self.failed = set()
+        self.connection = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['connection'] = None
+        return state
+
+    def _connect(self):
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.connection = sqlite3.connect(self.path, timeout=30)
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS capid_metadata (
+                    database TEXT, capid INTEGER, metadata TEXT, fetched TEXT,
+                    PRIMARY KEY (database, capid)
+                )""")
+        return self.connection
+
+    def load(self, capids):
+        # Pull every cached entry for capids into memory in one query per 500 capids
+        capids = [int(capid) for capid in set(capids) if int(capid) not in self.memory]
+        connection = self._connect()
+        for start in range(0, len(capids), 500):
+            chunk = capids[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            for capid, metadata in connection.execute(
+                    f"SELECT capid, metadata FROM capid_metadata WHERE database = ? AND capid IN ({placeholders})",
+                    [self.database] + chunk):
+                self.memory[capid] = json.loads(metadata)
+
+    def get(self, capid):
+        return self.memory.get(int(capid))
+
+    def put(self, capid, metadata):
+        self.memory[int(capid)] = metadata
+        self._connect().execute(
+            "INSERT OR REPLACE INTO capid_metadata VALUES (?, ?, ?, ?)",
+            (self.database, int(capid), json.dumps(metadata), datetime.now().isoformat(timespec='seconds')))
+
+    def missing(self, capids):
+        self.load(capids)
+        return sorted({int(capid) for capid in capids} - set(self.memory))
+
+    async def prefetch(self, capids, fetch, concurrency=PREFETCH_CONCURRENCY):
+        # fetch(capid) returns a metadata dict, None when CAP has no lookup for the
+        # capid, or raises when the request failed. Returns the number of calls made.
+        missing = self.missing(capids)
+        METRICS.cache('capid_metadata', 'hit', len({int(capid) for capid in capids}) - len(missing))
+        METRICS.cache('capid_metadata', 'miss', len(missing))
+        semaphore = asyncio.Semaphore(concurrency)
+        skipped = []  # Left unfetched once the daily call budget is spent
+
+        async def fetch_one(capid):
+            async with semaphore:
+                if BUDGET.exhausted:
+                    BUDGET.stop()
+                    skipped.append(capid)
+                    return
+                try:
+                    metadata = await fetch(capid)
+                except Exception:
+                    self.failed.add(capid)
+                    return
+            if metadata is None:
+                self.not_found.add(capid)
+            else:
+                self.put(capid, metadata)
+
+        await asyncio.gather(*(fetch_one(capid) for capid in missing))
+        self.flush()
+        return len(missing) - len(skipped)
+
+    def flush(self):
+        if self.connection is not None:
+            self.connection.commit()
+
+    def close(self):
+        self.flush()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class SingleFlight:
+    # key -> task of the one call made for it. Callers arriving while the call is in
+    # flight await the same task; later callers get its result. Calls that raise or
+    # return None are forgotten so the next caller tries again. Every lookup is
+    # counted in METRICS as a hit, coalesced (joined a call in flight) or miss.
+    # Given max_entries, the least recently used keys are dropped beyond that many;
+    # given ttl, results are kept for that many seconds.
+    def __init__(self, name='requests', max_entries=None, ttl=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.tasks = OrderedDict()  # Least recently used first
+        self.finished = {}  # key -> time.monotonic() its result was kept
+        self.calls = 0
+        self.requests = 0
+
+    async def do(self, key, func):
+        self.requests += 1
+        task = self.tasks.get(key)
+        if task is not None and self.expired(key):
+            self.forget(key, task)
+            task = None
+        if task is not None:
+            self.tasks.move_to_end(key)
+            METRICS.cache(self.name, 'hit' if task.done() else 'coalesced')
+            return await task
+        METRICS.cache(self.name, 'miss')
+        self.calls += 1
+        task = self.tasks[key] = asyncio.ensure_future(func())
+        while self.max_entries is not None and len(self.tasks) > self.max_entries:
+            self.forget(*self.tasks.popitem(last=False))
+        try:
+            result = await task
+        except Exception:
+            self.forget(key, task)
+            raise
+        if result is None:
+            self.forget(key, task)
+        elif self.tasks.get(key) is task:
+            self.finished[key] = time.monotonic()
+        return result
+
+    def expired(self, key):
+        # Calls still in flight have no finish time and never expire
+        kept = self.finished.get(key)
+        return self.ttl is not None and kept is not None and time.monotonic() - kept > self.ttl
+
+    def forget(self, key, task):
+        # Drops key unless a newer call for it has replaced task
+        if self.tasks.get(key, task) is task:
+            self.tasks.pop(key, None)
+            self.finished.pop(key, None)
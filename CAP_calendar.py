@@ -0,0 +1,36 @@
+# CAP publication calendar shared by the CAP tools.
+#
+# CAP publishes used values on a fixed monthly cadence, and every valuation date
+# inside a publication period returns that period's figures. Tools still send CAP
+# the real valuation date, but key their caches and in-flight requests by period,
+# so sale dates spread across a month cost one call per vehicle rather than one
+# per date.
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+PUBLICATION_DAY = 1  # Day of the month each period's figures are published
+
+
+def period_start(value, publication_day=PUBLICATION_DAY):
+    # Publication date of the period a valuation date falls in, as a date.
+    # Accepts a date, a datetime or a 'YYYY-MM-DD' string.
+    if isinstance(value, str):
+        value = datetime.strptime(value[:10], '%Y-%m-%d').date()
+    elif isinstance(value, datetime):
+        value = value.date()
+    if value.day < publication_day:
+        value = value.replace(day=1) - timedelta(days=1)  # Still in the previous month's period
+    return value.replace(day=publication_day)
+
+
+def period_key(value, publication_day=PUBLICATION_DAY):
+    # 'YYYY-MM-DD' of the period start; the key tools share calls and cached figures by
+    return period_start(value, publication_day).strftime('%Y-%m-%d')
+
+
+def period_keys(values, publication_day=PUBLICATION_DAY):
+    # period_key for a whole datetime64 column at once; missing dates stay missing
+    offset = pd.to_timedelta(publication_day - 1, unit='D')
+    starts = (values - offset).dt.to_period('M').dt.start_time + offset
+    return starts.dt.strftime('%Y-%m-%d').where(values.notna())
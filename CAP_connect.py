@@ -0,0 +1,176 @@
+# Warm connections to CAP, opened while a tool is still reading its input.
+#
+# The tools read their input first and only then started talking to CAP, so DNS,
+# TCP and TLS set-up to soap.cap.co.uk all came after input parsing and the first
+# requests of a run paid for the handshakes. Now a tool calls CONNECTIONS.start()
+# before it reads its input. That starts the run's event loop on a thread of its
+# own, with one aiohttp session on it, and opens --warm-connections keep-alive
+# connections (a HEAD request each, not a CAP call, so not metered). The host is
+# resolved once and cached for the run. CONNECTIONS.run(coroutine) then takes the
+# loop back onto the main thread in place of asyncio.run, so the requests go out
+# on the pool opened in the background, and every phase of a run (metadata
+# prefetch, rows, reruns) shares it. A warm-up still going at that point carries
+# on alongside the rows.
+#
+# Connections opened, warmed up and reused are counted as
+# cap_connections_total{outcome} (CAP_metrics). Runs print the share of requests
+# that found a connection already open. Without start(), e.g. in sharded workers,
+# run() is asyncio.run and session() opens a pool for that event loop alone.
+import asyncio
+import contextlib
+import threading
+import time
+from types import SimpleNamespace
+
+import aiohttp
+from yarl import URL
+
+from CAP_metrics import METRICS
+from CAP_trace import TRACER
+
+WARM_CONNECTIONS = 8  # Default --warm-connections
+DNS_CACHE_SECONDS = 300  # The CAP host is resolved once per run, not every 10s
+KEEPALIVE_SECONDS = 60  # Idle pooled connections are kept this long (aiohttp's default is 15)
+WARM_UP = SimpleNamespace(warm_up=True)  # trace_request_ctx of the warm-up's own requests
+
+
+def connection_trace_config():
+    # Counts connections opened and reused, and records connection waits and
+    # connects as spans when tracing (CAP_trace) is on
+    config = aiohttp.TraceConfig()
+
+    async def queued_start(session, context, params):
+        context.queued = time.perf_counter()
+
+    async def queued_end(session, context, params):
+        TRACER.record('connection wait', context.queued)
+
+    async def create_start(session, context, params):
+        context.connecting = time.perf_counter()
+
+    async def create_end(session, context, params):
+        warm_up = context.trace_request_ctx is WARM_UP
+        METRICS.inc('cap_connections_total', outcome='warmed' if warm_up else 'opened')
+        TRACER.record('connect', context.connecting)
+
+    async def reused(session, context, params):
+        if context.trace_request_ctx is not WARM_UP:
+            METRICS.inc('cap_connections_total', outcome='reused')
+
+    config.on_connection_queued_start.append(queued_start)
+    config.on_connection_queued_end.append(queued_end)
+    config.on_connection_create_start.append(create_start)
+    config.on_connection_create_end.append(create_end)
+    config.on_connection_reuseconn.append(reused)
+    return config
+
+
+def open_session(**connector_options):
+    # A session on the running loop with keep-alive and DNS caching set for CAP;
+    # connector_options (limit, limit_per_host) go to aiohttp's TCPConnector
+    connector = aiohttp.TCPConnector(ttl_dns_cache=DNS_CACHE_SECONDS, keepalive_timeout=KEEPALIVE_SECONDS,
+                                     **connector_options)
+    return aiohttp.ClientSession(connector=connector, trace_configs=[connection_trace_config()])
+
+
+async def warm_up(session, url, connections):
+    # Opens up to `connections` connections to url's host at once and leaves them in the
+    # pool; connections already idle in the pool are used again instead. Returns the errors.
+    origin = URL(url.strip()).origin()
+
+    async def touch():
+        async with session.head(origin, allow_redirects=False, trace_request_ctx=WARM_UP):
+            pass
+
+    results = await asyncio.gather(*(touch() for _ in range(connections)), return_exceptions=True)
+    return [result for result in results if isinstance(result, Exception)]
+
+
+async def keep_warm(session, url, connections, interval=KEEPALIVE_SECONDS / 2):
+    # For long-lived processes (the valuation service): keeps idle connections from timing
+    # out between jobs and tops the pool back up after CAP closes some
+    while True:
+        await warm_up(session, url, connections)
+        await asyncio.sleep(interval)
+
+
+def connection_summary(metrics):
+    # One line on how often requests found a connection open, or None when none were made
+    counts = {dict(labels)['outcome']: value for (name, labels), value in metrics.counters.items()
+              if name == 'cap_connections_total'}
+    opened, warmed, reused = counts.get('opened', 0), counts.get('warmed', 0), counts.get('reused', 0)
+    if not opened + reused:
+        return None
+    return (f"{opened + warmed} connections to CAP ({warmed} warmed up before the first request); "
+            f"{reused / (opened + reused):.0%} of requests reused an open connection")
+
+
+class ConnectionPool:
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.shared = None  # The run's session, once start() has been called
+        self.warming = None
+
+    def start(self, url, connections=WARM_CONNECTIONS, **connector_options):
+        # Starts the run's event loop on a background thread and warms up the pool while
+        # the caller goes on to read its input
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='CAP connections', daemon=True)
+        self.thread.start()
+        self.shared = self.submit(self._open(connector_options)).result()
+        self.warming = self.submit(self._warm_up(url, connections))
+
+    def submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def _open(self, connector_options):
+        return open_session(**connector_options)
+
+    async def _warm_up(self, url, connections):
+        errors = await warm_up(self.shared, url, connections)
+        if errors:
+            print(f"Connection warm-up: {len(errors)} of {connections} connections failed "
+                  f"({type(errors[0]).__name__}: {errors[0]}); requests will connect as they go")
+
+    def run(self, coroutine):
+        # Stands in for asyncio.run(coroutine), running it on the warmed-up loop
+        if self.loop is None:
+            return asyncio.run(coroutine)
+        if self.thread is not None:
+            # Take the loop back from the warm-up thread, which stops after its current step
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.thread = None
+        asyncio.set_event_loop(self.loop)
+        try:
+            return self.loop.run_until_complete(coroutine)
+        finally:
+            asyncio.set_event_loop(None)
+
+    @contextlib.asynccontextmanager
+    async def session(self, **connector_options):
+        # async with CONNECTIONS.session() as session: ... the warm pool once start() has
+        # been called, otherwise a pool of the caller's own that closes with the block
+        if self.shared is not None:
+            yield self.shared
+            return
+        async with open_session(**connector_options) as session:
+            yield session
+
+    def close(self):
+        # Closes the run's pool and loop; run_tool calls this at the end of every run
+        if self.loop is None:
+            return
+        self.run(self._close())
+        self.loop.close()
+        self.loop = self.shared = self.warming = None
+
+    async def _close(self):
+        self.warming.cancel()
+        await self.shared.close()
+        await self.loop.shutdown_asyncgens()
+        await self.loop.shutdown_default_executor()
+
+
+CONNECTIONS = ConnectionPool()
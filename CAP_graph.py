@@ -0,0 +1,36 @@
+# Per-row request graph shared by the CAP tools.
+#
+# Each step is an async function plus the names of the steps whose results it
+# needs. Steps with no dependencies between them run concurrently, and a
+# dependent step (e.g. VRM -> live valuation, or a 10k-mile fallback) starts as
+# soon as its inputs resolve, so a row takes as long as its slowest chain of
+# calls rather than the sum of all of them.
+import asyncio
+
+
+class RequestGraph:
+    def __init__(self):
+        self.steps = {}
+
+    def add(self, name, func, *depends_on):
+        # func is called with the results of depends_on, in order. Dependencies must
+        # be added first, which also rules out cycles.
+        missing = [dep for dep in depends_on if dep not in self.steps]
+        if missing:
+            raise ValueError(f"Step '{name}' depends on unknown step(s): {', '.join(missing)}")
+        self.steps[name] = (func, depends_on)
+        return self
+
+    async def run(self):
+        # Returns {step name: result}. A step that raised maps to its exception, and so
+        # does every step depending on it.
+        tasks = {}
+
+        async def run_step(func, depends_on):
+            inputs = [await tasks[dep] for dep in depends_on]
+            return await func(*inputs)
+
+        for name, (func, depends_on) in self.steps.items():
+            tasks[name] = asyncio.ensure_future(run_step(func, depends_on))
+        results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+        return dict(zip(tasks, results))
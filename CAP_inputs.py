@@ -0,0 +1,135 @@
+# Parsed copies of the spreadsheets and CSVs the CAP tools read.
+#
+# Parsing an .xlsx workbook takes seconds and a large CSV most of one, and the
+# same files are usually read again by the next run. read_excel and read_csv
+# keep each parsed input as an Arrow sidecar in the cache directory, with the
+# column types pandas inferred, and read that instead while the input is unchanged:
+#
+#   Cache/Inputs/IF4C_<id>.arrow   the parsed sheet (Arrow IPC, uncompressed)
+#   Cache/Inputs/IF4C_<id>.json    the size, mtime and SHA-1 of the file it came from
+#
+# Sidecars are memory-mapped rather than read, so loading one costs little more
+# than building the DataFrame. An input with the size and mtime recorded is taken
+# as unchanged. One whose mtime moved (e.g. OneDrive synced it again, or CAP Sales
+# wrote its input back) is hashed, and the sidecar is kept if the content is the
+# same. Anything else re-parses the input and replaces the sidecar; sidecars of
+# inputs that have since been deleted (last week's export) are removed. Without
+# pyarrow, or for a column Arrow can't hold (mixed numbers and text), the input
+# is parsed every time as before.
+import contextlib
+import glob
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+from CAP_cache import CACHE_DIRECTORY
+
+INPUTS_SUBDIRECTORY = 'Inputs'  # Sidecars are kept here under the --cache directory
+HASH_CHUNK_BYTES = 1 << 20
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sidecar_paths(path, reader, options, directory):
+    # (sidecar, manifest) for path parsed by reader with options; each has its own
+    source = os.path.abspath(path)
+    key = hashlib.sha1(json.dumps([source, reader, options], sort_keys=True, default=str).encode()).hexdigest()[:16]
+    stem = os.path.join(directory, f"{os.path.splitext(os.path.basename(source))[0]}_{key}")
+    return stem + '.arrow', stem + '.json'
+
+
+def unchanged(path, manifest_path):
+    # True when the input is the one the sidecar was made from; refreshes the manifest
+    # when only its mtime has moved
+    try:
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return False
+    stat = os.stat(path)
+    if stat.st_size != manifest.get('size'):
+        return False
+    if stat.st_mtime_ns == manifest.get('mtime_ns'):
+        return True
+    if file_hash(path) != manifest.get('sha1'):
+        return False
+    write_manifest(manifest_path, path, manifest['sha1'], stat)
+    return True
+
+
+def write_manifest(manifest_path, path, sha1, stat):
+    manifest = {'source': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': sha1}
+    temporary = f'{manifest_path}.{os.getpid()}.tmp'
+    with open(temporary, 'w') as file:
+        json.dump(manifest, file)
+    os.replace(temporary, manifest_path)
+
+
+def write_sidecar(frame, path, sidecar_path, manifest_path, sha1, stat):
+    # Saves frame as the sidecar of path, recorded with the sha1 and stat the input had before
+    # it was parsed; returns False when Arrow can't hold it, or the sidecar can't be replaced
+    # (another run has it mapped)
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+    temporary = f'{sidecar_path}.{os.getpid()}.tmp'
+    try:
+        feather.write_feather(frame, temporary, compression='uncompressed')
+        os.replace(temporary, sidecar_path)
+    except (pa.ArrowException, TypeError, ValueError, OSError) as exc:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        print(f"{os.path.basename(path)} is parsed each run; it has no sidecar ({exc})")
+        return False
+    write_manifest(manifest_path, path, sha1, stat)
+    return True
+
+
+def prune(directory):
+    # Removes the sidecars of inputs that no longer exist
+    for manifest_path in glob.glob(os.path.join(directory, '*.json')):
+        try:
+            with open(manifest_path) as file:
+                source = json.load(file).get('source')
+        except (OSError, ValueError):
+            continue
+        if source and not os.path.exists(source):
+            for stale in (os.path.splitext(manifest_path)[0] + '.arrow', manifest_path):
+                with contextlib.suppress(OSError):
+                    os.remove(stale)
+
+
+def read_input(reader, path, cache_directory, **options):
+    # reader(path, **options), from the sidecar while the input is unchanged
+    try:
+        import pyarrow.feather as feather
+    except ImportError:
+        return reader(path, **options)
+    directory = os.path.join(cache_directory, INPUTS_SUBDIRECTORY)
+    sidecar_path, manifest_path = sidecar_paths(path, reader.__name__, options, directory)
+    if os.path.exists(sidecar_path) and unchanged(path, manifest_path):
+        return feather.read_table(sidecar_path, memory_map=True).to_pandas()
+    # Taken before parsing, so an input saved while it is read is not recorded as the one parsed
+    stat = os.stat(path)
+    sha1 = file_hash(path)
+    frame = reader(path, **options)
+    os.makedirs(directory, exist_ok=True)
+    prune(directory)
+    write_sidecar(frame, path, sidecar_path, manifest_path, sha1, stat)
+    return frame
+
+
+def read_excel(path, cache_directory=CACHE_DIRECTORY, **options):
+    return read_input(pd.read_excel, path, cache_directory, **options)
+
+
+def read_csv(path, cache_directory=CACHE_DIRECTORY, **options):
+    return read_input(pd.read_csv, path, cache_directory, **options)
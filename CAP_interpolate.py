@@ -0,0 +1,96 @@
+# Approximate valuations from neighbouring mileage buckets (--interpolate).
+#
+# Within one capid, registration date and CAP publication period, values change
+# smoothly with mileage, so a vehicle whose 1,000-mile bucket has not been valued
+# can be estimated from buckets either side of it that have. With --interpolate,
+# a tool looks for those neighbours before calling CAP: in the valuation
+# warehouse (CAP_warehouse), loaded once for the capids in its input, and among
+# the valuations the run itself has made so far (e.g. other stock of the same
+# derivative).
+#
+#   valued buckets on both sides within the tolerance -> straight-line interpolation
+#   a valued bucket on one side only                  -> that bucket's figures
+#   no valued bucket within the tolerance             -> CAP is called as usual
+#
+# The tolerance is in miles either side of the vehicle's bucket. Estimated cells
+# are listed in an Interpolated column of the output and are not added to the
+# warehouse. Only GetUsedLive_IdRegDateMileage valuations are interpolated.
+from CAP_calendar import period_key
+from CAP_metrics import METRICS
+from CAP_warehouse import available, query
+
+INTERPOLATE_TOLERANCE = 2000  # --interpolate with no value
+INTERPOLATED_COLUMN = 'Interpolated'  # Output column naming the estimated cells of a row
+ENDPOINT = 'GetUsedLive_IdRegDateMileage'
+
+
+def to_figure(value):
+    # A clean or retail figure as a number; None for 'n/a', blanks and zero
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if value > 0 else None
+
+
+class MileageInterpolator:
+    # (capid, registration date, period) -> {mileage bucket: (clean, retail)}
+    def __init__(self, tolerance=INTERPOLATE_TOLERANCE):
+        self.tolerance = tolerance
+        self.points = {}
+
+    @staticmethod
+    def key(capid, reg_date, valuation_date):
+        return int(capid), str(reg_date)[:10], period_key(valuation_date)
+
+    def add(self, capid, reg_date, valuation_date, mileage, clean, retail):
+        # Records a valuation CAP returned; figures missing from it are not neighbours
+        clean, retail = to_figure(clean), to_figure(retail)
+        if clean is None or retail is None:
+            return
+        self.points.setdefault(self.key(capid, reg_date, valuation_date), {})[int(mileage)] = (clean, retail)
+
+    def load(self, capids, valuation_dates, directory):
+        # Adds the warehouse's valuations of capids in the periods of valuation_dates and
+        # returns how many there were; the newest valuation of each bucket is kept
+        if not available(directory):
+            return 0
+        periods = {period_key(value) for value in valuation_dates}
+        records = query(capid=sorted({int(capid) for capid in capids}), start=min(periods), directory=directory)
+        records = records[(records['endpoint'] == ENDPOINT) & records['reg_date'].notna()
+                          & records['mileage_bucket'].notna()]
+        records = records[records['valuation_date'].map(period_key).isin(periods)]
+        for record in records.iloc[::-1].itertuples(index=False):  # Oldest first, so newer ones replace them
+            self.add(record.capid, record.reg_date, record.valuation_date, record.mileage_bucket,
+                     record.clean, record.retail)
+        return len(records)
+
+    def estimate(self, capid, reg_date, valuation_date, mileage):
+        # (clean, retail) at mileage from the nearest valued buckets within the tolerance,
+        # or None when there are none and CAP has to be called
+        points = self.points.get(self.key(capid, reg_date, valuation_date))
+        if not points:
+            return None
+        mileage = int(mileage)
+        below = max((bucket for bucket in points if mileage - self.tolerance <= bucket <= mileage), default=None)
+        above = min((bucket for bucket in points if mileage <= bucket <= mileage + self.tolerance), default=None)
+        if below is None and above is None:
+            return None
+        if below is None or above is None or below == above:
+            clean, retail = points[below if above is None else above]
+        else:
+            share = (mileage - below) / (above - below)
+            clean, retail = (low + (high - low) * share for low, high in zip(points[below], points[above]))
+        METRICS.inc('cap_interpolated_total')
+        return round(clean), round(retail)
+
+
+def interpolation_summary(metrics, valuations):
+    # One line on how many of a run's valuations were estimated
+    estimated = sum(value for (name, _), value in metrics.counters.items() if name == 'cap_interpolated_total')
+    return f"{estimated} of {valuations} valuations interpolated from neighbouring mileage buckets"
+
+
+def interpolated_cells(*cells):
+    # The Interpolated column's value from (estimated, clean column, retail column) triples
+    return ' '.join(f'{clean} {retail}' for estimated, clean, retail in cells if estimated) or None
@@ -0,0 +1,199 @@
+# Per-row result ledger shared by the CAP tools, for re-running only the calls
+# that failed.
+#
+# Every row a run attempts is recorded with the output fields that do not come
+# from CAP, plus one entry per step (each endpoint/date call the row needs)
+# holding either the parsed result or the error. A run's failed steps are its
+# failure manifest: a re-run reads them, issues just those requests again, and
+# takes the successful steps from the ledger as they are.
+#
+# Shard processes write to one ledger at the same time. SQLite lets only one of
+# them write at once, so each row and its steps are committed together in a
+# transaction of their own rather than holding the write lock across rows.
+import argparse
+import json
+import os
+import sqlite3
+from datetime import datetime
+
+from CAP_archive import CREDENTIAL_FIELDS
+
+LEDGER_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Runs')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    tool TEXT,
+    started TEXT,
+    rerun_of TEXT
+);
+CREATE TABLE IF NOT EXISTS rows (
+    run_id TEXT,
+    row_key INTEGER,
+    base TEXT,
+    PRIMARY KEY (run_id, row_key)
+);
+CREATE TABLE IF NOT EXISTS steps (
+    run_id TEXT,
+    row_key INTEGER,
+    step TEXT,
+    url TEXT,
+    request TEXT,
+    result TEXT,
+    error TEXT,
+    PRIMARY KEY (run_id, row_key, step)
+);
+"""
+
+
+class StepResult:
+    # One recorded call: the request without credentials, and its result or error
+    def __init__(self, url, request, result=None, error=None):
+        self.url = url
+        self.request = request
+        self.result = result
+        self.error = error
+
+    @property
+    def failed(self):
+        return self.error is not None
+
+
+def to_json(value):
+    # numpy scalars from pandas rows are stored as the plain Python values they hold
+    return json.dumps(value, default=lambda item: item.item())
+
+
+def strip_credentials(payload):
+    return {key: value for key, value in payload.items() if key.lower() not in CREDENTIAL_FIELDS}
+
+
+class RunLedger:
+    # One run's view of the ledger. The sqlite connection is opened lazily so the
+    # object can be handed to worker processes.
+    def __init__(self, tool, run_id, directory=LEDGER_DIRECTORY, rerun_of=None):
+        self.tool = tool
+        self.run_id = run_id
+        self.directory = directory
+        self.rerun_of = rerun_of
+        self.connection = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['connection'] = None
+        return state
+
+    def _connect(self):
+        if self.connection is None:
+            self.connection = connect(self.directory)
+            self.connection.execute(
+                "INSERT OR IGNORE INTO runs (run_id, tool, started, rerun_of) VALUES (?, ?, ?, ?)",
+                (self.run_id, self.tool, datetime.now().isoformat(timespec='seconds'), self.rerun_of))
+            self.connection.commit()
+        return self.connection
+
+    def record_row(self, row_key, base, steps):
+        # The row's base fields and every one of its {step: StepResult}, in one short transaction
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO rows VALUES (?, ?, ?)",
+                (self.run_id, int(row_key), to_json(base)))
+            connection.executemany(
+                "INSERT OR REPLACE INTO steps VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(self.run_id, int(row_key), step, step_result.url,
+                  to_json(strip_credentials(step_result.request)),
+                  None if step_result.failed else to_json(step_result.result),
+                  step_result.error)
+                 for step, step_result in steps.items()])
+
+    def flush(self):
+        if self.connection is not None:
+            self.connection.commit()
+
+    def close(self):
+        self.flush()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def connect(directory=LEDGER_DIRECTORY):
+    os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(os.path.join(directory, 'ledger.sqlite'), timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL")  # Shards read while another writes
+    connection.execute("PRAGMA synchronous=NORMAL")  # A commit per row need not wait on the disk
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def load_run(run_id, directory=LEDGER_DIRECTORY):
+    # Every row of a recorded run in row order, as (row_key, base, {step: StepResult})
+    connection = connect(directory)
+    try:
+        if connection.execute("SELECT 1 FROM runs WHERE run_id = ?", (run_id,)).fetchone() is None:
+            raise ValueError(f"Run '{run_id}' is not in the ledger at {directory}")
+        steps = {}
+        for row_key, step, url, request, result, error in connection.execute(
+                "SELECT row_key, step, url, request, result, error FROM steps WHERE run_id = ?", (run_id,)):
+            steps.setdefault(row_key, {})[step] = StepResult(
+                url, json.loads(request), None if result is None else json.loads(result), error)
+        return [(row_key, json.loads(base), steps.get(row_key, {}))
+                for row_key, base in connection.execute(
+                    "SELECT row_key, base FROM rows WHERE run_id = ? ORDER BY row_key", (run_id,))]
+    finally:
+        connection.close()
+
+
+def latest_run(tool, directory=LEDGER_DIRECTORY):
+    # run_id of the tool's most recent run, or None
+    if not os.path.exists(os.path.join(directory, 'ledger.sqlite')):
+        return None
+    connection = connect(directory)
+    try:
+        found = connection.execute(
+            "SELECT run_id FROM runs WHERE tool = ? ORDER BY started DESC, run_id DESC LIMIT 1", (tool,)).fetchone()
+    finally:
+        connection.close()
+    return found[0] if found else None
+
+
+def failure_manifest(run_id, directory=LEDGER_DIRECTORY):
+    # The failed steps of a run as (row_key, step, url, error)
+    connection = connect(directory)
+    try:
+        return connection.execute("""
+            SELECT row_key, step, url, error FROM steps
+            WHERE run_id = ? AND error IS NOT NULL ORDER BY row_key, step
+        """, (run_id,)).fetchall()
+    finally:
+        connection.close()
+
+
+def list_runs(directory=LEDGER_DIRECTORY):
+    if not os.path.exists(os.path.join(directory, 'ledger.sqlite')):
+        return []
+    connection = connect(directory)
+    try:
+        return connection.execute("""
+            SELECT runs.run_id, runs.tool, runs.started, runs.rerun_of,
+                   (SELECT COUNT(*) FROM rows WHERE rows.run_id = runs.run_id),
+                   (SELECT COUNT(DISTINCT row_key) FROM steps
+                    WHERE steps.run_id = runs.run_id AND steps.error IS NOT NULL)
+            FROM runs ORDER BY runs.started
+        """).fetchall()
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="List the runs in the CAP result ledger, or one run's failures")
+    parser.add_argument('--directory', default=LEDGER_DIRECTORY)
+    parser.add_argument('--failures', metavar='RUN_ID', help="Print the failure manifest of a run")
+    args = parser.parse_args()
+    if args.failures:
+        for row_key, step, url, error in failure_manifest(args.failures, args.directory):
+            print(f"row {row_key}  {step}  {url.strip()}  {error}")
+    else:
+        for run_id, tool, started, rerun_of, rows, failed_rows in list_runs(args.directory):
+            rerun = f"  re-run of {rerun_of}" if rerun_of else ""
+            print(f"{run_id}  {tool}  started {started}  {rows} rows, {failed_rows} with failures{rerun}")
@@ -0,0 +1,189 @@
+# Prometheus-style metrics shared by the CAP tools and the valuation service.
+#
+# Each process keeps one registry, METRICS. The request path records latency per
+# CAP endpoint, in-flight gauges and outcome counters (HTTP status, timeout or
+# error); SingleFlight and the capid metadata cache count hits, misses and
+# coalesced calls; output sinks count rows per tool. Batch runs dump a JSON
+# snapshot to the tool's Logs folder at the end, the service exposes /metrics in
+# Prometheus text format, and sharded runs merge each worker's snapshot into the
+# parent's, so one file answers whether CAP, the concurrency settings or local CPU
+# was the bottleneck.
+#
+#   cap_request_seconds{endpoint}            histogram of CAP call latency
+#   cap_requests_in_flight{endpoint}         gauge
+#   cap_requests_total{endpoint,outcome}     counter; outcome is the HTTP status, 'timeout' or 'error'
+#   cap_retries_total{tool,reason}           counter, e.g. the 10,000-mile fallback
+#   cap_cache_total{cache,outcome}           counter; outcome is hit, miss or coalesced
+#   cap_rows_total{tool}                     counter, with cap_rows_per_second{tool} derived from it
+#   cap_connections_total{outcome}           counter; outcome is opened, warmed (by CAP_connect) or reused
+import asyncio
+import json
+import os
+import time
+from datetime import datetime
+
+from CAP_archive import endpoint_name
+from CAP_budget import BUDGET
+from CAP_trace import TRACER
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)  # Seconds; +Inf is implied
+
+HELP = {
+    'cap_request_seconds': ('histogram', "Latency of CAP requests"),
+    'cap_requests_in_flight': ('gauge', "CAP requests currently waiting on a response"),
+    'cap_requests_total': ('counter', "CAP requests by outcome"),
+    'cap_retries_total': ('counter', "Extra CAP requests made to retry a row"),
+    'cap_cache_total': ('counter', "Lookups answered from a cache, coalesced onto a call in flight, or missed"),
+    'cap_rows_total': ('counter', "Output rows written"),
+    'cap_row_failures_total': ('counter', "Rows skipped because processing them raised an error"),
+    'cap_rows_per_second': ('gauge', "Output rows written per second since the registry started"),
+    'cap_connections_total': ('counter', "Connections to CAP opened by requests, opened ahead by the warm-up, or reused"),
+}
+
+
+def label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+class RequestTimer:
+    # with METRICS.request(url) as call: ... call.status = response.status
+    # Times one CAP call and counts it under its status, or as a timeout/error when it raises.
+    # The call is also a 'request' span in the row's trace lane when tracing (CAP_trace) is on,
+    # and is counted against the daily call budget (CAP_budget).
+    def __init__(self, registry, url):
+        self.registry = registry
+        self.endpoint = endpoint_name(url)
+        self.status = None
+
+    def __enter__(self):
+        BUDGET.spend()
+        self.registry.add('cap_requests_in_flight', 1, endpoint=self.endpoint)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.registry.observe('cap_request_seconds', time.perf_counter() - self.started, endpoint=self.endpoint)
+        self.registry.add('cap_requests_in_flight', -1, endpoint=self.endpoint)
+        if exc_type is not None and issubclass(exc_type, asyncio.TimeoutError):
+            outcome = 'timeout'
+        elif exc_type is not None or self.status is None:
+            outcome = 'error'
+        else:
+            outcome = self.status
+        self.registry.inc('cap_requests_total', endpoint=self.endpoint, outcome=outcome)
+        TRACER.record('request', self.started, endpoint=self.endpoint, outcome=outcome)
+        return False
+
+
+class Registry:
+    def __init__(self, tool=None):
+        self.tool = tool  # Label for rows written by this process
+        self.run_id = None  # The run's usage is recorded under (CAP_options.run_tool)
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.counters = {}  # (name, labels) -> value
+        self.gauges = {}
+        self.histograms = {}  # (name, labels) -> [count per bucket (+Inf last), sum]
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, label_key(labels))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def add(self, name, amount, **labels):
+        key = (name, label_key(labels))
+        self.gauges[key] = self.gauges.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, label_key(labels))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0]
+        for position, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                break
+        else:
+            position = len(LATENCY_BUCKETS)
+        histogram[0][position] += 1
+        histogram[1] += value
+
+    def request(self, url):
+        return RequestTimer(self, url)
+
+    def cache(self, cache, outcome, amount=1):
+        if amount:
+            self.inc('cap_cache_total', amount, cache=cache, outcome=outcome)
+
+    def row(self):
+        self.inc('cap_rows_total', tool=self.tool or 'unknown')
+
+    def derived_gauges(self):
+        # Rows per second for each tool, over the life of the registry
+        elapsed = max(time.time() - self.started, 1e-9)
+        return {('cap_rows_per_second', labels): value / elapsed
+                for (name, labels), value in self.counters.items() if name == 'cap_rows_total'}
+
+    def snapshot(self):
+        # Plain, picklable and JSON-able copy of every metric
+        def entries(metrics):
+            return [{'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(metrics.items())]
+        return {
+            'started': datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+            'elapsed_seconds': round(time.time() - self.started, 3),
+            'buckets': list(LATENCY_BUCKETS),
+            'counters': entries(self.counters),
+            'gauges': entries({**self.gauges, **self.derived_gauges()}),
+            'histograms': [{'name': name, 'labels': dict(labels), 'buckets': counts, 'sum': total}
+                           for (name, labels), (counts, total) in sorted(self.histograms.items())],
+        }
+
+    def merge(self, snapshot):
+        # Add a worker process's snapshot into this registry
+        for entry in snapshot['counters']:
+            self.inc(entry['name'], entry['value'], **entry['labels'])
+        for entry in snapshot['gauges']:
+            if entry['name'] != 'cap_rows_per_second':  # Recomputed from the merged row count
+                self.add(entry['name'], entry['value'], **entry['labels'])
+        for entry in snapshot['histograms']:
+            key = (entry['name'], label_key(entry['labels']))
+            counts, total = self.histograms.setdefault(key, [[0] * (len(LATENCY_BUCKETS) + 1), 0.0])
+            self.histograms[key] = [[a + b for a, b in zip(counts, entry['buckets'])], total + entry['sum']]
+
+    def to_prometheus(self):
+        # Prometheus text exposition format
+        def label_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+        by_name = {}
+        for (name, labels), value in sorted({**self.counters, **self.gauges, **self.derived_gauges()}.items()):
+            by_name.setdefault(name, []).append(f'{name}{label_text(labels)} {value:g}')
+        for (name, labels), (counts, total) in sorted(self.histograms.items()):
+            lines = by_name.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{label_text(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_sum{label_text(labels)} {total:g}')
+            lines.append(f'{name}_count{label_text(labels)} {cumulative}')
+
+        text = []
+        for name in sorted(by_name):
+            kind, description = HELP.get(name, ('untyped', name))
+            text += [f'# HELP {name} {description}', f'# TYPE {name} {kind}'] + by_name[name]
+        return '\n'.join(text) + '\n'
+
+    def dump_json(self, directory, tool):
+        # Writes <directory>/<tool>_metrics_<timestamp>.json and returns its path
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{tool}_metrics_{datetime.now().strftime('%Y%m%d%H%M%S')}.json")
+        with open(path, 'w') as file:
+            json.dump(self.snapshot(), file, indent=2)
+        return path
+
+
+METRICS = Registry()
@@ -0,0 +1,84 @@
+# Column-wide input normalisation shared by the CAP tools.
+#
+# Dates and mileages are converted for the whole input before any request is
+# scheduled, so the per-row hot path only reads ready-made values.
+import numpy as np
+import pandas as pd
+
+# Date formats seen in the input files, in the order they are tried
+INPUT_DATE_FORMATS = ('%d/%m/%Y', '%Y-%m-%d')
+
+EXCEL_EPOCH = '1899-12-30'  # Excel's epoch starts on January 1, 1900, but there's an off-by-two error
+DATE_SAMPLE_SIZE = 100  # Values checked when inferring a column's date format
+
+
+def infer_date_format(values, formats=INPUT_DATE_FORMATS):
+    # Pick the first format that parses every sampled value; falls back to the first format
+    sample = values.dropna().astype(str).head(DATE_SAMPLE_SIZE)
+    for fmt in formats:
+        if pd.to_datetime(sample, format=fmt, errors='coerce').notna().all():
+            return fmt
+    return formats[0]
+
+
+def normalise_dates(values, formats=INPUT_DATE_FORMATS, excel_serials=False):
+    # Convert a column of dates to datetime64. The column's format is inferred once;
+    # values it does not match are retried with the remaining formats. With
+    # excel_serials, whole numbers such as 44197 are read as Excel day serials.
+    values = pd.Series(values)
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+
+    converted = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+    text = values.where(values.isna(), values.astype(str).str.strip())
+
+    if excel_serials:
+        serials = pd.to_numeric(text, errors='coerce')
+        is_serial = serials.notna() & (serials == serials.round())
+        converted[is_serial] = pd.to_datetime(serials[is_serial], unit='D', origin=EXCEL_EPOCH)
+        text = text.where(~is_serial)
+
+    first = infer_date_format(text, formats)
+    for fmt in (first,) + tuple(fmt for fmt in formats if fmt != first):
+        missing = converted.isna() & text.notna()
+        if not missing.any():
+            break
+        converted[missing] = pd.to_datetime(text[missing], format=fmt, errors='coerce')
+    return converted
+
+
+def format_dates(values, fmt='%Y-%m-%d'):
+    # Format a datetime64 column as strings; missing dates stay missing
+    return values.dt.strftime(fmt).where(values.notna())
+
+
+def unparsed_values(original, converted):
+    # Input values that were present but could not be converted
+    original = pd.Series(original)
+    return original[original.notna() & converted.isna()]
+
+
+def mileage_buckets(mileages, round_to=1000, offset=None, method='trunc'):
+    # Bucket a whole mileage column at once: method((mileage + offset) / round_to) * round_to.
+    # offset defaults to round_to - 1 (always round up). method 'trunc' matches int(),
+    # 'round' matches Python's round(). Non-numeric mileages become <NA>.
+    if offset is None:
+        offset = round_to - 1
+    values = pd.to_numeric(pd.Series(mileages), errors='coerce').to_numpy(dtype=float)
+    rounding = np.round if method == 'round' else np.trunc
+    buckets = rounding((values + offset) / round_to) * round_to
+    return pd.array(buckets, dtype='Int64')
+
+
+def normalise_registrations(values):
+    # Registrations as join keys: upper case without spaces; missing ones stay missing
+    values = pd.Series(values)
+    return values.astype('string').str.upper().str.replace(r'\s+', '', regex=True).replace('', pd.NA)
+
+
+def normalise_ids(values):
+    # Identifiers as join keys, whether they were read as text, integers or floats
+    # (12345, '12345 ' and 12345.0 are all '12345'); missing ones, including the 'nan' of a
+    # column converted with astype(str), stay missing
+    values = pd.Series(values)
+    return values.astype('string').str.strip().str.replace(r'\.0+$', '', regex=True).replace(['', 'nan'], pd.NA)
@@ -0,0 +1,90 @@
+# Command-line options shared by every CAP tool.
+#
+# Each tool adds these to its own parser, so --concurrency, --rate, --cache,
+# --resume, --profile, --trace, --budget, --warm-connections and --warehouse
+# mean the same thing whether the tool is run directly or through the cap command.
+import cProfile
+import os
+import pstats
+from datetime import datetime
+
+from CAP_budget import BUDGET, calls_today, record_usage
+from CAP_cache import CACHE_DIRECTORY
+from CAP_connect import CONNECTIONS, WARM_CONNECTIONS, connection_summary
+from CAP_metrics import METRICS
+from CAP_scheduler import PRIORITY_CLASSES
+from CAP_trace import TRACER
+from CAP_warehouse import WAREHOUSE_DIRECTORY
+
+LATEST = 'latest'  # --resume with no value: continue the most recent run
+PROFILE_LINES = 25  # Functions listed when a profiled run finishes
+
+
+def add_common_arguments(parser, concurrency, priority='lookups'):
+    group = parser.add_argument_group('common options')
+    group.add_argument('--concurrency', type=int, default=concurrency,
+                       help=f"Rows or requests in flight at once, per worker (default: {concurrency})")
+    group.add_argument('--rate', type=float, default=None,
+                       help="Maximum CAP requests per second, shared with other runs by priority (default: unlimited)")
+    group.add_argument('--priority', choices=PRIORITY_CLASSES, default=priority,
+                       help="Priority class for a share of --rate when runs overlap"
+                            + (" (default: %(default)s)" if priority else ""))
+    group.add_argument('--warm-connections', type=int, default=WARM_CONNECTIONS, metavar='N',
+                       help="Connections to CAP to open while the input is read, 0 for none (default: %(default)s)")
+    group.add_argument('--cache', metavar='DIR', default=CACHE_DIRECTORY,
+                       help="Directory of the persistent lookup cache, for tools that keep one (default: %(default)s)")
+    group.add_argument('--warehouse', metavar='DIR', default=WAREHOUSE_DIRECTORY,
+                       help="Valuation warehouse the run's results are added to (default: %(default)s)")
+    group.add_argument('--no-warehouse', dest='warehouse', action='store_const', const=None,
+                       help="Don't add the run's results to the valuation warehouse")
+    group.add_argument('--resume', nargs='?', const=LATEST, metavar='RUN',
+                       help="Continue a previous run instead of starting a new one (default: the latest)")
+    group.add_argument('--profile', action='store_true',
+                       help="Profile the run and write the statistics to the tool's Logs folder")
+    group.add_argument('--trace', action='store_true',
+                       help="Record per-row phase spans and write a Chrome trace to the tool's Logs folder")
+    group.add_argument('--budget', type=int, metavar='CALLS',
+                       help="Daily CAP call budget across every run; no new rows are started once it is spent")
+    group.add_argument('--soft-budget', action='store_true',
+                       help="Only warn when --budget is passed instead of stopping")
+    return group
+
+
+def run_tool(args, logs_directory, tool, func, *func_args):
+    # Runs func(*func_args), under cProfile when --profile was given and traced when
+    # --trace was given, within the --budget call budget. However the run ends, its
+    # metrics (CAP_metrics) and trace (CAP_trace) are written to the Logs folder and
+    # its calls are added to the daily usage totals (CAP_budget). The warm connection
+    # pool (CAP_connect), if the tool started one, is closed.
+    METRICS.tool = tool
+    run_id = METRICS.run_id = datetime.now().strftime('%Y%m%d%H%M%S')
+    if args.budget:
+        BUDGET.configure(args.budget, not args.soft_budget, calls_today())
+    if args.trace:
+        TRACER.enable()
+    try:
+        if not args.profile:
+            return func(*func_args)
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return func(*func_args)
+        finally:
+            profiler.disable()
+            os.makedirs(logs_directory, exist_ok=True)
+            path = os.path.join(logs_directory, f"{tool}_profile_{datetime.now().strftime('%Y%m%d%H%M%S')}.prof")
+            profiler.dump_stats(path)
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(PROFILE_LINES)
+            print(f"Profile written to {path}")
+    finally:
+        CONNECTIONS.close()
+        print(record_usage(tool, run_id, METRICS))
+        summary = connection_summary(METRICS)
+        if summary:
+            print(summary)
+        if BUDGET.exhausted:
+            print(f"Stopped starting new rows at the daily budget of {BUDGET.limit} CAP calls; "
+                  f"run again tomorrow or with a larger --budget for the rest")
+        print(f"Metrics written to {METRICS.dump_json(logs_directory, tool)}")
+        if args.trace:
+            print(f"Trace written to {TRACER.export(logs_directory, tool)}")
@@ -0,0 +1,320 @@
+# Output sinks shared by the CAP tools.
+#
+# Tools hand every finished row to a RowSinks object holding only the real
+# columns, as a compact Row (see row_type) or a dict. The Parquet sink stores
+# those columns typed and compressed; the legacy CSV view pads the same rows out
+# to the spreadsheet layout (Unused1...) at write time.
+import asyncio
+import csv
+import logging
+import os
+import re
+
+import pandas as pd
+
+from CAP_budget import BUDGET
+from CAP_metrics import METRICS
+from CAP_trace import TRACER
+
+# Formats written by default: the Parquet file plus the legacy padded CSV
+OUTPUT_FORMATS = ('parquet', 'csv')
+
+# Date formats CAP tools write into their rows
+DATE_FORMATS = ('%d/%m/%Y', '%Y-%m-%d')
+
+PARQUET_BATCH_SIZE = 1000  # Rows buffered per Parquet row group
+PARQUET_COMPRESSION = 'zstd'
+
+REORDER_BUFFER_SIZE = 1000  # Finished rows held back at most while waiting for an earlier row
+FLUSH_EVERY = 100  # Rows written between flushes of the CSV file, so partial results reach disk during a run
+
+
+class Row:
+    # Base of the row types made by row_type(). Values live in __slots__, one per column,
+    # so a row costs one small object instead of a dict of its own; with 100k+ rows
+    # buffered or in flight that is most of a tool's memory (see CAP_benchmark.py).
+    # get() and [] take column names, so sinks read rows and dicts alike.
+    __slots__ = ()
+    fields = ()  # Column names, in order
+    slot_names = {}  # Column name -> attribute
+
+    def __init__(self, *values, **named):
+        if len(values) > len(self.__slots__):
+            raise TypeError(f"{type(self).__name__} takes {len(self.__slots__)} values, got {len(values)}")
+        for slot, value in zip(self.__slots__, values):
+            setattr(self, slot, value)
+        for slot in self.__slots__[len(values):]:
+            setattr(self, slot, named.pop(slot, None))
+        if named:
+            raise TypeError(f"{type(self).__name__} has no column {', '.join(named)}")
+
+    def get(self, field, default=None):
+        slot = self.slot_names.get(field)
+        return default if slot is None else getattr(self, slot)
+
+    def __getitem__(self, field):
+        slot = self.slot_names.get(field)
+        if slot is None:
+            raise KeyError(field)
+        return getattr(self, slot)
+
+    def __setitem__(self, field, value):
+        slot = self.slot_names.get(field)
+        if slot is None:
+            raise KeyError(field)
+        setattr(self, slot, value)
+
+    def values(self):
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def to_dict(self):
+        return dict(zip(self.fields, self.values()))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.values() == other.values()
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(f'{slot}={value!r}' for slot, value in zip(self.__slots__, self.values()))})"
+
+
+def row_type(name, fields):
+    # A Row class for the given columns. Column names that aren't identifiers ('CAP ID')
+    # get an attribute with the other characters replaced by '_'. The class is kept in
+    # this module under its name, so rows pickle by reference between shard workers and
+    # the parent; each tool makes its row types at import, in every process.
+    slots = tuple(re.sub(r'\W', '_', field) for field in fields)
+    cls = type(name, (Row,), {
+        '__slots__': slots, '__module__': __name__, 'fields': tuple(fields), 'slot_names': dict(zip(fields, slots)),
+    })
+    globals()[name] = cls
+    return cls
+
+
+def frame_rows(df, cls):
+    # (index, row) pairs for a DataFrame, keeping only cls's columns; a light stand-in for iterrows()
+    return zip(df.index, (cls(*values) for values in df[list(cls.fields)].itertuples(index=False, name=None)))
+
+
+def to_numbers(values):
+    # 'Not Found', 'n/a' and blanks become nulls
+    return pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').astype('Int64')
+
+
+def to_dates(values):
+    values = pd.Series(values, dtype=object)
+    converted = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+    for fmt in DATE_FORMATS:
+        missing = converted.isna()
+        if not missing.any():
+            break
+        converted[missing] = pd.to_datetime(values[missing], format=fmt, errors='coerce')
+    return converted.dt.date
+
+
+class ParquetSink:
+    # Writes rows to a Parquet file in row groups of PARQUET_BATCH_SIZE rows; flush() leaves
+    # a part-filled group buffered, so periodic flushes don't fragment the file.
+    # columns is a list of (name, type) pairs with type 'string', 'int' or 'date'.
+    def __init__(self, path, columns, batch_size=PARQUET_BATCH_SIZE):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.path = path
+        self.columns = columns
+        self.batch_size = batch_size
+        self.buffer = []
+        arrow_types = {'string': pa.string(), 'int': pa.int64(), 'date': pa.date32()}
+        self.schema = pa.schema([(name, arrow_types[kind]) for name, kind in columns])
+        self.writer = pq.ParquetWriter(path, self.schema, compression=PARQUET_COMPRESSION)
+        self._pa = pa
+
+    def write(self, row):
+        self.buffer.append(row)
+        if len(self.buffer) >= self.batch_size:
+            self.write_group()
+
+    def flush(self):
+        pass
+
+    def write_group(self):
+        if not self.buffer:
+            return
+        data = {}
+        for name, kind in self.columns:
+            values = [row.get(name) for row in self.buffer]
+            if kind == 'int':
+                data[name] = to_numbers(values)
+            elif kind == 'date':
+                data[name] = to_dates(values)
+            else:
+                data[name] = pd.Series([None if value is None else str(value) for value in values], dtype=object)
+        table = self._pa.Table.from_pandas(pd.DataFrame(data), schema=self.schema, preserve_index=False)
+        self.writer.write_table(table)
+        self.buffer.clear()
+
+    def close(self):
+        self.write_group()
+        self.writer.close()
+
+
+class LegacyCSVView:
+    # Writes rows in the padded spreadsheet layout; columns missing from a row are left blank
+    def __init__(self, path, header):
+        self.path = path
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.DictWriter(self.file, fieldnames=header, restval='', extrasaction='ignore')
+        self.writer.writeheader()
+
+    def write(self, row):
+        self.writer.writerow(row)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class MemorySink:
+    # Collects rows in a list; used by shard workers that hand their rows back to the parent
+    path = None
+
+    def __init__(self):
+        self.rows = []
+
+    def write(self, row):
+        self.rows.append(row)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class RowSinks:
+    # Sends the same row stream to every configured output
+    def __init__(self, sinks):
+        self.sinks = sinks
+        self.rows_written = 0
+
+    @property
+    def paths(self):
+        return [sink.path for sink in self.sinks if sink.path is not None]
+
+    def write(self, row):
+        for sink in self.sinks:
+            sink.write(row)
+        self.rows_written += 1
+        METRICS.row()
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def open_output(base_path, columns, legacy_header, formats=OUTPUT_FORMATS, warehouse=None):
+    # base_path is the output path without an extension, e.g. Outputs/CAP_VRM_Output_20240207_080444.
+    # warehouse, a CAP_warehouse.WarehouseSink, also gets every row when given.
+    os.makedirs(os.path.dirname(base_path) or '.', exist_ok=True)
+    sinks = []
+    if 'parquet' in formats:
+        try:
+            sinks.append(ParquetSink(f'{base_path}.parquet', columns))
+        except ImportError:
+            print("pyarrow is not installed; writing the CSV output only.")
+            formats = tuple(formats) + ('csv',)
+    if 'csv' in formats:
+        sinks.append(LegacyCSVView(f'{base_path}.csv', legacy_header))
+    if not sinks:
+        raise ValueError(f"No supported output format in {formats}")
+    if warehouse is not None:
+        sinks.append(warehouse)
+    return RowSinks(sinks)
+
+
+class OrderedRowWriter:
+    # Streams finished rows into an output. When ordered, rows are released in input
+    # order through a reorder buffer; a row finishing more than max_pending positions
+    # ahead of the oldest unfinished row waits, so memory stays flat. put(position, None)
+    # marks a skipped row.
+    def __init__(self, output, ordered=True, max_pending=REORDER_BUFFER_SIZE, flush_every=FLUSH_EVERY):
+        self.output = output
+        self.ordered = ordered
+        self.max_pending = max_pending
+        self.flush_every = flush_every
+        self.pending = {}
+        self.next_position = 0
+        self.rows_written = 0
+        self.since_flush = 0
+        self.condition = asyncio.Condition()
+
+    async def put(self, position, row):
+        if not self.ordered:
+            self._write(row)
+            return
+        async with self.condition:
+            await self.condition.wait_for(lambda: position - self.next_position < self.max_pending)
+            self.pending[position] = row
+            if self.next_position in self.pending:
+                while self.next_position in self.pending:
+                    self._write(self.pending.pop(self.next_position))
+                    self.next_position += 1
+                self.condition.notify_all()
+
+    def _write(self, row):
+        if row is None:
+            return
+        self.output.write(row)
+        self.rows_written += 1
+        self.since_flush += 1
+        if self.since_flush >= self.flush_every:
+            self.output.flush()
+            self.since_flush = 0
+
+    def finish(self):
+        self.output.flush()
+
+
+async def write_rows(rows, process, output, concurrency, ordered=True, progress=None):
+    # Run process(row) over rows with a fixed pool of workers and stream each result into
+    # output as soon as it can be written. process returns an output row, or None to skip.
+    # progress() is called once per finished row. Returns the number of rows written.
+    # Once the daily call budget is spent no new rows are started (BUDGET.stopped is set).
+    # A row whose process() raises is logged, counted and skipped; the others carry on.
+    writer = OrderedRowWriter(output, ordered, max(REORDER_BUFFER_SIZE, concurrency))
+    queue = iter(enumerate(rows))
+
+    async def worker():
+        for position, row in queue:
+            if BUDGET.exhausted:
+                BUDGET.stop()
+                await writer.put(position, None)  # Already taken; release it so later rows are written
+                return
+            with TRACER.row('row', row=position):
+                try:
+                    result = await process(row)
+                except Exception as exc:
+                    logging.error(f"Row {position} skipped: {exc!r}", exc_info=True)
+                    METRICS.inc('cap_row_failures_total', tool=METRICS.tool or 'unknown')
+                    result = None
+                with TRACER.span('write'):
+                    await writer.put(position, result)
+            if progress is not None:
+                progress()
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    finally:
+        writer.finish()  # Rows already written reach disk even when the run is cancelled
+    return writer.rows_written
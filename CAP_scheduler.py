@@ -0,0 +1,236 @@
+# Priority-aware sharing of the CAP request rate.
+#
+# Requests belong to a priority class: interactive (the valuation service), stock
+# (the morning CAP_Stock refresh), lookups (VRM, CAPID and Sales runs) and
+# backfill (Sales --backfill). Each class has a weight, and capacity is shared by
+# weighted fair queuing, so bulk jobs soak up whatever the urgent ones leave
+# spare but never hold them up. Backfill only ever gets what the other classes
+# leave: it has no weighted claim against them.
+#
+# Between runs: every run with a --rate registers in Runs/scheduler.sqlite while
+# it is making requests, with its class and how much of its allowance it used.
+# --rate is then the account-wide limit and each run's RateLimiter spaces its
+# requests at the run's fair share of it. Runs using less than their share keep
+# what they use and the rest is split among the others by weight, so a backfill
+# runs at the full rate until a stock run starts and drops back as soon as it
+# does (to MIN_FRACTION while the stock run takes the whole rate). The table is
+# read and written by a heartbeat thread, never on the caller's event loop.
+#
+# Within a process: FairScheduler hands out request slots in weighted fair order,
+# so the service's interactive lookups overtake batch and backfill requests
+# queued behind the same rate limit.
+import asyncio
+import atexit
+import heapq
+import itertools
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+
+from CAP_ledger import LEDGER_DIRECTORY
+
+# Priority class -> weight, highest priority first
+PRIORITY_CLASSES = {'interactive': 16, 'stock': 8, 'lookups': 2, 'backfill': 1}
+BACKGROUND_CLASSES = ('backfill',)  # Given only the rate the other classes leave
+
+HEARTBEAT_SECONDS = 2.0  # How often a run reports its use and recomputes its share
+STALE_SECONDS = 10.0  # Runs silent for longer have stopped making requests
+SATURATED = 0.9  # A run using this much of its share is taken to want more
+HEADROOM = 1.25  # A run below that keeps this much above its use, so growth shows up
+MIN_FRACTION = 0.05  # Least share of the rate any run is left with, so its next request is not stranded
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS active_runs (
+    run_key TEXT PRIMARY KEY,
+    priority TEXT,
+    weight REAL,
+    demand REAL,
+    heartbeat REAL
+)
+"""
+
+
+def fair_shares(total, runs):
+    # Split of total requests/second. runs is {key: (priority, weight, demand)}, demand None
+    # meaning "as much as it can get". Background runs share what the others leave.
+    foreground = {key: (weight, demand) for key, (priority, weight, demand) in runs.items()
+                  if priority not in BACKGROUND_CLASSES}
+    background = {key: (weight, demand) for key, (priority, weight, demand) in runs.items()
+                  if priority in BACKGROUND_CLASSES}
+    shares = weighted_shares(total, foreground)
+    shares.update(weighted_shares(max(total - sum(shares.values()), 0.0), background))
+    return shares
+
+
+def weighted_shares(total, runs):
+    # Weighted max-min fair split of total requests/second. runs is {key: (weight, demand)}.
+    # Runs wanting less than their weighted share get what they want; what they leave is
+    # split among the rest by weight.
+    shares = {}
+    remaining = total
+    active = dict(runs)
+    while active:
+        per_weight = remaining / sum(weight for weight, _ in active.values())
+        satisfied = {key: demand for key, (weight, demand) in active.items()
+                     if demand is not None and demand <= weight * per_weight}
+        if not satisfied:
+            shares.update({key: weight * per_weight for key, (weight, _) in active.items()})
+            break
+        for key, demand in satisfied.items():
+            shares[key] = demand
+            remaining -= demand
+            del active[key]
+    return shares
+
+
+class RateShare:
+    # This run's fair share of the --rate limit among the runs making requests at the same
+    # time. The share and the run's call count live in shared memory, so the run's worker
+    # processes count towards one entry.
+    def __init__(self, priority, directory=LEDGER_DIRECTORY):
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"Unknown priority '{priority}', expected one of {tuple(PRIORITY_CLASSES)}")
+        context = multiprocessing.get_context('spawn')
+        self.priority = priority
+        self.weight = PRIORITY_CLASSES[priority]
+        self.path = os.path.join(directory, 'scheduler.sqlite')
+        self.run_key = f'{os.getpid()}-{time.time():.0f}'
+        self.fraction = context.Value('d', 1.0)  # Share of the total rate
+        self.calls = context.Value('q', 0)
+        self.last_refresh = context.Value('d', 0.0)
+        self.calls_at_refresh = context.Value('q', 0)
+        self.heartbeat = None  # This process's heartbeat thread, started by the first rate()
+        self.stopped = threading.Event()
+        atexit.register(self.close)  # Leave the table as soon as the run ends
+
+    def __getstate__(self):
+        # Worker processes get the shared values and start heartbeats of their own
+        state = self.__dict__.copy()
+        del state['heartbeat'], state['stopped']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.heartbeat = None
+        self.stopped = threading.Event()
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute(SCHEMA)
+        return connection
+
+    def rate(self, total):
+        # Requests/second this run may make now; called once per request, on the event loop,
+        # so it only counts the call and reads the share the heartbeat last worked out
+        with self.calls.get_lock():
+            self.calls.value += 1
+        if self.heartbeat is None:
+            self.heartbeat = threading.Thread(target=self.beat, args=(total,), daemon=True)
+            self.heartbeat.start()
+        return total * self.fraction.value
+
+    def beat(self, total):
+        # Refreshes the share every HEARTBEAT_SECONDS while the run is making requests; a run
+        # that stops goes stale and leaves its share to the others. The first refresh is at once.
+        while True:
+            if self.calls.value != self.calls_at_refresh.value:
+                self.refresh(total)
+            if self.stopped.wait(HEARTBEAT_SECONDS):
+                return
+
+    def refresh(self, total, now=None):
+        now = now or time.time()
+        with self.last_refresh.get_lock():
+            elapsed = now - self.last_refresh.value
+            if elapsed < HEARTBEAT_SECONDS:
+                return  # Another worker of this run refreshed meanwhile
+            self.last_refresh.value = now
+            used = (self.calls.value - self.calls_at_refresh.value) / elapsed if elapsed < STALE_SECONDS else None
+            self.calls_at_refresh.value = self.calls.value
+        # Only a run visibly leaving part of its share unused is held to (a little over) what it uses
+        allowed = total * self.fraction.value
+        demand = used * HEADROOM if used is not None and used < SATURATED * allowed else None
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute("INSERT OR REPLACE INTO active_runs VALUES (?, ?, ?, ?, ?)",
+                                   (self.run_key, self.priority, self.weight, demand, now))
+                connection.execute("DELETE FROM active_runs WHERE heartbeat < ?", (now - STALE_SECONDS,))
+                runs = {key: (priority, weight, demand) for key, priority, weight, demand in
+                        connection.execute("SELECT run_key, priority, weight, demand FROM active_runs")}
+        finally:
+            connection.close()
+        shares = fair_shares(total, runs)
+        self.fraction.value = max(shares[self.run_key] / total, MIN_FRACTION)
+
+    def close(self):
+        self.stopped.set()
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute("DELETE FROM active_runs WHERE run_key = ?", (self.run_key,))
+        finally:
+            connection.close()
+
+
+class FairScheduler:
+    # At most `concurrency` requests in flight, with waiting requests admitted in weighted
+    # fair order (self-clocked fair queuing): each is tagged with a virtual finish time of
+    # its class's previous tag plus 1/weight, and the smallest tag goes next.
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.in_flight = 0
+        self.waiting = []  # (finish tag, sequence, future)
+        self.virtual_time = 0.0
+        self.last_finish = {}
+        self.sequence = itertools.count()
+
+    def _tag(self, priority):
+        start = max(self.virtual_time, self.last_finish.get(priority, 0.0))
+        finish = self.last_finish[priority] = start + 1.0 / PRIORITY_CLASSES[priority]
+        return finish
+
+    async def acquire(self, priority):
+        finish = self._tag(priority)
+        if self.in_flight < self.concurrency and not self.waiting:
+            self.in_flight += 1
+            self.virtual_time = finish
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (finish, next(self.sequence), future))
+        try:
+            await future  # The slot is handed over by release()
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()  # Handed a slot just as the wait was cancelled
+            raise
+
+    def release(self):
+        while self.waiting:
+            finish, _, future = heapq.heappop(self.waiting)
+            if not future.done():
+                self.virtual_time = finish
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def slot(self, priority):
+        return FairSlot(self, priority)
+
+
+class FairSlot:
+    # async with scheduler.slot('interactive'): ... one request
+    def __init__(self, scheduler, priority):
+        self.scheduler = scheduler
+        self.priority = priority
+
+    async def __aenter__(self):
+        await self.scheduler.acquire(self.priority)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.scheduler.release()
+        return False
@@ -0,0 +1,337 @@
+# Local CAP valuation service.
+#
+# A small HTTP server for ad-hoc valuations (e.g. from Excel's WEBSERVICE or
+# Power Query) without editing an input file and running a whole batch. Every
+# caller shares one warm connection pool, one rate limiter, the persistent capid
+# metadata cache and a SingleFlight, so repeat lookups are answered from memory
+# and identical lookups in flight at the same time cost one CAP call. The pool is
+# kept at --warm-connections open connections between callers (CAP_connect), so
+# a lookup after a quiet spell does not wait on a TLS handshake.
+#
+#   GET  /valuation?capid=&regdate=&mileage=[&date=]   live clean/retail values
+#   GET  /vrm?vrm=&mileage=                            VRMValuation: capid, derivative, monthly values
+#   GET  /capid?capid=&regdate=&mileage=               derivative metadata
+#   POST /batch    JSON lines in, JSON lines out in the same order; each line names
+#                  its "endpoint" (valuation, vrm or capid) plus that endpoint's fields
+#   GET  /metrics  request latency, cache and throughput metrics in Prometheus text format
+#
+# Mileages are bucketed the way the batch tools do it, so answers match their output.
+# Single lookups are 'interactive' and /batch lines 'lookups' (see CAP_scheduler);
+# either can name another class in a 'priority' field. Requests waiting for a
+# slot are let through in weighted fair order, so a caller at a spreadsheet is
+# not kept behind a large batch.
+#
+# The service's CAP calls are added to Runs/usage.sqlite every USAGE_FLUSH_SECONDS
+# rather than only when it stops (CAP_budget), and the daily budget takes in what
+# batch runs have recorded meanwhile.
+import argparse
+import asyncio
+import contextvars
+import functools
+import json
+import os
+import xml.etree.ElementTree as ET
+from datetime import date, datetime
+
+import aiohttp
+from aiohttp import web
+
+from CAP_archive import endpoint_name
+from CAP_budget import BUDGET, calls_today, record_usage
+from CAP_cache import CACHE_DIRECTORY, CACHE_FILENAME, CapidMetadataStore, SingleFlight, parse_capid_metadata
+from CAP_calendar import period_key
+from CAP_config import PASSWORD, SUBSCRIBER_ID
+from CAP_connect import WARM_CONNECTIONS, keep_warm, open_session
+from CAP_metrics import METRICS, Registry
+from CAP_normalise import mileage_buckets
+from CAP_options import add_common_arguments, run_tool
+from CAP_scheduler import PRIORITY_CLASSES, FairScheduler
+from CAP_shard import RateLimiter
+
+LIVE_URL = 'https://soap.cap.co.uk/usedvalueslive/capusedvalueslive.asmx/GetUsedLive_IdRegDateMileage'
+CAPID_URL = 'https://soap.cap.co.uk/vrm/capvrm.asmx/CAPIDValuation'
+VRM_URL = 'https://soap.cap.co.uk/vrm/capvrm.asmx/VRMValuation'
+HEADERS = {'Content-Type': 'application/x-www-form-urlencoded'}
+DATABASE = 'CAR'
+NAMESPACE_VRM = {'ns': 'https://soap.cap.co.uk/vrm'}
+NAMESPACE_USEDVALUESLIVE = {'ns': 'https://soap.cap.co.uk/usedvalueslive'}
+
+DEFAULT_HOST = '127.0.0.1'  # Local callers only
+DEFAULT_PORT = 8050
+CONCURRENCY = 20  # CAP requests in flight at once, across all callers
+CACHE_ENTRIES = 100_000  # Answers kept for repeat lookups, least recently used dropped first
+CACHE_SECONDS = 6 * 3600  # How long an answer is kept before CAP is asked again
+USAGE_FLUSH_SECONDS = 60  # How often the service's calls are recorded in the usage database
+LOGS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Logs')  # --profile output
+
+# Priority class of the lookup the current task is answering
+CALLER_PRIORITY = contextvars.ContextVar('CAP_service_priority', default='interactive')
+
+
+class BadRequest(Exception):
+    pass
+
+
+class NotFound(Exception):
+    pass
+
+
+class UpstreamError(Exception):
+    pass
+
+
+class BudgetSpent(Exception):
+    pass
+
+
+def required(params, name):
+    value = params.get(name)
+    if value is None or str(value).strip() == '':
+        raise BadRequest(f"Missing '{name}'")
+    return str(value).strip()
+
+
+def whole_number(params, name):
+    try:
+        return int(float(required(params, name)))
+    except (ValueError, OverflowError):  # OverflowError: 'inf'
+        raise BadRequest(f"'{name}' must be a number")
+
+
+def iso_date(params, name, default=None):
+    value = params.get(name) or default
+    if value is None:
+        raise BadRequest(f"Missing '{name}'")
+    for fmt in ('%Y-%m-%d', '%d/%m/%Y'):
+        try:
+            return datetime.strptime(str(value).strip()[:10], fmt).strftime('%Y-%m-%d')
+        except ValueError:
+            pass
+    raise BadRequest(f"'{name}' must be a date (YYYY-MM-DD or DD/MM/YYYY)")
+
+
+def priority_class(params, default):
+    priority = str(params.pop('priority', None) or default).strip().lower()
+    if priority not in PRIORITY_CLASSES:
+        raise BadRequest(f"'priority' must be one of {', '.join(PRIORITY_CLASSES)}")
+    return priority
+
+
+def element_text(root, path, namespace):
+    element = root.find(path, namespace)
+    return element.text if element is not None else None
+
+
+class ValuationService:
+    def __init__(self, rate=None, concurrency=CONCURRENCY, cache_directory=CACHE_DIRECTORY, priority='interactive',
+                 warm_connections=WARM_CONNECTIONS):
+        self.rate_limiter = RateLimiter(rate, priority)
+        self.concurrency = concurrency
+        self.warm_connections = min(warm_connections, concurrency)
+        self.metadata_store = CapidMetadataStore(DATABASE, os.path.join(cache_directory, CACHE_FILENAME))
+        self.calls = SingleFlight('service', CACHE_ENTRIES, CACHE_SECONDS)
+        self.session = None
+        self.scheduler = None
+        self.warming = None
+        self.flushing = None
+
+    async def start(self, app):
+        # One connection pool for the life of the service, kept warm between callers
+        self.session = open_session(limit=self.concurrency)
+        self.scheduler = FairScheduler(self.concurrency)
+        self.warming = asyncio.create_task(keep_warm(self.session, LIVE_URL, self.warm_connections))
+        self.flushing = asyncio.create_task(self.flush_usage())
+
+    async def stop(self, app):
+        self.warming.cancel()
+        self.flushing.cancel()
+        await self.session.close()
+        self.metadata_store.close()
+
+    async def flush_usage(self):
+        # Records the calls made so far and refreshes the budget from the usage database
+        while True:
+            await asyncio.sleep(USAGE_FLUSH_SECONDS)
+            counters = Registry(METRICS.tool)
+            counters.counters = dict(METRICS.counters)  # Copied here; lookups keep counting meanwhile
+            await asyncio.to_thread(record_usage, METRICS.tool, METRICS.run_id, counters)
+            if BUDGET.used is not None:
+                BUDGET.sync(await asyncio.to_thread(calls_today))
+
+    async def post(self, url, payload):
+        # Lookups already cached are still answered once the daily call budget is spent
+        if BUDGET.exhausted:
+            raise BudgetSpent(f"The daily budget of {BUDGET.limit} CAP calls is spent")
+        async with self.scheduler.slot(CALLER_PRIORITY.get()):
+            await self.rate_limiter.wait()
+            with METRICS.request(url) as call:
+                async with self.session.post(url, headers=HEADERS, data=payload) as response:
+                    call.status = response.status
+                    text = await response.text()
+            if response.status != 200:
+                raise UpstreamError(f"{endpoint_name(url)} returned status {response.status}")
+            return text
+
+    async def valuation(self, params):
+        capid = whole_number(params, 'capid')
+        reg_date = iso_date(params, 'regdate')
+        mileage = int(mileage_buckets([whole_number(params, 'mileage')])[0])  # Round up to the nearest 1000
+        valuation_date = iso_date(params, 'date', datetime.now().strftime('%Y-%m-%d'))
+        period = period_key(valuation_date)  # Dates in the same CAP publication period share a call
+
+        async def fetch():
+            text = await self.post(LIVE_URL, {
+                'subscriberId': SUBSCRIBER_ID, 'password': PASSWORD, 'database': DATABASE, 'capid': capid,
+                'valuationDate': valuation_date, 'regDate': reg_date, 'mileage': mileage,
+            })
+            root = ET.fromstring(text)
+            if root.find('.//ns:Valuation', NAMESPACE_USEDVALUESLIVE) is None:
+                return None
+            return {
+                'capid': capid, 'regdate': reg_date, 'mileage': mileage, 'period': period,
+                'valuation_date': element_text(root, './/ns:ValuationDate/ns:Date', NAMESPACE_USEDVALUESLIVE),
+                'clean': element_text(root, './/ns:Valuation/ns:Clean', NAMESPACE_USEDVALUESLIVE),
+                'retail': element_text(root, './/ns:Valuation/ns:Retail', NAMESPACE_USEDVALUESLIVE),
+            }
+
+        result = await self.calls.do(('valuation', capid, reg_date, mileage, period), fetch)
+        if result is None:
+            raise NotFound(f"No valuation for CAPID {capid} at {mileage} miles")
+        return result
+
+    async def vrm(self, params):
+        vrm = required(params, 'vrm').upper().replace(' ', '')
+        mileage = int(mileage_buckets([whole_number(params, 'mileage')], offset=500, method='round')[0])  # Nearest 1000
+
+        async def fetch():
+            text = await self.post(VRM_URL, {
+                'SubscriberID': SUBSCRIBER_ID, 'Password': PASSWORD, 'VRM': vrm, 'Mileage': mileage,
+                'StandardEquipmentRequired': 'false',
+            })
+            root = ET.fromstring(text)
+            if root.find('.//ns:VRMLookup', NAMESPACE_VRM) is None:
+                return None
+            result = {'vrm': vrm, 'mileage': mileage}
+            for field in ('Database', 'CAPID', 'CAPMan', 'CAPRange', 'CAPMod', 'CAPDer', 'RegisteredDate'):
+                result[field] = element_text(root, f'.//ns:VRMLookup/ns:{field}', NAMESPACE_VRM)
+            result['clean'] = element_text(root, './/ns:Valuation/ns:Clean', NAMESPACE_VRM)
+            result['retail'] = element_text(root, './/ns:Valuation/ns:Retail', NAMESPACE_VRM)
+            return result
+
+        # VRMValuation values at today's date, so the answer is kept for the current period only
+        result = await self.calls.do(('vrm', vrm, mileage, period_key(date.today())), fetch)
+        if result is None:
+            raise NotFound(f"No CAP lookup for VRM {vrm}")
+        return result
+
+    async def capid(self, params):
+        capid = whole_number(params, 'capid')
+        reg_date = iso_date(params, 'regdate')
+        mileage = int(mileage_buckets([whole_number(params, 'mileage')])[0])  # Round up to the nearest 1000
+
+        async def fetch():
+            # Metadata never changes for a capid, so the persistent cache answers most calls
+            self.metadata_store.load([capid])
+            metadata = self.metadata_store.get(capid)
+            if metadata is None:
+                metadata = parse_capid_metadata(await self.post(CAPID_URL, {
+                    'SubscriberID': SUBSCRIBER_ID, 'Password': PASSWORD, 'Database': DATABASE, 'CAPID': capid,
+                    'RegisteredDate': reg_date, 'Mileage': mileage, 'StandardEquipmentRequired': False,
+                }))
+                if metadata is not None:
+                    self.metadata_store.put(capid, metadata)
+                    self.metadata_store.flush()
+            return metadata
+
+        metadata = await self.calls.do(('capid', capid), fetch)
+        if metadata is None:
+            raise NotFound(f"No CAP lookup for CAPID {capid}")
+        return {'capid': capid, **metadata}
+
+    async def answer(self, endpoint, params, priority='interactive'):
+        # (status, body) for one lookup; errors become a JSON body with an 'error' field
+        handler = {'valuation': self.valuation, 'vrm': self.vrm, 'capid': self.capid}.get(endpoint)
+        try:
+            if handler is None:
+                raise BadRequest(f"Unknown endpoint '{endpoint}'")
+            CALLER_PRIORITY.set(priority_class(params, priority))  # Each handler runs in a task of its own
+            result = await handler(params)
+            METRICS.row()
+            return 200, result
+        except BadRequest as e:
+            return 400, {'error': str(e)}
+        except NotFound as e:
+            return 404, {'error': str(e)}
+        except BudgetSpent as e:
+            return 429, {'error': str(e)}
+        except (UpstreamError, aiohttp.ClientError, asyncio.TimeoutError, ET.ParseError) as e:
+            return 502, {'error': str(e) or type(e).__name__}
+
+    def single(self, endpoint):
+        async def handle(request):
+            params = dict(request.query)
+            if request.method == 'POST':
+                if request.content_type == 'application/json':
+                    try:
+                        body = await request.json()
+                    except json.JSONDecodeError:
+                        return web.json_response({'error': 'Body is not valid JSON'}, status=400)
+                    if not isinstance(body, dict):
+                        return web.json_response({'error': 'Body must be a JSON object'}, status=400)
+                else:
+                    body = await request.post()
+                params.update(body)
+            status, body = await self.answer(endpoint, params)
+            return web.json_response(body, status=status)
+        return handle
+
+    async def batch(self, request):
+        # Every line is looked up at once; misses share upstream calls through the SingleFlight
+        lines = [line for line in (await request.text()).splitlines() if line.strip()]
+
+        async def answer_line(line):
+            try:
+                params = json.loads(line)
+            except json.JSONDecodeError:
+                return 400, {'error': 'Line is not valid JSON'}
+            if not isinstance(params, dict):
+                return 400, {'error': 'Line must be a JSON object'}
+            return await self.answer(params.pop('endpoint', None), params, 'lookups')
+
+        answers = await asyncio.gather(*(answer_line(line) for line in lines))
+        body = ''.join(json.dumps({'line': number, 'status': status, **result}) + '\n'
+                       for number, (status, result) in enumerate(answers, 1))
+        return web.Response(text=body, content_type='application/x-ndjson')
+
+    async def metrics(self, request):
+        return web.Response(text=METRICS.to_prometheus(), content_type='text/plain')
+
+
+def make_app(service):
+    app = web.Application()
+    app.on_startup.append(service.start)
+    app.on_cleanup.append(service.stop)
+    for endpoint in ('valuation', 'vrm', 'capid'):
+        app.router.add_get(f'/{endpoint}', service.single(endpoint))
+        app.router.add_post(f'/{endpoint}', service.single(endpoint))
+    app.router.add_post('/batch', service.batch)
+    app.router.add_get('/metrics', service.metrics)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve CAP valuations over HTTP on this machine")
+    parser.add_argument('--host', default=DEFAULT_HOST, help="Address to listen on (default: %(default)s)")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="Port to listen on (default: %(default)s)")
+    add_common_arguments(parser, CONCURRENCY, priority='interactive')
+    args = parser.parse_args()
+    if args.resume:
+        parser.error("--resume is not supported: the service keeps no run to continue")
+    service = ValuationService(args.rate, args.concurrency, args.cache, args.priority, args.warm_connections)
+    print(f"CAP valuation service on http://{args.host}:{args.port}/ (Ctrl+C to stop)")
+    serve = functools.partial(web.run_app, host=args.host, port=args.port, print=None)
+    run_tool(args, LOGS_DIRECTORY, 'CAP_service', serve, make_app(service))
+
+
+if __name__ == '__main__':
+    main()
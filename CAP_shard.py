@@ -0,0 +1,106 @@
+# Multi-process sharded execution shared by the CAP lookup tools.
+#
+# The input is split into shards, each shard runs in its own process with its
+# own event loop, and every process draws requests from one RateLimiter held in
+# shared memory. Shards return (input_index, row) pairs which are merged back
+# into input order.
+import asyncio
+import heapq
+import multiprocessing
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from CAP_budget import BUDGET
+from CAP_metrics import METRICS
+from CAP_scheduler import RateShare
+from CAP_trace import TRACER
+
+SHARD_MODES = ('range', 'hash')
+
+# Processes are always spawned so behaviour matches Windows everywhere; shared
+# objects must come from the same context as the processes using them
+SPAWN_CONTEXT = multiprocessing.get_context('spawn')
+
+
+class RateLimiter:
+    # Spaces requests evenly at `rate` requests per second. The next free slot is
+    # kept in shared memory, so one limiter handed to several worker processes
+    # enforces a single global rate. A rate of None or 0 means unlimited. Given a
+    # priority class, the rate is shared with other runs going at the same time
+    # and this run is held to its weighted fair share of it (CAP_scheduler).
+    def __init__(self, rate=None, priority=None):
+        self.rate = rate
+        self.share = RateShare(priority) if rate and priority else None
+        self.next_slot = SPAWN_CONTEXT.Value('d', 0.0, lock=False)
+        self.lock = SPAWN_CONTEXT.Lock()
+
+    async def wait(self):
+        if not self.rate:
+            return
+        rate = self.share.rate(self.rate) if self.share is not None else self.rate
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot.value)
+            self.next_slot.value = slot + 1.0 / rate
+        delay = slot - now
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def shard_key(value):
+    # Stable across processes and runs, unlike hash()
+    return zlib.crc32(str(value).strip().upper().encode('utf-8'))
+
+
+def shard_indices(keys, workers, by='range'):
+    # Split input positions into `workers` shards: contiguous row ranges, or by
+    # hash of the key so repeats of a VRM/capid land in the same shard's cache
+    if by not in SHARD_MODES:
+        raise ValueError(f"Unknown shard mode '{by}', expected one of {SHARD_MODES}")
+    keys = list(keys)
+    if by == 'hash':
+        shards = [[] for _ in range(workers)]
+        for index, key in enumerate(keys):
+            shards[shard_key(key) % workers].append(index)
+    else:
+        size = -(-len(keys) // workers) if keys else 0
+        shards = [list(range(start, min(start + size, len(keys)))) for start in range(0, len(keys), size or 1)]
+    return [shard for shard in shards if shard]
+
+
+def init_worker(budget, initializer, initargs):
+    # Runs once in each worker process: share the parent's call budget, then the tool's own set-up
+    BUDGET.adopt(budget)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def run_instrumented(shard_worker, payload, tracing):
+    # Runs in the worker process: the shard's rows plus the metrics and trace spans recorded for it
+    METRICS.reset()
+    if tracing:
+        TRACER.enable()
+    rows = shard_worker(payload)
+    return rows, METRICS.snapshot(), TRACER.take_events()
+
+
+def run_sharded(shard_worker, shard_payloads, workers, initializer=None, initargs=(), progress=None):
+    # Run shard_worker(payload) for every payload in its own process. Each worker
+    # returns a list of (input_index, row) sorted by input_index; the merged
+    # result is yielded in input order. progress(payload) is called as each shard finishes.
+    # Each shard's metrics and trace spans are merged into this process's METRICS and TRACER,
+    # and every worker draws on this process's call BUDGET.
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=SPAWN_CONTEXT,
+                             initializer=init_worker, initargs=(BUDGET, initializer, initargs)) as executor:
+        futures = {executor.submit(run_instrumented, shard_worker, payload, TRACER.enabled): payload
+                   for payload in shard_payloads}
+        for future in as_completed(futures):
+            rows, snapshot, events = future.result()
+            results.append(rows)
+            METRICS.merge(snapshot)
+            TRACER.events.extend(events)
+            if progress is not None:
+                progress(futures[future])
+    return heapq.merge(*results, key=lambda item: item[0])
@@ -0,0 +1,140 @@
+# Optional per-row tracing for the CAP tools, exported as a Chrome trace.
+#
+# With --trace, every row is given a lane for as long as it is being worked on and
+# its phases are recorded as spans in that lane: queue wait, connection wait and
+# connect (from aiohttp's trace hooks, see CAP_connect), request, parse, fallback and write, each
+# tagged with the row and VRM. The run writes <tool>_trace_<timestamp>.json to
+# the tool's Logs folder; open it in chrome://tracing or https://ui.perfetto.dev
+# to see how many rows were in flight at once and where they stalled. Sharded
+# runs add each worker's spans under the worker's process id.
+#
+# Tracing is off unless enabled: span() and row() then hand back one shared no-op
+# object and record() returns at once, so the only cost is a flag check.
+import contextvars
+import heapq
+import json
+import os
+import time
+from datetime import datetime
+
+# (lane, row identifiers) of the row the current task is working on
+CURRENT_ROW = contextvars.ContextVar('CAP_trace_row', default=None)
+MAIN_LANE = 0  # Spans recorded outside any row, e.g. writing the output file
+
+
+class NullSpan:
+    # Stands in for every span while tracing is off
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.record(self.name, self.started, **self.args)
+        return False
+
+
+class RowSpan(Span):
+    # Holds a lane for one row; spans recorded while it is open land in that lane
+    def __enter__(self):
+        self.lane = self.tracer.take_lane()
+        self.token = CURRENT_ROW.set((self.lane, self.args))
+        return super().__enter__()
+
+    def __exit__(self, exc_type, exc, tb):
+        super().__exit__(exc_type, exc, tb)
+        CURRENT_ROW.reset(self.token)
+        self.tracer.free_lane(self.lane)
+        return False
+
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.marks = {}
+        self.free_lanes = []
+        self.next_lane = MAIN_LANE + 1
+        self.pid = os.getpid()
+
+    def enable(self):
+        self.enabled = True
+        self.pid = os.getpid()
+
+    def take_events(self):
+        events, self.events = self.events, []
+        return events
+
+    def take_lane(self):
+        if self.free_lanes:
+            return heapq.heappop(self.free_lanes)
+        self.next_lane += 1
+        return self.next_lane - 1
+
+    def free_lane(self, lane):
+        heapq.heappush(self.free_lanes, lane)
+
+    def row(self, name, **ids):
+        # with TRACER.row('row', row=index, vrm=vrm): ... one lane for the row's phases
+        return RowSpan(self, name, ids) if self.enabled else NULL_SPAN
+
+    def span(self, name, **args):
+        return Span(self, name, args) if self.enabled else NULL_SPAN
+
+    def record(self, name, started, ended=None, **args):
+        # A finished span from perf_counter() started to ended (default: now)
+        if not self.enabled:
+            return
+        if ended is None:
+            ended = time.perf_counter()
+        current = CURRENT_ROW.get()
+        lane, ids = current if current is not None else (MAIN_LANE, {})
+        self.events.append({
+            'name': name, 'ph': 'X', 'pid': self.pid, 'tid': lane,
+            'ts': round(started * 1e6, 1), 'dur': round((ended - started) * 1e6, 1),
+            'args': {**ids, **args} if args else ids,
+        })
+
+    def mark(self, key):
+        # Note when an item was queued; since(key, ...) records the wait once it is picked up
+        if self.enabled:
+            self.marks[key] = time.perf_counter()
+
+    def since(self, key, name, **args):
+        if self.enabled and key in self.marks:
+            self.record(name, self.marks.pop(key), **args)
+
+    def export(self, directory, tool):
+        # Writes <directory>/<tool>_trace_<timestamp>.json in Chrome trace format and returns its path
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{tool}_trace_{datetime.now().strftime('%Y%m%d%H%M%S')}.json")
+        lanes = sorted({(event['pid'], event['tid']) for event in self.events})
+        metadata = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': MAIN_LANE,
+                     'args': {'name': tool if pid == self.pid else f'{tool} worker {pid}'}}
+                    for pid in sorted({pid for pid, _ in lanes})]
+        metadata += [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': lane,
+                      'args': {'name': 'main' if lane == MAIN_LANE else f'lane {lane}'}}
+                     for pid, lane in lanes]
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': metadata + self.events, 'displayTimeUnit': 'ms'}, file)
+        return path
+
+
+TRACER = Tracer()
@@ -0,0 +1,281 @@
+# Valuation warehouse: every valuation from every tool and run, in one place.
+#
+# Each run's output files are timestamped and laid out the tool's own way, so
+# finding what a car was worth last month meant searching through CSVs. Every
+# tool now also adds its valuations here, one record per valuation, with the
+# same columns whichever tool made it:
+#
+#   vrm, capid, reg_date, mileage_bucket, valuation_date, endpoint, clean, retail, tool, run_id
+#
+# endpoint is the CAP call the figures came from (GetUsedLive_IdRegDateMileage or
+# VRMValuation). Records are kept in Parquet files partitioned by valuation month:
+#
+#   Warehouse/valuation_month=2024-01/CAPID_Lookup_<run>_<id>.parquet
+#   Warehouse/index.sqlite   files, plus the VRMs and capids in each file
+#
+# A lookup by VRM or capid finds its files through the index and reads only
+# those; a date range reads only the months it covers. Within a file, records
+# are sorted by VRM, so Parquet's row group statistics skip the rest.
+#
+# python CAP_warehouse.py AB12CDE [--from 2024-01-01] [--to 2024-01-31]
+# python CAP_warehouse.py --capid 81738 --csv history.csv
+import argparse
+import json
+import os
+import sqlite3
+import time
+import uuid
+from datetime import datetime
+
+import pandas as pd
+
+from CAP_output import to_dates, to_numbers
+
+WAREHOUSE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Warehouse')
+INDEX_FILENAME = 'index.sqlite'
+ROW_GROUP_ROWS = 10000  # Records per Parquet row group; smaller groups skip more on a lookup
+COMPRESSION = 'zstd'
+
+# Record columns: (name, type) with type 'string', 'int' or 'date', as for CAP_output.ParquetSink
+RECORD_COLUMNS = [
+    ('vrm', 'string'), ('capid', 'int'), ('reg_date', 'date'), ('mileage_bucket', 'int'),
+    ('valuation_date', 'date'), ('endpoint', 'string'), ('clean', 'int'), ('retail', 'int'),
+    ('tool', 'string'), ('run_id', 'string'),
+]
+
+# Fields a tool maps to its own output columns (the rest come from the valuations and the run).
+# A tool may also map 'interpolated' to a column listing the cells of a row that were
+# estimated (CAP_interpolate); those valuations are left out.
+ROW_FIELDS = ('vrm', 'capid', 'reg_date', 'mileage_bucket')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    tool TEXT,
+    run_id TEXT,
+    month TEXT,
+    records INTEGER,
+    added TEXT
+);
+CREATE TABLE IF NOT EXISTS vehicles (
+    vrm TEXT,
+    capid INTEGER,
+    path TEXT
+);
+CREATE INDEX IF NOT EXISTS vehicles_by_vrm ON vehicles (vrm);
+CREATE INDEX IF NOT EXISTS vehicles_by_capid ON vehicles (capid);
+CREATE INDEX IF NOT EXISTS files_by_month ON files (month);
+"""
+
+
+def arrow_schema():
+    import pyarrow as pa
+    arrow_types = {'string': pa.string(), 'int': pa.int64(), 'date': pa.date32()}
+    return pa.schema([(name, arrow_types[kind]) for name, kind in RECORD_COLUMNS])
+
+
+def connect(directory=WAREHOUSE_DIRECTORY):
+    os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(os.path.join(directory, INDEX_FILENAME), timeout=30)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def normalise_vrm(vrm):
+    return str(vrm).upper().replace(' ', '')
+
+
+def available(directory):
+    # False, with a note, when pyarrow is missing; also False when the warehouse is
+    # turned off (directory None)
+    if directory is None:
+        return False
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        print("pyarrow is not installed; this run's valuations are not added to the warehouse.")
+        return False
+    return True
+
+
+def to_records(frame, tool, run_id, fields, valuations):
+    # One record per valuation in each row of frame. fields maps ROW_FIELDS to frame's
+    # columns; valuations lists (CAP endpoint, valuation date column, clean column,
+    # retail column), optionally followed by a mileage bucket column for a valuation
+    # that may have been made at another bucket than the row's (e.g. a 10,000-mile
+    # fallback). Valuations without figures ('n/a', blank or 0) are left out.
+    frame = frame.reset_index(drop=True)
+    row_fields = {
+        'vrm': frame[fields['vrm']].map(normalise_vrm, na_action='ignore'),
+        'capid': to_numbers(pd.to_numeric(frame[fields['capid']], errors='coerce').round()),
+        'reg_date': to_dates(frame[fields['reg_date']].astype('string').str[:10]),
+        'mileage_bucket': to_numbers(pd.to_numeric(frame[fields['mileage_bucket']], errors='coerce').round()),
+    }
+    estimated = pd.Series([[]] * len(frame), dtype=object)
+    if fields.get('interpolated') in frame:
+        estimated = frame[fields['interpolated']].fillna('').astype(str).str.split()
+    parts = []
+    for endpoint, date_column, clean_column, retail_column, *bucket_column in valuations:
+        part = pd.DataFrame({
+            **row_fields,
+            **({'mileage_bucket': to_numbers(pd.to_numeric(frame[bucket_column[0]], errors='coerce').round())}
+               if bucket_column else {}),
+            'valuation_date': to_dates(frame[date_column].astype('string').str[:10]),
+            'endpoint': endpoint,
+            'clean': to_numbers(pd.to_numeric(frame[clean_column], errors='coerce').round()),
+            'retail': to_numbers(pd.to_numeric(frame[retail_column], errors='coerce').round()),
+            'tool': tool,
+            'run_id': run_id,
+        })
+        valued = ((part['clean'].fillna(0) > 0) | (part['retail'].fillna(0) > 0)) \
+            & ~estimated.map(lambda cells: clean_column in cells)
+        parts.append(part[valued & part['vrm'].notna() & part['valuation_date'].notna()])
+    return pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=[name for name, _ in RECORD_COLUMNS])
+
+
+def add_frame(frame, tool, run_id, fields, valuations, directory=WAREHOUSE_DIRECTORY):
+    # Adds the valuations in frame (see to_records) as one file per valuation month and
+    # returns the number of records added
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    records = to_records(frame, tool, run_id, fields, valuations)
+    if records.empty:
+        return 0
+    months = pd.to_datetime(records['valuation_date']).dt.strftime('%Y-%m')
+    schema = arrow_schema()
+    added = datetime.now().isoformat(timespec='seconds')
+    connection = connect(directory)
+    try:
+        for month, part in records.groupby(months, sort=True):
+            part = part.sort_values(['vrm', 'capid', 'valuation_date'])
+            relative_path = os.path.join(f'valuation_month={month}', f'{tool}_{run_id}_{uuid.uuid4().hex[:8]}.parquet')
+            path = os.path.join(directory, relative_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Written under a temporary name first, so a query never reads half a file
+            pq.write_table(pa.Table.from_pandas(part, schema=schema, preserve_index=False), f'{path}.partial',
+                           compression=COMPRESSION, row_group_size=ROW_GROUP_ROWS)
+            os.replace(f'{path}.partial', path)
+            vehicles = part[['vrm', 'capid']].drop_duplicates()
+            with connection:
+                connection.execute("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                                   (relative_path, tool, run_id, month, len(part), added))
+                connection.executemany("INSERT INTO vehicles VALUES (?, ?, ?)",
+                                       ((vrm, None if pd.isna(capid) else int(capid), relative_path)
+                                        for vrm, capid in vehicles.itertuples(index=False)))
+    finally:
+        connection.close()
+    return len(records)
+
+
+class WarehouseSink:
+    # Output sink (CAP_output.open_output) collecting the columns the warehouse needs from
+    # each row written, and adding the run's valuations when the output is closed
+    path = None  # Not an output file of the run
+
+    def __init__(self, directory, tool, run_id, fields, valuations, constants=None):
+        self.directory = directory
+        self.tool = tool
+        self.run_id = run_id
+        self.fields = fields
+        self.valuations = valuations
+        self.constants = constants or {}
+        self.columns = {column: [] for column in
+                        [fields[name] for name in ROW_FIELDS] +
+                        ([fields['interpolated']] if 'interpolated' in fields else []) +
+                        [column for valuation in valuations for column in valuation[1:]]
+                        if column not in self.constants}
+
+    @classmethod
+    def open(cls, directory, tool, run_id, fields, valuations, constants=None):
+        # A sink for the run, or None when the warehouse is turned off (directory None)
+        # or pyarrow is not installed. constants holds columns with the same value in
+        # every row (e.g. the run's valuation date) that the rows themselves don't carry.
+        if not available(directory):
+            return None
+        return cls(directory, tool, run_id, fields, valuations, constants)
+
+    def write(self, row):
+        for column, values in self.columns.items():
+            values.append(row.get(column))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        frame = pd.DataFrame(self.columns, dtype=object).assign(**self.constants)
+        added = add_frame(frame, self.tool, self.run_id, self.fields, self.valuations, self.directory)
+        print(f"{added} valuations added to the warehouse in {self.directory}")
+
+
+def query(vrm=None, capid=None, start=None, end=None, tool=None, directory=WAREHOUSE_DIRECTORY):
+    # Records matching every criterion given, newest valuation first. capid is one capid
+    # or a list of them; start and end are inclusive 'YYYY-MM-DD' valuation dates.
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+
+    conditions, parameters = [], []
+    if start:
+        conditions.append("f.month >= ?")
+        parameters.append(start[:7])
+    if end:
+        conditions.append("f.month <= ?")
+        parameters.append(end[:7])
+    if tool:
+        conditions.append("f.tool = ?")
+        parameters.append(tool)
+    if vrm:
+        conditions.append("v.vrm = ?")
+        parameters.append(normalise_vrm(vrm))
+    capids = None
+    if capid is not None:
+        capids = [int(value) for value in capid] if isinstance(capid, (list, tuple, set)) else [int(capid)]
+        conditions.append("v.capid IN (SELECT value FROM json_each(?))")
+        parameters.append(json.dumps(capids))
+    source = "files f JOIN vehicles v ON v.path = f.path" if vrm or capid is not None else "files f"
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    connection = connect(directory)
+    try:
+        paths = [os.path.join(directory, path) for (path,) in
+                 connection.execute(f"SELECT DISTINCT f.path FROM {source}{where}", parameters)]
+    finally:
+        connection.close()
+
+    columns = [name for name, _ in RECORD_COLUMNS]
+    if not paths:
+        return pd.DataFrame(columns=columns)
+    expression = pc.scalar(True)
+    if vrm:
+        expression &= pc.field('vrm') == normalise_vrm(vrm)
+    if capids is not None:
+        expression &= pc.field('capid').isin(capids)
+    if start:
+        expression &= pc.field('valuation_date') >= pd.Timestamp(start).date()
+    if end:
+        expression &= pc.field('valuation_date') <= pd.Timestamp(end).date()
+    if tool:
+        expression &= pc.field('tool') == tool
+    table = ds.dataset(paths, schema=arrow_schema(), format='parquet').to_table(filter=expression)
+    return table.to_pandas().sort_values(['valuation_date', 'run_id'], ascending=False, ignore_index=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Look up valuations from every CAP tool and run")
+    parser.add_argument('vrm', nargs='?', help="Registration to look up")
+    parser.add_argument('--capid', type=int, help="CAPID to look up")
+    parser.add_argument('--from', dest='start', metavar='DATE', help="Earliest valuation date, YYYY-MM-DD")
+    parser.add_argument('--to', dest='end', metavar='DATE', help="Latest valuation date, YYYY-MM-DD")
+    parser.add_argument('--tool', help="Only valuations from this tool, e.g. CAP_Stock")
+    parser.add_argument('--csv', metavar='PATH', help="Write the records to a CSV file instead of printing them")
+    parser.add_argument('--warehouse', metavar='DIR', default=WAREHOUSE_DIRECTORY,
+                        help="Warehouse directory (default: %(default)s)")
+    args = parser.parse_args()
+    started = time.perf_counter()
+    found = query(args.vrm, args.capid, args.start, args.end, args.tool, args.warehouse)
+    elapsed = time.perf_counter() - started
+    if args.csv:
+        found.to_csv(args.csv, index=False)
+        print(f"{len(found)} records written to {args.csv}")
+    elif not found.empty:
+        print(found.to_string(index=False))
+    print(f"{len(found)} records in {elapsed * 1000:.0f} ms")
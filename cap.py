@@ -0,0 +1,66 @@
+# The cap command: one entry point for every CAP tool.
+#
+#   cap stock|vrm|capid|sales|serve|warehouse [tool options]
+#
+# Runs the highest version of the tool's script (e.g. CAPID_Lookup_VA_v3.1.py)
+# in this interpreter. cap puts this folder on the import path and loads CAP_config
+# once before the tool starts; the scripts do no path set-up of their own, so run
+# directly they need the editable install below. Every tool but warehouse takes the common options (--concurrency,
+# --rate, --cache, --resume, --profile) from CAP_options; `cap <tool> --help`
+# lists them along with the tool's own options. Install with `pip install -e .`
+# for a `cap` command on the PATH, or run `python cap.py`.
+import argparse
+import glob
+import os
+import re
+import runpy
+import sys
+
+CAP_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Subcommand -> (tool folder, script pattern, description)
+TOOLS = {
+    'stock': ('CAP Stock', 'CAP_Stock*.py', "Add CAP values to the autoedit stock export"),
+    'vrm': ('CAP VRM Lookup', 'CAP_VRM_Lookup*.py', "Look up CAP values for every VRM in VRM_Input.csv"),
+    'capid': ('CAPID Lookup', 'CAPID_Lookup_VA*.py', "Value every CAPID in CAPID_Lookup_Input.csv"),
+    'sales': ('CAP Sales', 'CAP_Sales*.py', "Value sales at their sale and purchase dates"),
+    'serve': ('', 'CAP_service.py', "Serve CAP valuations over HTTP on this machine"),
+    'warehouse': ('', 'CAP_warehouse.py', "Look up valuations from every tool and run"),
+}
+
+
+def script_version(path):
+    # 'CAP_Stock v1.8.py' -> (1, 8); scripts without a version sort first
+    found = re.search(r'v(\d+(?:\.\d+)*)\.py$', os.path.basename(path))
+    return tuple(int(part) for part in found.group(1).split('.')) if found else ()
+
+
+def newest_script(tool):
+    folder, pattern, _ = TOOLS[tool]
+    scripts = glob.glob(os.path.join(CAP_DIRECTORY, folder, pattern))
+    if not scripts:
+        raise FileNotFoundError(f"No {pattern} script in {os.path.join(CAP_DIRECTORY, folder)}")
+    return max(scripts, key=lambda path: (script_version(path), os.path.getmtime(path)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='cap', description="Run a CAP tool")
+    subparsers = parser.add_subparsers(dest='tool', required=True, metavar='TOOL')
+    for tool, (_, _, description) in TOOLS.items():
+        subparsers.add_parser(tool, help=description, add_help=False)
+    # Everything after the tool name, including --help, is left for the tool's own parser
+    args, tool_args = parser.parse_known_args(argv)
+
+    script = newest_script(args.tool)
+    print(f"Running {os.path.basename(script)}")
+
+    # The tool parses its own options (including the common ones) from sys.argv
+    sys.argv = [script] + tool_args
+    if CAP_DIRECTORY not in sys.path:
+        sys.path.insert(0, CAP_DIRECTORY)
+    import CAP_config  # noqa: F401  Loaded once here; the tool's imports reuse it
+    runpy.run_path(script, run_name='__main__')
+
+
+if __name__ == '__main__':
+    main()